@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""Compare the peak memory of reading a TSV data resource for loading.
+
+- "materialized": the old behavior of CfdeDataPackage.load_data_files(),
+  which reads every row, converts every row, and encodes one request body
+- "streamed": loader.iter_batches(), which builds one batch at a time
+
+Each reader runs in a fresh process, and its peak RSS is reported with the
+increase over an idle process. A synthetic resource of the given size in MB
+(default 1024) is written to a temporary directory.
+
+Example:
+
+   python3 benchmarks/loader_memory_benchmark.py 1024
+
+"""
+
+import csv
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+
+from cfde_ap import loader
+
+
+HEADER = ["id_namespace", "local_id", "project", "filename", "size_in_bytes",
+          "sha256", "file_format", "data_type", "mime_type", "persistent_id"]
+MISSING_VALUES = {""}
+BATCH_SIZE = 1000
+
+
+def row2dict_factory(header):
+    def row2dict(row):
+        return {k: (None if v in MISSING_VALUES else v) for k, v in zip(header, row)}
+    return row2dict
+
+
+def write_resource(path, megabytes):
+    with open(path, "w") as out:
+        out.write("\t".join(HEADER) + "\n")
+        i = 0
+        while out.tell() < megabytes * 1024 * 1024:
+            out.write(f"tag:example.org,2020:\tfile-{i}\tproject-{i % 100}\tsample_{i}.fastq.gz\t"
+                      f"{i * 1024}\t{i:064x}\tformat:3989\tdata:3494\t\t\n")
+            i += 1
+
+
+def peak_rss():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def idle(path):
+    return 0
+
+
+def materialized(path):
+    with open(path, "r", newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        row2dict = row2dict_factory(next(reader))
+        raw_rows = list(reader)
+        dict_rows = [row2dict(row) for row in raw_rows]
+        body = json.dumps(dict_rows).encode()
+    return len(body)
+
+
+def streamed(path):
+    return sum(len(body) for count, body in
+               loader.iter_batches(path, row2dict_factory, BATCH_SIZE))
+
+
+def measure(function, path):
+    def run(queue):
+        function(path)
+        queue.put(peak_rss())
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run, args=(queue,))
+    process.start()
+    rss = queue.get()
+    process.join()
+    return rss
+
+
+if __name__ == "__main__":
+    # Fork after importing, so every process starts from the same baseline
+    multiprocessing.set_start_method("fork")
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "file.tsv")
+        write_resource(path, megabytes)
+        print(f"Resource: {os.path.getsize(path) / 1024 / 1024:.0f} MB")
+        baseline = measure(idle, path)
+        for name, function in [("materialized", materialized), ("streamed", streamed)]:
+            rss = measure(function, path)
+            print("{:<15} peak RSS {:>8.0f} MB (+{:.0f} MB)".format(
+                name, rss / 1024 / 1024, (rss - baseline) / 1024 / 1024))
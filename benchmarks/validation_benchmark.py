@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+"""Compare the per-request cost of validating /run input against INPUT_SCHEMA.
+
+- "jsonschema.validate": the old behavior, which checks the schema and
+  builds a validator on every request
+- "compiled jsonschema": validation.compile_validator(..., fast=False)
+- "compiled fastjsonschema": validation.compile_validator(..., fast=True),
+  only if fastjsonschema is installed
+
+Example:
+
+   python3 benchmarks/validation_benchmark.py 20000
+
+"""
+
+import sys
+import timeit
+
+import jsonschema
+
+from cfde_ap import validation
+from cfde_ap.schemas import INPUT_SCHEMA
+
+
+BODY = {
+    "data_url": "https://example.org/bags/c2m2-test.zip",
+    "operation": "ingest",
+    "server": "demo.derivacloud.org",
+    "catalog_acls": {
+        "owner": ["https://auth.globus.org/a437abe3-c9a4-11e9-b441-0efb3ba9a670"],
+        "select": ["*"]
+    }
+}
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+candidates = {
+    "jsonschema.validate": lambda: jsonschema.validate(BODY, INPUT_SCHEMA)
+}
+compiled = validation.compile_validator(INPUT_SCHEMA, fast=False)
+candidates["compiled jsonschema"] = lambda: compiled(BODY)
+if validation.fastjsonschema is not None:
+    fast = validation.compile_validator(INPUT_SCHEMA, fast=True)
+    candidates["compiled fastjsonschema"] = lambda: fast(BODY)
+
+baseline = None
+for name, function in candidates.items():
+    seconds = min(timeit.repeat(function, number=runs, repeat=3)) / runs
+    baseline = baseline or seconds
+    print("{:<25} {:>10.1f} us/request {:>8.1f}x".format(name, seconds * 1e6,
+                                                         baseline / seconds))
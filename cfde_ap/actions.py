@@ -1,20 +1,21 @@
-import json
 import logging
 import os
-import tempfile
+import re
 
 from cfde_deriva.datapackage import CfdeDataPackage
 from deriva.core import DerivaServer
-import requests
+from deriva.transfer import DerivaRestore, DerivaRestoreError
 
 from cfde_ap import CONFIG
+from . import loader, model_cache
 from .utils import get_deriva_token
 
 
 logger = logging.getLogger(__name__)
 
 
-def deriva_ingest(servername, data_json_file, catalog_id=None, acls=None):
+def deriva_ingest(servername, data_json_file, catalog_id=None, acls=None,
+                  ingest_mode="insert", progress=None, catalog_created=None, resume=False):
     """Perform an ingest to DERIVA into a catalog, using the CfdeDataPackage.
 
     Arguments:
@@ -24,12 +25,27 @@ def deriva_ingest(servername, data_json_file, catalog_id=None, acls=None):
                 Default None, to create a new catalog.
         acls (dict): The ACLs to set on the catalog.
                 Default None to use default ACLs.
+        ingest_mode (str): "insert" to add every row, "upsert" to add new rows and update
+                changed rows, or "sync" to also delete rows not in the data.
+                Default "insert".
+        progress (function): Called as progress(result) after each table is loaded,
+                with the table's load results. Default None.
+        catalog_created (function): Called as catalog_created(catalog_id) when a new
+                catalog is created, before it is provisioned and loaded, so that an
+                interrupted ingest can be resumed in the same catalog. Default None.
+        resume (bool): True if the existing catalog was created by an interrupted ingest,
+                to provision it with the schema if that was not done, and to not insert
+                again the rows loaded before the interruption (see EntityLoader).
+                Default False.
 
     Returns:
         dict: The result of the ingest.
             success (bool): True when the ingest was successful.
             catalog_id (str): The catalog's ID.
     """
+    # Rows can only be updated or deleted in an existing catalog
+    if ingest_mode != "insert" and not catalog_id:
+        raise ValueError(f"Ingest mode '{ingest_mode}' requires an existing catalog")
     # Format credentials in DerivaServer-expected format
     creds = {
         "bearer-token": get_deriva_token()
@@ -41,18 +57,18 @@ def deriva_ingest(servername, data_json_file, catalog_id=None, acls=None):
     if catalog_id:
         catalog_id = str(int(catalog_id))
         catalog = server.connect_ermrest(catalog_id)
-    # Otherwise, we need to fetch the latest model for provisioning
-    else:
-        canon_schema = requests.get(CONFIG["DERIVA_SCHEMA_LOCATION"]).json()
-        with tempfile.TemporaryDirectory() as schema_dir:
-            schema_path = os.path.join(schema_dir, "model.json")
-            with open(schema_path, 'w') as f:
-                json.dump(canon_schema, f)
-
-            provisional_datapack = CfdeDataPackage(schema_path, verbose=False)
-            catalog = server.create_ermrest_catalog()
+        if resume and CONFIG["DERIVA_SCHEMA_NAME"] not in catalog.getCatalogModel().schemas:
+            provisional_datapack = model_cache.get_canonical_datapackage()
             provisional_datapack.set_catalog(catalog)
             provisional_datapack.provision()
+    # Otherwise, we need the latest model for provisioning
+    else:
+        provisional_datapack = model_cache.get_canonical_datapackage()
+        catalog = server.create_ermrest_catalog()
+        if catalog_created is not None:
+            catalog_created(catalog.catalog_id)
+        provisional_datapack.set_catalog(catalog)
+        provisional_datapack.provision()
 
     # Now we create a datapackage to ingest the actual data
     datapack = CfdeDataPackage(data_json_file, verbose=False)
@@ -84,7 +100,13 @@ def deriva_ingest(servername, data_json_file, catalog_id=None, acls=None):
 
     # Load data from files into DERIVA
     # This is the step that will fail if the data are incorrect
-    datapack.load_data_files()
+    load_res = loader.load_datapackage(datapack,
+                                       os.path.dirname(os.path.abspath(data_json_file)),
+                                       mode=ingest_mode, progress=progress, resume=resume)
+    logger.info(f"Ingest ({ingest_mode}) into {catalog.catalog_id}: "
+                f"{sum(res['inserted'] for res in load_res)} rows inserted, "
+                f"{sum(res['updated'] for res in load_res)} updated, "
+                f"{sum(res['deleted'] for res in load_res)} deleted")
 
     return {
         "success": True,
@@ -128,3 +150,129 @@ def deriva_modify(servername, catalog_id, acls=None):
     return {
         "success": True
     }
+
+
+class RestoreProgressHandler(logging.Handler):
+    """Collect per-table results from the log messages of DerivaRestore,
+    which logs through the root logger and reports table failures only in its log.
+
+    Arguments:
+        callback (function): Called as callback(progress) after each table is restored,
+                with the progress dict. Default None.
+    """
+    TABLE_RESULT = re.compile(r"Restoration of table data \[(.+?)\] (successful|failed)\. "
+                              r"(\d+) rows restored")
+    CATALOG_RESULT = re.compile(r"Restore of catalog \S+ (completed successfully|failed)\.")
+
+    def __init__(self, callback=None):
+        super().__init__(logging.INFO)
+        self.callback = callback
+        self.catalog_failed = False
+        self.progress = {
+            "tables_restored": 0,
+            "rows_restored": 0,
+            "failed_tables": []
+        }
+
+    def emit(self, record):
+        message = record.getMessage()
+        match = self.CATALOG_RESULT.search(message)
+        if match:
+            self.catalog_failed = match.group(1) == "failed"
+            return
+        match = self.TABLE_RESULT.search(message)
+        if not match:
+            return
+        table_name, result, rows = match.groups()
+        if result == "successful":
+            self.progress["tables_restored"] += 1
+        else:
+            self.progress["failed_tables"].append(table_name)
+        self.progress["rows_restored"] += int(rows)
+        _report_restore(self.callback, dict(self.progress, last_table=table_name))
+
+
+class _LevelFilter(logging.Filter):
+    """Drop records below a level."""
+    def __init__(self, level):
+        super().__init__()
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno >= self.level
+
+
+def _report_restore(callback, progress):
+    if callback is None:
+        return
+    try:
+        callback(progress)
+    except Exception as e:
+        logger.warning(f"Unable to report restore progress: {repr(e)}")
+
+
+def deriva_restore(servername, input_path, catalog_id=None, progress=None):
+    """Restore a DERIVA backup into a catalog, in this process.
+
+    Arguments:
+        servername (str): The name of the DERIVA server.
+        input_path (str): The path to the backup bag, as a directory or archive.
+        catalog_id (str or int): The ID of an existing catalog to restore into.
+                Default None, to create a new catalog.
+        progress (function): Called as progress(dict) with the phase of the restore,
+                "restoring" or "restored", and after each table is restored,
+                with the counts of tables and rows restored. Default None.
+
+    Returns:
+        dict: The result of the restore.
+            success (bool): True when the restore was successful.
+            catalog_id (str): The catalog's ID.
+            tables_restored (int): The number of tables with data restored.
+            rows_restored (int): The number of rows restored.
+
+    Raises:
+        DerivaRestoreError: When the restore of a table or the catalog failed.
+    """
+    server_args = {
+        "host": servername,
+        "protocol": "https",
+        "catalog_id": str(int(catalog_id)) if catalog_id else None
+    }
+    restorer = DerivaRestore(server_args, input_path=input_path,
+                             oauth2_token=get_deriva_token())
+
+    # DerivaRestore logs its results at INFO through the root logger. The root logger
+    # passes INFO records to the handler during the restore, and its other handlers
+    # drop records below the level the root logger was configured with.
+    handler = RestoreProgressHandler(progress)
+    root_logger = logging.getLogger()
+    root_level = root_logger.level
+    level_filter = _LevelFilter(root_logger.getEffectiveLevel())
+    other_handlers = list(root_logger.handlers)
+    for other_handler in other_handlers:
+        other_handler.addFilter(level_filter)
+    root_logger.addHandler(handler)
+    if root_logger.getEffectiveLevel() > logging.INFO:
+        root_logger.setLevel(logging.INFO)
+    _report_restore(progress, {"phase": "restoring"})
+    try:
+        restorer.restore()
+    finally:
+        root_logger.removeHandler(handler)
+        root_logger.setLevel(root_level)
+        for other_handler in other_handlers:
+            other_handler.removeFilter(level_filter)
+
+    if handler.progress["failed_tables"]:
+        raise DerivaRestoreError("Restore of tables {} failed"
+                                 .format(", ".join(handler.progress["failed_tables"])))
+    if handler.catalog_failed:
+        raise DerivaRestoreError("Restore of catalog failed")
+    result = {
+        "success": True,
+        "catalog_id": str(restorer.catalog_id),
+        "tables_restored": handler.progress["tables_restored"],
+        "rows_restored": handler.progress["rows_restored"]
+    }
+    _report_restore(progress, dict(result, phase="restored"))
+    return result
@@ -1,9 +1,13 @@
+from collections import Counter
 from datetime import datetime, timedelta, timezone
+import hashlib
 import logging
 import multiprocessing
 import os
+import random
 import shutil
-import subprocess
+import threading
+import time
 
 from flask import Flask, jsonify, request
 from globus_action_provider_tools.authentication import TokenChecker
@@ -12,12 +16,12 @@ from globus_action_provider_tools.validation import (
     response_validator
 )
 from isodate import duration_isoformat, parse_duration, parse_datetime
-import jsonschema
 from openapi_core.wrappers.flask import FlaskOpenAPIResponse, FlaskOpenAPIRequest
-import requests
 
 from cfde_ap import CONFIG
-from . import actions, error as err, utils
+from . import (actions, bag_cache, bags, downloads, error as err, loader, model_cache,
+               scheduler, status_cache, status_store, tokens, utils, validation)
+from .cache import TTLCache
 
 
 # Flask setup
@@ -44,9 +48,49 @@ TBL = CONFIG["DEMO_DYNAMO_TABLE"]
 ROOT = "/"  # Segregate different APs by root path?
 TOKEN_CHECKER = TokenChecker(CONFIG["GLOBUS_CC_APP"], CONFIG["GLOBUS_SECRET"],
                              [CONFIG["GLOBUS_SCOPE"]], CONFIG["GLOBUS_AUD"])
+# Input validator, compiled once
+INPUT_VALIDATOR = validation.compile_validator(CONFIG["INPUT_SCHEMA"],
+                                               fast=CONFIG["FAST_INPUT_VALIDATION"])
+# Counts of responses validated against the API specification, by result
+RESPONSE_VALIDATION_STATS = Counter()
+RESPONSE_VALIDATION_LOCK = threading.Lock()
+RESPONSE_VALIDATION_MODES = {"always", "sampled", "log", "off"}
+if CONFIG["RESPONSE_VALIDATION"] not in RESPONSE_VALIDATION_MODES:
+    raise ValueError("Unknown RESPONSE_VALIDATION mode '{}', must be one of {}"
+                     .format(CONFIG["RESPONSE_VALIDATION"], sorted(RESPONSE_VALIDATION_MODES)))
+# Checked tokens' auth states, keyed by the token's SHA-256 hash
+AUTH_CACHE = TTLCache(CONFIG["AUTH_CACHE_SIZE"], CONFIG["AUTH_CACHE_TTL"])
+
+# Durable record of the actions queued and running on this node
+JOB_LOG = scheduler.JobLog(CONFIG["JOB_DB_PATH"], CONFIG["NODE_ID"])
+
+# Clean up environment, keeping data for actions to be recovered
+utils.clean_environment(keep=JOB_LOG.action_ids())
+# Receive status updates from action processes into the status cache
+status_cache.start_listener()
+# Keep the shared DERIVA token fresh, so actions never wait on Globus Auth
+tokens.DERIVA_TOKENS.start_refresher(CONFIG["DERIVA_TOKEN_CHECK_INTERVAL"])
+# Load the canonical model before forking and keep it current, so action processes inherit it
+model_cache.start_refresher(CONFIG["DERIVA_SCHEMA_CHECK_INTERVAL"])
+
+
+def _mark_started(action_id):
+    # Actions are created INACTIVE, and become ACTIVE when they get a worker
+    utils.update_action_status(TBL, action_id, {
+        "status": "ACTIVE",
+        "details": {
+            "message": "Action started"
+        }
+    })
 
-# Clean up environment
-utils.clean_environment()
+
+def _mark_start_failed(action_id, error):
+    utils.update_action_status(TBL, action_id, {
+        "status": "FAILED",
+        "details": {
+            "error": f"Unable to start action: {str(error)}"
+        }
+    })
 
 
 #######################################
@@ -60,17 +104,63 @@ def handle_invalid_usage(error):
     return response
 
 
+def get_auth_state(token):
+    """Return the auth state of a bearer token, from AUTH_CACHE if checked recently.
+    Valid tokens are cached until they expire, up to AUTH_CACHE_TTL seconds;
+    invalid tokens are cached for AUTH_NEGATIVE_CACHE_TTL seconds.
+    """
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    auth_state = AUTH_CACHE.get(token_hash)
+    if auth_state is None:
+        auth_state = TOKEN_CHECKER.check_token(token)
+        token_details = auth_state.introspect_token()
+        if token_details is None:
+            ttl = CONFIG["AUTH_NEGATIVE_CACHE_TTL"]
+        else:
+            ttl = min(CONFIG["AUTH_CACHE_TTL"], token_details.get("exp", 0) - time.time())
+        AUTH_CACHE.put(token_hash, auth_state, ttl=ttl)
+    return auth_state
+
+
+def get_response_validation_stats():
+    with RESPONSE_VALIDATION_LOCK:
+        stats = {
+            "validated": RESPONSE_VALIDATION_STATS["validated"],
+            "failed": RESPONSE_VALIDATION_STATS["failed"],
+            "skipped": RESPONSE_VALIDATION_STATS["skipped"]
+        }
+    stats["mode"] = CONFIG["RESPONSE_VALIDATION"]
+    return stats
+
+
+def get_stats():
+    # Service statistics for this API process
+    return {
+        "scheduler": SCHEDULER.stats(),
+        "bag_cache": bag_cache.stats(),
+        "status_cache": status_cache.stats(),
+        "auth_cache": AUTH_CACHE.stats(),
+        "response_validation": get_response_validation_stats(),
+        "dynamodb": status_store.get_dmo_stats()
+    }
+
+
 @app.before_request
 def before_request():
     # Service alive check can skip validation
     if request.path == "/ping":
         return {"success": True}
-    wrapped_req = FlaskOpenAPIRequest(request)
-    validation_result = request_validator.validate(wrapped_req)
-    if validation_result.errors:
-        raise err.InvalidRequest("; ".join([str(err) for err in validation_result.errors]))
+    # Service statistics are not in the API specification, but still require authentication
+    if request.path != "/stats":
+        wrapped_req = FlaskOpenAPIRequest(request)
+        # Reused to validate the response
+        request.openapi_request = wrapped_req
+        validation_result = request_validator.validate(wrapped_req)
+        if validation_result.errors:
+            raise err.InvalidRequest("; ".join([str(err)
+                                                for err in validation_result.errors]))
     token = request.headers.get("Authorization", "").replace("Bearer ", "")
-    auth_state = TOKEN_CHECKER.check_token(token)
+    auth_state = get_auth_state(token)
     if not auth_state.identities:
         # Return auth errors for debugging - may change in prod for security
         raise err.NoAuthentication("; ".join([str(err) for err in auth_state.errors]))
@@ -79,13 +169,30 @@ def before_request():
 
 @app.after_request
 def after_request(response):
-    wrapped_req = FlaskOpenAPIRequest(request)
+    # Service paths are not in the API specification
+    if request.path in ["/ping", "/stats"]:
+        return response
+    # "always" rejects invalid responses; "sampled" and "log" only log them,
+    # "sampled" checking only a fraction of responses to keep validation off the hot path
+    mode = CONFIG["RESPONSE_VALIDATION"]
+    if mode == "off" or (mode == "sampled"
+                         and random.random() >= CONFIG["RESPONSE_VALIDATION_SAMPLE_RATE"]):
+        with RESPONSE_VALIDATION_LOCK:
+            RESPONSE_VALIDATION_STATS["skipped"] += 1
+        return response
+    # Requests rejected before validation were not wrapped
+    wrapped_req = getattr(request, "openapi_request", None) or FlaskOpenAPIRequest(request)
     wrapped_resp = FlaskOpenAPIResponse(response)
     validation_result = response_validator.validate(wrapped_req, wrapped_resp)
+    with RESPONSE_VALIDATION_LOCK:
+        RESPONSE_VALIDATION_STATS["validated"] += 1
+        if validation_result.errors:
+            RESPONSE_VALIDATION_STATS["failed"] += 1
     if validation_result.errors:
         logger.error("Error on response: {}, {}"
                      .format(response.response, validation_result.errors))
-        raise err.DeveloperError("; ".join([str(err) for err in validation_result.errors]))
+        if mode == "always":
+            raise err.DeveloperError("; ".join([str(err) for err in validation_result.errors]))
     return response
 
 
@@ -93,6 +200,14 @@ def after_request(response):
 # API Routes
 #######################################
 
+@app.route("/stats", methods=["GET"])
+def service_stats():
+    # Service statistics are visible to those allowed to run actions
+    if not request.auth.check_authorization(["urn:globus:groups:id:" + CONFIG["GLOBUS_GROUP"]]):
+        raise err.NotAuthorized("You cannot view the service statistics.")
+    return jsonify(get_stats())
+
+
 @app.route(ROOT, methods=["GET"])
 def meta():
     resp = {
@@ -125,12 +240,7 @@ def run():
     req = request.get_json(force=True)
     # Validate input
     body = req.get("body", {})
-    try:
-        jsonschema.validate(body, CONFIG["INPUT_SCHEMA"])
-    except jsonschema.ValidationError as e:
-        # Raise just the first line of the exception text, which contains the error
-        # The entire body and schema are in the exception, which are too verbose
-        raise err.InvalidRequest(str(e).split("\n")[0])
+    INPUT_VALIDATOR(body)
     # Must have data_url if ingest or restore
     if body["operation"] in ["ingest", "restore"] and not body.get("data_url"):
         raise err.InvalidRequest("You must provide a data_url to ingest or restore.")
@@ -141,18 +251,28 @@ def run():
         elif not body.get("catalog_acls"):
             raise err.InvalidRequest("You must specify content in the catalog to modify. "
                                      "(Currently only catalog_acls qualifies.)")
+    # Rows can only be updated or deleted in an existing catalog
+    if body.get("ingest_mode", "insert") != "insert":
+        if body["operation"] != "ingest":
+            raise err.InvalidRequest("ingest_mode only applies to the 'ingest' operation.")
+        elif not body.get("catalog_id"):
+            raise err.InvalidRequest(f"You must specify the catalog_id to "
+                                     f"{body['ingest_mode']}.")
     # If request_id has been submitted before, return status instead of starting new
     try:
-        status = utils.read_action_by_request(TBL, req["request_id"])
+        status = utils.read_action_by_request(TBL, req["request_id"], consistent=True)
     # Otherwise, create new action
     except err.NotFound:
         # TODO: Accurately estimate completion time
         estimated_completion = datetime.now(tz=timezone.utc) + timedelta(days=1)
 
         default_release_after = timedelta(days=30)
+        # Reject new actions while the queue is full
+        if SCHEDULER.is_full():
+            raise err.ServiceUnavailable("Too many actions are queued, please retry later")
         job = {
-            # Start job as ACTIVE - no "waiting" status
-            "status": "ACTIVE",
+            # Start job as INACTIVE, SCHEDULER marks it ACTIVE when it gets a worker
+            "status": "INACTIVE",
             # Default these to the principals of whoever is running this action:
             "manage_by": request.auth.identities,
             "monitor_by": request.auth.identities,
@@ -186,12 +306,42 @@ def run():
             job["monitor_by"] = list(job["monitor_by"])
         # Standardize datetime to ISO format
         job["release_after"] = duration_isoformat(job["release_after"])
+        job["details"] = {
+            "message": "Action queued"
+        }
 
         # Create status in database (creates action_id)
-        job = utils.create_action_status(TBL, job)
-
-        # start_action() blocks, throws exception on failure, returns on success
-        start_action(job["action_id"], req["body"])
+        try:
+            job = utils.create_action_status(TBL, job)
+        # Created by a concurrent retry of this request since it was checked
+        except err.DuplicateRequest:
+            status = utils.read_action_by_request(TBL, req["request_id"], consistent=True)
+            return jsonify(utils.translate_status(status))
+
+        # start_action() queues the action, throws exception on failure,
+        # returns whether it starts without waiting on success
+        try:
+            if start_action(job["action_id"], req["body"]):
+                job["status"] = "ACTIVE"
+                job["details"] = {
+                    "message": "Action started"
+                }
+        except Exception as e:
+            utils.update_action_status(TBL, job["action_id"], {
+                "status": "FAILED",
+                "details": {
+                    "error": f"Unable to start action: {str(e)}"
+                }
+            })
+            # Release an action rejected for lack of capacity,
+            # so that a retry of the request starts a new action
+            if isinstance(e, err.ServiceUnavailable):
+                try:
+                    utils.delete_action_status(TBL, job["action_id"])
+                except Exception as e2:
+                    logger.error(f"{job['action_id']}: Unable to release rejected action: "
+                                 f"{repr(e2)}")
+            raise
 
         res = jsonify(utils.translate_status(job))
         res.status_code = 202
@@ -202,7 +352,8 @@ def run():
 
 @app.route(ROOT+"<action_id>/status", methods=["GET"])
 def status(action_id):
-    status = utils.read_action_status(TBL, action_id)
+    # Polling is frequent, so tolerate bounded staleness for cheaper reads
+    status = utils.read_action_status(TBL, action_id, cached=True, consistent=False)
     if not request.auth.check_authorization(status["monitor_by"]):
         raise err.NotAuthorized("You cannot view the status of action {}".format(action_id))
     return jsonify(utils.translate_status(status))
@@ -210,12 +361,13 @@ def status(action_id):
 
 @app.route(ROOT+"<action_id>/cancel", methods=["POST"])
 def cancel(action_id):
-    status = utils.read_action_status(TBL, action_id)
+    # Terminal state check must be consistent
+    status = utils.read_action_status(TBL, action_id, consistent=True)
     if not request.auth.check_authorization(status["manage_by"]):
         raise err.NotAuthorized("You cannot cancel action {}".format(action_id))
 
     clean_status = utils.translate_status(status)
-    if clean_status["status"] in ["SUCCEEDED", "FAILED"]:
+    if clean_status["status"] in utils.TERMINAL_STATUSES:
         raise err.InvalidState("Action {} already completed".format(action_id))
 
     cancel_action(action_id)
@@ -225,16 +377,9 @@ def cancel(action_id):
 
 @app.route(ROOT+"<action_id>/release", methods=["POST"])
 def release(action_id):
-    status = utils.read_action_status(TBL, action_id)
-    if not request.auth.check_authorization(status["manage_by"]):
-        raise err.NotAuthorized("You cannot cancel action {}".format(action_id))
-
-    clean_status = utils.translate_status(status)
-    if clean_status["status"] in ["ACTIVE", "INACTIVE"]:
-        raise err.InvalidState("Action {} not completed and cannot be released".format(action_id))
-
-    utils.delete_action_status(TBL, action_id)
-    return clean_status
+    # Existence, authorization, and completion are checked by the conditional delete
+    status = utils.delete_action_status(TBL, action_id, principals=request.auth.principals)
+    return jsonify(utils.translate_status(status))
 
 
 #######################################
@@ -253,37 +398,34 @@ def start_action(action_id, action_data):
             raise ValueError(f"Server '{action_data['server']}' does not match server for "
                              f"catalog '{action_data['catalog_id']}' ({catalog_info['server']})")
 
-    # TODO: Process management
-    #       Currently assuming process manages itself
+    # Actions run in processes managed by SCHEDULER, which queues them if all workers are busy
+    priority = CONFIG["JOB_PRIORITIES"].get(action_data["operation"], 0)
     # Restore Action
     if action_data["operation"] == "restore":
         logger.info(f"{action_id}: Starting Deriva restore into "
                     f"{action_data.get('catalog_id', 'new catalog')}")
-        # Spawn new process
+        # Queue new process
         args = (action_id, action_data["data_url"], action_data.get("server"),
                 action_data.get("catalog_id"))
-        driver = multiprocessing.Process(target=action_restore, args=args, name=action_id)
-        driver.start()
+        return SCHEDULER.submit(action_id, "restore", args, priority=priority)
     # Ingest Action
     elif action_data["operation"] == "ingest":
         logger.info(f"{action_id}: Starting Deriva ingest into "
                     f"{action_data.get('catalog_id', 'new catalog')}")
-        # Spawn new process
+        # Queue new process
         args = (action_id, action_data["data_url"], action_data.get("server"),
-                action_data.get("catalog_id"), action_data.get("catalog_acls"))
-        driver = multiprocessing.Process(target=action_ingest, args=args, name=action_id)
-        driver.start()
+                action_data.get("catalog_id"), action_data.get("catalog_acls"),
+                action_data.get("ingest_mode", "insert"))
+        return SCHEDULER.submit(action_id, "ingest", args, priority=priority)
     elif action_data["operation"] == "modify":
         logger.info(f"{action_id}: Starting Deriva modification of "
                     f"{action_data['catalog_id']}")
-        # Spawn new process
+        # Queue new process
         args = (action_id, action_data["catalog_id"], action_data.get("server"),
                 action_data.get("catalog_acls"))
-        driver = multiprocessing.Process(target=action_modify, args=args, name=action_id)
-        driver.start()
+        return SCHEDULER.submit(action_id, "modify", args, priority=priority)
     else:
         raise err.InvalidRequest("Operation '{}' unknown".format(action_data["operation"]))
-    return
 
 
 def cancel_action(action_id):
@@ -298,14 +440,11 @@ def cancel_action(action_id):
 #######################################
 
 def action_restore(action_id, url, server=None, catalog=None):
-    token = utils.get_deriva_token()
     if not server:
         server = CONFIG["DEFAULT_SERVER_NAME"]
 
     # Download backup zip file
     # TODO: Determine file type
-    #       Use original file name (Content-Disposition)
-    #       Make filename unique if collision
 
     # Excessive try-except blocks because there's (currently) no process management;
     # if the action fails, it needs to always self-report failure
@@ -313,7 +452,8 @@ def action_restore(action_id, url, server=None, catalog=None):
     logger.debug(f"{action_id}: Deriva restore process started")
     # Setup
     try:
-        file_path = os.path.join(CONFIG["DATA_DIR"], "cfde-backup.zip")
+        # Each action downloads into its own directory, so concurrent restores don't collide
+        data_dir = os.path.join(CONFIG["DATA_DIR"], action_id + "/")
     except Exception as e:
         error_status = {
             "status": "FAILED",
@@ -332,11 +472,27 @@ def action_restore(action_id, url, server=None, catalog=None):
         return
     # TODO: Check that catalog exists - non-existent catalog will fail
 
+    # Resume from the last checkpoint if this action was interrupted
+    stage, checkpoint = JOB_LOG.get_checkpoint(action_id)
+
     logger.debug(f"{action_id}: Downloading '{url}'")
     # Download link
     try:
-        with open(file_path, 'wb') as output:
-            output.write(requests.get(url).content)
+        # Reuse a backup downloaded before an interruption
+        if checkpoint.get("file_path") and os.path.isfile(checkpoint["file_path"]):
+            file_path = checkpoint["file_path"]
+            logger.debug(f"{action_id}: Resuming with downloaded backup '{file_path}'")
+        else:
+            download = downloads.download_file(url, data_dir)
+            file_path = download["path"]
+            JOB_LOG.checkpoint(action_id, "downloaded", file_path=file_path)
+            utils.update_action_status(TBL, action_id, {
+                "details": {
+                    "message": "Backup downloaded, restoring",
+                    "download_bytes": download["bytes"],
+                    "download_bytes_per_second": download["bytes_per_second"]
+                }
+            })
     except Exception as e:
         error_status = {
             "status": "FAILED",
@@ -352,33 +508,22 @@ def action_restore(action_id, url, server=None, catalog=None):
                           f"After error '{repr(e)}'")
         return
 
-    # TODO: Use package calls instead of subprocess
-    logger.debug(f"{action_id}: Restoring with script")
+    # Extract and verify the backup bag
+    logger.debug(f"{action_id}: Preparing backup '{file_path}'")
     try:
-        restore_args = [
-            "deriva-restore-cli",
-            "--oauth2-token",
-            token
-        ]
-        if catalog is not None:
-            restore_args.extend([
-                "--catalog",
-                catalog
-            ])
-        restore_args.extend([
-            server,
-            file_path
-        ])
-        restore_res = subprocess.run(restore_args, capture_output=True)
-        restore_message = restore_res.stderr + restore_res.stdout
+        if checkpoint.get("bag_path") and os.path.isdir(checkpoint["bag_path"]):
+            bag_path = checkpoint["bag_path"]
+        else:
+            bag_path = bags.prepare_bag(file_path, data_dir)["bag_path"]
+            JOB_LOG.checkpoint(action_id, "extracted", file_path=file_path, bag_path=bag_path)
     except Exception as e:
         error_status = {
             "status": "FAILED",
             "details": {
-                "error": f"Unable to run restore script: {str(e)}"
+                "error": f"Unable to extract backup: {str(e)}"
             }
         }
-        logger.error(f"{action_id}: Unable to run restore script: {repr(e)}")
+        logger.error(f"{action_id}: Unable to extract backup: {repr(e)}")
         try:
             utils.update_action_status(TBL, action_id, error_status)
         except Exception as e2:
@@ -387,22 +532,43 @@ def action_restore(action_id, url, server=None, catalog=None):
                           f"After error '{repr(e)}'")
         return
 
-    # TODO: Check success, fetch ID without needing to parse output text
+    def report_progress(progress):
+        # Phase updates come without table results
+        if "last_table" not in progress:
+            details = {
+                "message": ("Restoring catalog" if progress["phase"] == "restoring"
+                            else "Catalog restored")
+            }
+        else:
+            details = {
+                "message": f"Restored table {progress['last_table']}",
+                "tables_restored": progress["tables_restored"],
+                "rows_restored": progress["rows_restored"]
+            }
+        utils.update_action_status(TBL, action_id, {
+            "details": details
+        })
+
+    logger.debug(f"{action_id}: Restoring backup")
     try:
-        if b"completed successfully" not in restore_message:
-            raise ValueError(f"DERIVA restore failed: {restore_message}")
-        deriva_link = (restore_message.split(b"Restore of catalog")[-1]
-                                      .split(b"completed successfully")[0].strip())
-        deriva_id = int(deriva_link.split(b"/")[-1])
+        # A catalog restored before an interruption is not restored again
+        if stage == "restored":
+            deriva_id = int(checkpoint["catalog_id"])
+        else:
+            restore_res = actions.deriva_restore(server, bag_path, catalog_id=catalog,
+                                                 progress=report_progress)
+            deriva_id = int(restore_res["catalog_id"])
+            JOB_LOG.checkpoint(action_id, "restored", file_path=file_path, bag_path=bag_path,
+                               catalog_id=deriva_id)
         deriva_samples = f"https://{server}/chaise/recordset/#{deriva_id}/demo:Samples"
     except Exception as e:
         error_status = {
             "status": "FAILED",
             "details": {
-                "error": f"Restore script output parsing failed: {str(e)}"
+                "error": f"DERIVA restore failed: {str(e)}"
             }
         }
-        logger.error(f"{action_id}: Restore script output parsing failed: {repr(e)}")
+        logger.error(f"{action_id}: DERIVA restore failed: {repr(e)}")
         try:
             utils.update_action_status(TBL, action_id, error_status)
         except Exception as e2:
@@ -428,10 +594,18 @@ def action_restore(action_id, url, server=None, catalog=None):
         with open("ERROR.log", 'w') as out:
             out.write(f"Error updating status on {action_id}: '{repr(e)}'\n\n"
                       f"After success on ID '{deriva_id}'")
+
+    # Remove restored backup from disk
+    # Failed restores are not removed, which helps debugging
+    try:
+        shutil.rmtree(data_dir)
+    except Exception as e:
+        logger.info(f"Data dir '{data_dir}' not deleted after restore: {repr(e)}")
     return
 
 
-def action_ingest(action_id, url, servername=None, catalog_id=None, acls=None):
+def action_ingest(action_id, url, servername=None, catalog_id=None, acls=None,
+                  ingest_mode="insert"):
     # Download ingest BDBag
     # Excessive try-except blocks because there's (currently) no process management;
     # if the action fails, it needs to always self-report failure
@@ -439,7 +613,8 @@ def action_ingest(action_id, url, servername=None, catalog_id=None, acls=None):
     if not servername:
         servername = CONFIG["DEFAULT_SERVER_NAME"]
 
-    logger.debug(f"{action_id}: Deriva ingest process started for {catalog_id or 'new catalog'}")
+    logger.debug(f"{action_id}: Deriva {ingest_mode} process started for "
+                 f"{catalog_id or 'new catalog'}")
     # Setup
     try:
         if acls is None:
@@ -462,11 +637,20 @@ def action_ingest(action_id, url, servername=None, catalog_id=None, acls=None):
                           f"After error '{repr(e)}'")
         return
 
+    # Resume from the last checkpoint if this action was interrupted
+    stage, checkpoint = JOB_LOG.get_checkpoint(action_id)
+
     # TODO: Check that catalog exists if catalog_id set
     # Download and unarchive link
     logger.debug(f"{action_id}: Downloading '{url}'")
     try:
-        bag_path = utils.download_data(url, data_dir)
+        # Reuse data downloaded before an interruption
+        if checkpoint.get("bag_path") and os.path.isdir(checkpoint["bag_path"]):
+            bag_path = checkpoint["bag_path"]
+            logger.debug(f"{action_id}: Resuming with downloaded data '{bag_path}'")
+        else:
+            bag_path = utils.download_data(url, data_dir)
+            JOB_LOG.checkpoint(action_id, "downloaded", bag_path=bag_path)
         bag_data_path = os.path.join(bag_path, "data")
     except Exception as e:
         error_status = {
@@ -506,14 +690,57 @@ def action_ingest(action_id, url, servername=None, catalog_id=None, acls=None):
                           f"After error '{repr(e)}'")
         return
 
+    load_progress = {
+        "tables_loaded": 0,
+        "rows_loaded": 0,
+        "rows_inserted": 0,
+        "rows_updated": 0,
+        "table_rows_per_second": {}
+    }
+
+    def report_progress(result):
+        load_progress["tables_loaded"] += 1
+        load_progress["rows_loaded"] += result["rows"]
+        load_progress["rows_inserted"] += result["inserted"]
+        load_progress["rows_updated"] += result["updated"]
+        load_progress["table_rows_per_second"][result["table"]] = result["rows_per_second"]
+        utils.update_action_status(TBL, action_id, {
+            "details": {
+                "message": f"Loaded table {result['table']}",
+                **load_progress
+            }
+        })
+
     # Ingest into Deriva
     logger.debug(f"{action_id}: Ingesting into Deriva")
     try:
         # TODO: Determine schema name from data
         schema_name = CONFIG["DERIVA_SCHEMA_NAME"]
 
-        ingest_res = actions.deriva_ingest(servername, schema_file_path,
-                                           catalog_id=catalog_id, acls=acls)
+        # Do not repeat an ingest completed before an interruption
+        if stage == "ingested":
+            ingest_res = {
+                "success": True,
+                "catalog_id": checkpoint["catalog_id"]
+            }
+        # Continue in the catalog created before an interruption, instead of
+        # creating another. Rows loaded before the interruption are not inserted again.
+        elif stage == "catalog_created":
+            logger.info(f"{action_id}: Resuming ingest into catalog {checkpoint['catalog_id']}")
+            ingest_res = actions.deriva_ingest(servername, schema_file_path,
+                                               catalog_id=checkpoint["catalog_id"], acls=acls,
+                                               ingest_mode=ingest_mode,
+                                               progress=report_progress, resume=True)
+        else:
+            def catalog_created(new_catalog_id):
+                JOB_LOG.checkpoint(action_id, "catalog_created", bag_path=bag_path,
+                                   catalog_id=new_catalog_id)
+
+            ingest_res = actions.deriva_ingest(servername, schema_file_path,
+                                               catalog_id=catalog_id, acls=acls,
+                                               ingest_mode=ingest_mode,
+                                               progress=report_progress,
+                                               catalog_created=catalog_created)
         if not ingest_res["success"]:
             error_status = {
                 "status": "FAILED",
@@ -524,6 +751,7 @@ def action_ingest(action_id, url, servername=None, catalog_id=None, acls=None):
             utils.update_action_status(TBL, action_id, error_status)
             return
         catalog_id = ingest_res["catalog_id"]
+        JOB_LOG.checkpoint(action_id, "ingested", bag_path=bag_path, catalog_id=catalog_id)
     except Exception as e:
         error_status = {
             "status": "FAILED",
@@ -531,6 +759,11 @@ def action_ingest(action_id, url, servername=None, catalog_id=None, acls=None):
                 "error": f"Error ingesting to DERIVA: {str(e)}"
             }
         }
+        # Rows loaded before the error are not rolled back
+        if isinstance(e, loader.PartialLoadError):
+            error_status["details"]["partial_load"] = True
+            error_status["details"]["deriva_id"] = e.catalog_id
+            error_status["details"]["rows_written"] = e.rows_written
         logger.error(f"{action_id}: Error ingesting to DERIVA: {repr(e)}")
         try:
             utils.update_action_status(TBL, action_id, error_status)
@@ -630,3 +863,21 @@ def action_modify(action_id, catalog_id, servername=None, acls=None):
             out.write(f"Error updating status on {action_id}: '{repr(e)}'\n\n"
                       f"After success on ID '{catalog_id}'")
     return
+
+
+#######################################
+# Action scheduling
+#######################################
+
+# Run actions in a bounded pool of processes
+SCHEDULER = scheduler.JobScheduler({
+                                       "restore": action_restore,
+                                       "ingest": action_ingest,
+                                       "modify": action_modify
+                                   },
+                                   CONFIG["MAX_WORKERS"], CONFIG["MAX_QUEUED_JOBS"],
+                                   job_log=JOB_LOG, on_start=_mark_started,
+                                   on_error=_mark_start_failed)
+# Restart actions interrupted by a previous shutdown of this node
+SCHEDULER.recover(CONFIG["JOB_MAX_ATTEMPTS"])
+SCHEDULER.start()
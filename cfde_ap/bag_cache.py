@@ -0,0 +1,340 @@
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from cfde_ap import CONFIG
+from . import downloads
+
+
+logger = logging.getLogger(__name__)
+
+# Marks a complete cache entry, and records its location and size.
+# The entry's last use is the modification time of this file.
+ENTRY_FILE = "entry.json"
+STATS_FILE = "stats.json"
+# Lock files, one per entry and one per download in progress
+LOCK_DIR = ".locks"
+# Downloads in progress, kept after a failure so that a retry can resume them
+STAGING_DIR = ".staging"
+
+
+@contextmanager
+def _locked(lock_path, blocking=True):
+    """Hold an exclusive lock on lock_path, shared by all processes on the node.
+    Yields True if the lock was acquired, which is always the case when blocking.
+    A lock file removed by its holder (see _remove_lock()) is recreated by the next waiter.
+    """
+    while True:
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                current = os.stat(lock_path)
+            except FileNotFoundError:
+                current = None
+            # The file was removed while waiting for it, so lock its replacement
+            if current is None or not os.path.samestat(current, os.fstat(lock_file.fileno())):
+                continue
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return
+
+
+def _remove_lock(lock_path):
+    """Remove a lock file which is no longer needed. Must hold the lock."""
+    try:
+        os.remove(lock_path)
+    except FileNotFoundError:
+        pass
+
+
+def _lock_path(name):
+    lock_dir = os.path.join(CONFIG["BAG_CACHE_DIR"], LOCK_DIR)
+    os.makedirs(lock_dir, exist_ok=True)
+    return os.path.join(lock_dir, name)
+
+
+def _entry_lock(key):
+    """The lock on a cache entry, held only while it is read, written, or removed."""
+    return _lock_path(key)
+
+
+def _fetch_lock(key):
+    """The lock on fetching a bag into the cache, held for the whole download,
+    so that concurrent requests for the same bag wait for one download.
+    """
+    return _lock_path(key + ".fetch")
+
+
+def _global_lock():
+    return os.path.join(CONFIG["BAG_CACHE_DIR"], ".lock")
+
+
+def _dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _read_entry(entry_dir):
+    """Return the metadata of a complete cache entry, or None."""
+    try:
+        with open(os.path.join(entry_dir, ENTRY_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _link_or_copy(src, dst):
+    # Hard links share the cached data without copying it, and keep it
+    # available to this action if the entry is evicted
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _count(name, n=1):
+    """Add to a counter shared by all processes using the cache."""
+    with _locked(_global_lock()):
+        path = os.path.join(CONFIG["BAG_CACHE_DIR"], STATS_FILE)
+        try:
+            with open(path) as f:
+                counts = json.load(f)
+        except (OSError, ValueError):
+            counts = {}
+        counts[name] = counts.get(name, 0) + n
+        with open(path + ".tmp", 'w') as out:
+            json.dump(counts, out)
+        os.replace(path + ".tmp", path)
+
+
+def cache_key(location, info):
+    """Return the cache key for a file, or None if the file cannot be cached.
+    Files are identified by their location and their ETag or Last-Modified date;
+    a file with neither could change without notice, and is not cached.
+    """
+    if info is None:
+        return None
+    version = info["etag"] or info["last_modified"]
+    if not version:
+        return None
+    return hashlib.sha256("{}\n{}".format(location, version).encode()).hexdigest()
+
+
+def _staging_dir(key):
+    return os.path.join(CONFIG["BAG_CACHE_DIR"], STAGING_DIR, key)
+
+
+def _use_entry(key, local_path):
+    """Link the bag of a complete cache entry into local_path.
+
+    Returns:
+        str: The path to the bag in local_path, or None if the entry is not in the cache.
+    """
+    entry_dir = os.path.join(CONFIG["BAG_CACHE_DIR"], key)
+    with _locked(_entry_lock(key)):
+        entry = _read_entry(entry_dir)
+        if entry is None:
+            return None
+        os.utime(os.path.join(entry_dir, ENTRY_FILE))
+        return _link_bag(os.path.join(entry_dir, entry["bag"]), local_path)
+
+
+def _link_bag(cached_bag_path, local_path):
+    bag_path = os.path.join(local_path, os.path.basename(cached_bag_path))
+    shutil.rmtree(bag_path, ignore_errors=True)
+    os.makedirs(local_path, exist_ok=True)
+    shutil.copytree(cached_bag_path, bag_path, copy_function=_link_or_copy)
+    return bag_path
+
+
+def _fill_entry(key, location, local_path, fetch):
+    """Fetch a bag into the staging directory, then move it into the cache
+    and link it into local_path. Must hold the fetch lock of the entry.
+    A failed fetch leaves its download in the staging directory to be resumed,
+    and only removes incomplete extractions.
+
+    Returns:
+        str: The path to the bag in local_path.
+    """
+    staging_dir = _staging_dir(key)
+    os.makedirs(staging_dir, exist_ok=True)
+    for name in os.listdir(staging_dir):
+        path = os.path.join(staging_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+    staged_bag_path = os.path.normpath(fetch(location, staging_dir + "/"))
+
+    entry_dir = os.path.join(CONFIG["BAG_CACHE_DIR"], key)
+    with _locked(_entry_lock(key)):
+        # Left by a process which exited while filling the entry
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.makedirs(entry_dir)
+        bag_name = os.path.basename(staged_bag_path)
+        os.rename(staged_bag_path, os.path.join(entry_dir, bag_name))
+        entry = {
+            "location": location,
+            "bag": bag_name,
+            "size": _dir_size(entry_dir),
+            "created": time.time()
+        }
+        with open(os.path.join(entry_dir, ENTRY_FILE), 'w') as out:
+            json.dump(entry, out)
+        bag_path = _link_bag(os.path.join(entry_dir, bag_name), local_path)
+    # The download is only removed once its bag is extracted and cached
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    return bag_path
+
+
+def get_bag(location, local_path, fetch):
+    """Get an extracted BDBag, from the cache if the same version was fetched before.
+    On a miss, the bag is fetched into a staging directory, moved into the cache,
+    and the cache is trimmed to BAG_CACHE_MAX_SIZE by evicting the least recently
+    used entries. A failed fetch is resumed by the next request for the same bag.
+    Either way, the bag is linked into local_path, so the action may delete
+    its copy and the cache may evict its entry independently.
+    Entries are locked by their full key, and never while downloading,
+    so requests for other bags, and evictions, do not wait for a download.
+
+    Arguments:
+        location (str): The URL of the bag archive.
+        local_path (str): The directory to place the bag in.
+        fetch (function): Called as fetch(location, directory) to download
+                and extract the bag into directory, returning the bag path.
+
+    Returns:
+        str: The path to the extracted bag in local_path.
+    """
+    if not CONFIG["BAG_CACHE_MAX_SIZE"]:
+        return fetch(location, local_path)
+    os.makedirs(CONFIG["BAG_CACHE_DIR"], exist_ok=True)
+    key = cache_key(location, downloads.probe(location))
+    if key is None:
+        logger.debug(f"'{location}' has no version information, not caching")
+        _count("uncacheable")
+        return fetch(location, local_path)
+
+    bag_path = _use_entry(key, local_path)
+    if bag_path is None:
+        # Concurrent requests for the same bag wait for the first to fetch it
+        with _locked(_fetch_lock(key)):
+            bag_path = _use_entry(key, local_path)
+            if bag_path is None:
+                logger.info(f"Bag cache miss for '{location}'")
+                _count("misses")
+                bag_path = _fill_entry(key, location, local_path, fetch)
+                _remove_lock(_fetch_lock(key))
+            else:
+                _count("hits")
+    else:
+        _count("hits")
+    evict(keep=key)
+    return bag_path
+
+
+def evict(keep=None):
+    """Remove the least recently used cache entries until the cache is
+    no larger than BAG_CACHE_MAX_SIZE. Entries in use by another process are skipped.
+    Downloads left in the staging directory for more than BAG_CACHE_STAGING_MAX_AGE
+    seconds are removed.
+
+    Arguments:
+        keep (str): The key of an entry to never remove. Default None.
+    """
+    with _locked(_global_lock()):
+        entries = []
+        for key in os.listdir(CONFIG["BAG_CACHE_DIR"]):
+            entry_dir = os.path.join(CONFIG["BAG_CACHE_DIR"], key)
+            entry = _read_entry(entry_dir)
+            if entry is None:
+                continue
+            last_used = os.path.getmtime(os.path.join(entry_dir, ENTRY_FILE))
+            entries.append((last_used, key, entry["size"]))
+        total = sum(size for last_used, key, size in entries)
+        evicted = 0
+        for last_used, key, size in sorted(entries):
+            if total <= CONFIG["BAG_CACHE_MAX_SIZE"]:
+                break
+            if key == keep:
+                continue
+            with _locked(_entry_lock(key), blocking=False) as acquired:
+                if not acquired:
+                    continue
+                entry_dir = os.path.join(CONFIG["BAG_CACHE_DIR"], key)
+                os.remove(os.path.join(entry_dir, ENTRY_FILE))
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                _remove_lock(_entry_lock(key))
+            total -= size
+            evicted += 1
+            logger.debug(f"Evicted bag cache entry {key}")
+        _remove_stale_staging()
+    if evicted:
+        _count("evictions", evicted)
+
+
+def _remove_stale_staging():
+    """Remove abandoned downloads from the staging directory."""
+    staging_root = os.path.join(CONFIG["BAG_CACHE_DIR"], STAGING_DIR)
+    if not os.path.isdir(staging_root):
+        return
+    for key in os.listdir(staging_root):
+        staging_dir = os.path.join(staging_root, key)
+        try:
+            age = time.time() - os.path.getmtime(staging_dir)
+        except OSError:
+            continue
+        if age <= CONFIG["BAG_CACHE_STAGING_MAX_AGE"]:
+            continue
+        with _locked(_fetch_lock(key), blocking=False) as acquired:
+            if not acquired:
+                continue
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            _remove_lock(_fetch_lock(key))
+        logger.debug(f"Removed abandoned bag cache download {key}")
+
+
+def stats():
+    """Return the hit counts and size of the bag cache.
+
+    Returns:
+        dict: The size, max_size, hits, misses, hit_ratio, uncacheable, and evictions.
+    """
+    if not CONFIG["BAG_CACHE_MAX_SIZE"] or not os.path.isdir(CONFIG["BAG_CACHE_DIR"]):
+        return {}
+    try:
+        with open(os.path.join(CONFIG["BAG_CACHE_DIR"], STATS_FILE)) as f:
+            counts = json.load(f)
+    except (OSError, ValueError):
+        counts = {}
+    size = 0
+    for key in os.listdir(CONFIG["BAG_CACHE_DIR"]):
+        entry = _read_entry(os.path.join(CONFIG["BAG_CACHE_DIR"], key))
+        if entry is not None:
+            size += entry["size"]
+    hits = counts.get("hits", 0)
+    misses = counts.get("misses", 0)
+    return {
+        "size": size,
+        "max_size": CONFIG["BAG_CACHE_MAX_SIZE"],
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": (hits / (hits + misses)) if hits + misses else 0.0,
+        "uncacheable": counts.get("uncacheable", 0),
+        "evictions": counts.get("evictions", 0)
+    }
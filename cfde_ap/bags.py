@@ -0,0 +1,265 @@
+from concurrent.futures import as_completed, ProcessPoolExecutor
+import hashlib
+import logging
+import os
+import shutil
+import time
+import urllib.parse
+import zipfile
+
+from bdbag import bdbag_api
+
+from cfde_ap import CONFIG
+
+
+logger = logging.getLogger(__name__)
+
+# Manifest algorithms in order of preference. Only the first present is verified.
+MANIFEST_ALGORITHMS = ["sha512", "sha256", "sha1", "md5"]
+
+
+def parse_manifest(lines):
+    """Parse the lines of a BagIt manifest.
+
+    Returns:
+        dict: The expected checksum of each file, keyed by its path relative to the bag.
+    """
+    checksums = {}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        checksum, path = line.split(None, 1)
+        # BagIt percent-encodes CR, LF, and % in manifest paths
+        path = path.strip().replace("%0D", "\r").replace("%0A", "\n").replace("%25", "%")
+        checksums[os.path.normpath(path)] = checksum.lower()
+    return checksums
+
+
+def parse_fetch(lines):
+    """Return the paths of the files listed in a BagIt fetch.txt,
+    which are not included in the bag itself.
+    """
+    paths = set()
+    for line in lines:
+        parts = line.strip().split(None, 2)
+        if len(parts) == 3:
+            paths.add(os.path.normpath(urllib.parse.unquote(parts[2])))
+    return paths
+
+
+def _batches(items, sizes):
+    """Group items into batches of about BAG_VERIFY_BATCH_SIZE bytes.
+    Small batches let a mismatch stop the remaining work sooner.
+    """
+    batch = []
+    batch_size = 0
+    for item, size in zip(items, sizes):
+        batch.append(item)
+        batch_size += size
+        if batch_size >= CONFIG["BAG_VERIFY_BATCH_SIZE"]:
+            yield batch
+            batch = []
+            batch_size = 0
+    if batch:
+        yield batch
+
+
+def _run_batches(function, batches):
+    """Run function on each batch in a process pool.
+    Each call returns None, or an error message for the first bad file in its batch.
+
+    Raises ValueError with the first error message reported, after cancelling
+    the batches not yet started.
+    """
+    with ProcessPoolExecutor(max_workers=CONFIG["BAG_VERIFY_WORKERS"]) as pool:
+        futures = [pool.submit(function, *batch) for batch in batches]
+        for future in as_completed(futures):
+            error = future.result()
+            if error is not None:
+                for other in futures:
+                    other.cancel()
+                raise ValueError(error)
+
+
+def _extract_members(archive_path, output_dir, members, bag_prefix, checksums, algorithm):
+    """Extract members of a zip archive, checking each file's checksum as it is written.
+
+    Returns:
+        str: An error message for the first mismatched file, or None if all match.
+    """
+    output_dir = os.path.realpath(output_dir)
+    with zipfile.ZipFile(archive_path) as archive:
+        for name in members:
+            dest = os.path.realpath(os.path.join(output_dir, name))
+            if not dest.startswith(output_dir + os.sep):
+                return f"Archive member '{name}' is outside the bag"
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            path = os.path.normpath(name[len(bag_prefix):])
+            hasher = hashlib.new(algorithm) if path in checksums else None
+            with archive.open(name) as src, open(dest, 'wb') as out:
+                while True:
+                    chunk = src.read(CONFIG["DOWNLOAD_CHUNK_SIZE"])
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+            if hasher is not None and hasher.hexdigest() != checksums[path]:
+                return f"Checksum mismatch for '{path}'"
+    return None
+
+
+def _verify_files(bag_path, paths, checksums, algorithm):
+    """Check the checksums of extracted files.
+
+    Returns:
+        str: An error message for the first mismatched file, or None if all match.
+    """
+    for path in paths:
+        hasher = hashlib.new(algorithm)
+        with open(os.path.join(bag_path, path), 'rb') as f:
+            while True:
+                chunk = f.read(CONFIG["DOWNLOAD_CHUNK_SIZE"])
+                if not chunk:
+                    break
+                hasher.update(chunk)
+        if hasher.hexdigest() != checksums[path]:
+            return f"Checksum mismatch for '{path}'"
+    return None
+
+
+def _zip_bag_prefix(archive):
+    """Return the top-level directory of a zipped bag, including the trailing "/",
+    or None if the archive is not a single directory.
+    """
+    prefixes = {name.split("/", 1)[0] for name in archive.namelist()}
+    if len(prefixes) != 1:
+        return None
+    return prefixes.pop() + "/"
+
+
+def _read_zip_text(archive, name):
+    try:
+        return archive.read(name).decode("utf-8").splitlines()
+    except KeyError:
+        return []
+
+
+def _check_complete(checksums, present, fetched):
+    """Check that every payload file is in the manifest, and every manifest
+    entry is either present or to be fetched.
+
+    Raises ValueError otherwise.
+    """
+    payload = {path for path in present if path.startswith("data" + os.sep)}
+    unlisted = payload - set(checksums)
+    if unlisted:
+        raise ValueError(f"File '{sorted(unlisted)[0]}' is not in the bag manifest")
+    missing = set(checksums) - present - fetched
+    if missing:
+        raise ValueError(f"File '{sorted(missing)[0]}' in the bag manifest is missing")
+
+
+def _prepare_zip(archive_path, output_dir):
+    """Extract and verify a zipped bag in one pass, in parallel.
+    A bag that fails verification is removed.
+
+    Returns:
+        str: The path to the extracted bag, or None if the archive is not a single-bag zip.
+    """
+    with zipfile.ZipFile(archive_path) as archive:
+        bag_prefix = _zip_bag_prefix(archive)
+        if bag_prefix is None:
+            return None
+        algorithm = None
+        checksums = {}
+        for alg in MANIFEST_ALGORITHMS:
+            lines = _read_zip_text(archive, f"{bag_prefix}manifest-{alg}.txt")
+            if lines:
+                algorithm = alg
+                checksums = parse_manifest(lines)
+                break
+        fetched = parse_fetch(_read_zip_text(archive, f"{bag_prefix}fetch.txt"))
+        files = [info for info in archive.infolist() if not info.is_dir()]
+    if algorithm is None:
+        raise ValueError("Bag has no manifest")
+    present = {os.path.normpath(info.filename[len(bag_prefix):]) for info in files}
+    _check_complete(checksums, present, fetched)
+    bag_path = os.path.join(output_dir, bag_prefix.rstrip("/"))
+    # Largest files first, so they don't finish last
+    files.sort(key=lambda info: info.file_size, reverse=True)
+    batches = _batches([info.filename for info in files], [info.file_size for info in files])
+    try:
+        _run_batches(_extract_members, [(archive_path, output_dir, batch, bag_prefix,
+                                         checksums, algorithm) for batch in batches])
+    except Exception:
+        shutil.rmtree(bag_path, ignore_errors=True)
+        raise
+    return bag_path
+
+
+def verify_bag(bag_path):
+    """Verify the checksums of an extracted bag against its manifest, in parallel.
+
+    Raises ValueError on the first mismatched, missing, or unlisted file.
+    """
+    algorithm = None
+    checksums = {}
+    for alg in MANIFEST_ALGORITHMS:
+        manifest_path = os.path.join(bag_path, f"manifest-{alg}.txt")
+        if os.path.exists(manifest_path):
+            algorithm = alg
+            with open(manifest_path, encoding="utf-8") as f:
+                checksums = parse_manifest(f)
+            break
+    if algorithm is None:
+        raise ValueError("Bag has no manifest")
+    fetched = set()
+    if os.path.exists(os.path.join(bag_path, "fetch.txt")):
+        with open(os.path.join(bag_path, "fetch.txt"), encoding="utf-8") as f:
+            fetched = parse_fetch(f)
+    present = set()
+    for root, dirs, files in os.walk(bag_path):
+        for name in files:
+            present.add(os.path.relpath(os.path.join(root, name), bag_path))
+    _check_complete(checksums, present, fetched)
+    paths = sorted(set(checksums) & present,
+                   key=lambda path: os.path.getsize(os.path.join(bag_path, path)), reverse=True)
+    sizes = [os.path.getsize(os.path.join(bag_path, path)) for path in paths]
+    _run_batches(_verify_files, [(bag_path, batch, checksums, algorithm)
+                                 for batch in _batches(paths, sizes)])
+
+
+def prepare_bag(archive_path, output_dir):
+    """Extract a BDBag archive and verify its manifest checksums, stopping at
+    the first mismatch. Zip archives are extracted in parallel, checking each
+    file as it is written; other archives are extracted, then checked in parallel.
+    A bag that fails verification is removed.
+
+    Arguments:
+        archive_path (str): The path to the bag archive.
+        output_dir (str): The directory to extract the bag into.
+
+    Returns:
+        dict: The bag preparation results:
+            bag_path (str): The path to the extracted bag.
+            seconds (float): The time taken to extract and verify the bag.
+    """
+    start = time.monotonic()
+    bag_path = None
+    if zipfile.is_zipfile(archive_path):
+        bag_path = _prepare_zip(archive_path, output_dir)
+    if bag_path is None:
+        bag_path = bdbag_api.extract_bag(archive_path, output_dir)
+        try:
+            verify_bag(bag_path)
+        except Exception:
+            shutil.rmtree(bag_path, ignore_errors=True)
+            raise
+    seconds = time.monotonic() - start
+    logger.info(f"Bag '{bag_path}' prepared in {seconds:.2f}s")
+    return {
+        "bag_path": bag_path,
+        "seconds": seconds
+    }
@@ -17,5 +17,49 @@ BASE_CONFIG = {
                                "master/table-schema/demo-202006-model.json"),
     "FAIR_RE_URL": "https://317ec.36fe.dn.glob.us",
     "TRANSFER_PING_INTERVAL": 60,  # Seconds
-    "TRANSFER_DEADLINE": 24 * 60 * 60  # 1 day, in seconds
+    "TRANSFER_DEADLINE": 24 * 60 * 60,  # 1 day, in seconds
+    "DYNAMO_HEALTH_CHECK_INTERVAL": 5 * 60,  # Seconds
+    "STATUS_BACKEND": "dynamodb",  # "dynamodb", "sqlite", or "memory"
+    "STATUS_DB_PATH": os.path.join(os.path.expanduser("~"), "cfde_ap_status.db"),
+    "STATUS_CACHE_SIZE": 10000,  # Statuses
+    "STATUS_CACHE_TTL": 30,  # Seconds
+    "STATUS_MAX_STALENESS": 60,  # Seconds
+    "MAX_WORKERS": 4,  # Concurrent action processes
+    "MAX_QUEUED_JOBS": 50,
+    # Queue order of operations, lowest first
+    "JOB_PRIORITIES": {"modify": 0, "ingest": 1, "restore": 1},
+    "JOB_DB_PATH": os.path.join(os.path.expanduser("~"), "cfde_ap_jobs.db"),
+    "JOB_MAX_ATTEMPTS": 3,  # Starts of one action, including recoveries
+    "NODE_ID": os.uname().nodename,
+    "DOWNLOAD_CHUNK_SIZE": 1024 * 1024,  # Bytes
+    "DOWNLOAD_TIMEOUT": 60,  # Seconds to connect, or to wait for data
+    "DOWNLOAD_CONNECTIONS": 8,  # Concurrent range requests per download
+    "DOWNLOAD_RANGE_SIZE": 64 * 1024 * 1024,  # Bytes
+    "DOWNLOAD_RETRIES": 3,  # Per range
+    "BAG_CACHE_DIR": os.path.join(os.path.expanduser("~"), "cfde_ap_bag_cache"),
+    "BAG_CACHE_MAX_SIZE": 50 * 1024 ** 3,  # Bytes, 0 to disable the cache
+    # Seconds before an abandoned, partial download is removed from the cache
+    "BAG_CACHE_STAGING_MAX_AGE": 24 * 60 * 60,
+    "BAG_VERIFY_WORKERS": 4,  # Processes extracting and verifying a bag
+    "BAG_VERIFY_BATCH_SIZE": 64 * 1024 * 1024,  # Bytes of files per verification task
+    "DERIVA_TOKEN_PATH": os.path.join(os.path.expanduser("~"), ".cfde_ap_deriva_token.json"),
+    "DERIVA_TOKEN_MIN_LIFETIME": 5 * 60,  # Seconds a token must have left to be used
+    "DERIVA_TOKEN_REFRESH_AHEAD": 30 * 60,  # Seconds before expiry to refresh in background
+    "DERIVA_TOKEN_CHECK_INTERVAL": 60,  # Seconds
+    "AUTH_CACHE_SIZE": 1000,  # Tokens
+    "AUTH_CACHE_TTL": 5 * 60,  # Seconds, at most, to trust a checked token
+    "AUTH_NEGATIVE_CACHE_TTL": 30,  # Seconds to remember an invalid token
+    "FAST_INPUT_VALIDATION": True,  # Use fastjsonschema; falls back to jsonschema if missing
+    "RESPONSE_VALIDATION": "always",  # "always", "sampled", "log", or "off"
+    "RESPONSE_VALIDATION_SAMPLE_RATE": 0.05,  # Fraction of responses validated when "sampled"
+    "DERIVA_SCHEMA_CACHE_DIR": os.path.join(os.path.expanduser("~"), "cfde_ap_model_cache"),
+    "DERIVA_SCHEMA_REFRESH_INTERVAL": 10 * 60,  # Seconds between checks for model changes
+    "DERIVA_SCHEMA_CHECK_INTERVAL": 5 * 60,  # Seconds between checks in the API process
+    "LOAD_BATCH_SIZE": 1000,  # Rows per entity POST
+    "LOAD_WORKERS": 4,  # Concurrent entity POSTs per table
+    "LOAD_RETRIES": 3,
+    "LOAD_TABLE_WORKERS": 2,  # Tables loaded at once, each with LOAD_WORKERS POSTs
+    # Existing rows read per request, to upsert. Upsert and sync hold a hash of every
+    # existing row of the tables being loaded, roughly 300-500 bytes per row
+    "LOAD_FETCH_PAGE_SIZE": 10000
 }
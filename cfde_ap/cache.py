@@ -0,0 +1,80 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache(object):
+    """A thread-safe, size-bounded cache with per-entry expiry.
+    When full, the least recently used entry is evicted.
+    Hits and misses are counted for reporting with stats().
+
+    Arguments:
+        max_size (int): The maximum number of entries.
+        ttl (float): The default number of seconds an entry remains valid.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if absent or expired."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            elif entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl=None):
+        """Cache a value.
+
+        Arguments:
+            key: The key for the value.
+            value: The value to cache.
+            ttl (float): The number of seconds the value remains valid.
+                    Default None, to use the cache's default TTL.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            self.invalidate(key)
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Remove key from the cache, if present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return the cache's size and hit counts.
+
+        Returns:
+            dict: The size, hits, misses, and hit_ratio of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0
+            }
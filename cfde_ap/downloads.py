@@ -0,0 +1,291 @@
+from concurrent.futures import as_completed, ThreadPoolExecutor
+import json
+import logging
+import os
+import threading
+import time
+import urllib
+
+import requests
+
+from cfde_ap import CONFIG
+
+
+logger = logging.getLogger(__name__)
+
+# Responses to a range request which are retried like connection errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def get_http_filename(location, res):
+    """Return the filename for an HTTP download, from the Content-Disposition header
+    of the response if present, otherwise from the URL path.
+    """
+    http_filename = os.path.basename(urllib.parse.urlparse(location).path)
+    if not http_filename:
+        http_filename = "archive"
+    con_disp = res.headers.get("Content-Disposition", "")
+    filename_start = con_disp.find("filename=")
+    if filename_start >= 0:
+        filename_end = con_disp.find(";", filename_start)
+        if filename_end < 0:
+            filename_end = None
+        http_filename = con_disp[filename_start+len("filename="):filename_end]
+        http_filename = http_filename.strip("\"'; ")
+    # Never write outside the destination directory
+    return os.path.basename(http_filename) or "archive"
+
+
+def probe(location):
+    """Get the size and version of a file at an HTTP(S) location,
+    and check whether the location supports byte range requests.
+
+    Arguments:
+        location (str): The URL of the file.
+
+    Returns:
+        dict: The file information, or None if the location could not be probed:
+            size (int): The file size, or None if not reported.
+            ranges (bool): True if byte range requests are supported.
+            etag (str): The ETag of the file, or None.
+            last_modified (str): The Last-Modified date of the file, or None.
+            filename (str): The filename of the file.
+    """
+    try:
+        res = requests.head(location, allow_redirects=True, timeout=CONFIG["DOWNLOAD_TIMEOUT"])
+    except requests.RequestException as e:
+        logger.debug(f"Unable to probe '{location}': {repr(e)}")
+        return None
+    if res.status_code >= 300:
+        return None
+    try:
+        size = int(res.headers["Content-Length"])
+    except (KeyError, ValueError):
+        size = None
+    return {
+        "size": size,
+        "ranges": res.headers.get("Accept-Ranges", "").lower() == "bytes" and size is not None,
+        "etag": res.headers.get("ETag"),
+        "last_modified": res.headers.get("Last-Modified"),
+        "filename": get_http_filename(location, res)
+    }
+
+
+def _preallocate(fd, size):
+    """Reserve size bytes on disk for a file."""
+    os.ftruncate(fd, 0)
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # Not supported on this platform or filesystem, a sparse file works too
+        os.ftruncate(fd, size)
+
+
+def _save_progress(progress_path, progress):
+    """Atomically write the record of completed ranges."""
+    tmp_path = progress_path + ".tmp"
+    with open(tmp_path, 'w') as out:
+        json.dump(progress, out)
+    os.replace(tmp_path, progress_path)
+
+
+def _load_progress(progress_path, file_path, location, info):
+    """Return the ranges completed by a previous download of the same file,
+    or an empty set if there is nothing to resume.
+    """
+    try:
+        if os.path.getsize(file_path) != info["size"]:
+            return set()
+        with open(progress_path) as f:
+            progress = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    if (progress.get("location") != location or progress.get("size") != info["size"]
+            or progress.get("etag") != info["etag"]
+            or progress.get("range_size") != CONFIG["DOWNLOAD_RANGE_SIZE"]):
+        return set()
+    return set(progress.get("done", []))
+
+
+def _opaque_tag(etag):
+    """Return an ETag without its weakness indicator, for weak comparison."""
+    if etag is not None and etag.startswith("W/"):
+        return etag[2:]
+    return etag
+
+
+def download_ranges(location, file_path, info):
+    """Download a file as DOWNLOAD_RANGE_SIZE byte ranges, fetched over
+    DOWNLOAD_CONNECTIONS concurrent connections into a preallocated file.
+    Each range is retried DOWNLOAD_RETRIES times, continuing from its last byte received,
+    after connection errors and RETRY_STATUSES responses.
+    Completed ranges are recorded in a progress file beside the download,
+    so a failed download resumes where it stopped when retried.
+
+    Arguments:
+        location (str): The URL of the file.
+        file_path (str): The path to save the file to.
+        info (dict): The file information from probe().
+    """
+    size = info["size"]
+    range_size = CONFIG["DOWNLOAD_RANGE_SIZE"]
+    ranges = [(first, min(first + range_size, size) - 1) for first in range(0, size, range_size)]
+    progress_path = file_path + ".progress"
+    done = _load_progress(progress_path, file_path, location, info)
+    if done:
+        logger.info(f"Resuming download of '{location}' with {len(done)}/{len(ranges)} "
+                    "ranges complete")
+    progress = {
+        "location": location,
+        "size": size,
+        "etag": info["etag"],
+        "range_size": range_size,
+        "done": sorted(done)
+    }
+    lock = threading.Lock()
+    failed = threading.Event()
+
+    def fetch(index):
+        first, last = ranges[index]
+        offset = first
+        for attempt in range(CONFIG["DOWNLOAD_RETRIES"] + 1):
+            if failed.is_set():
+                return
+            headers = {"Range": f"bytes={offset}-{last}"}
+            # Get the whole file instead of a range if it changed, which is then rejected.
+            # Weak ETags are not allowed in If-Range (RFC 7233), they are compared below.
+            if info["etag"] and not info["etag"].startswith("W/"):
+                headers["If-Range"] = info["etag"]
+            try:
+                with requests.get(location, headers=headers, stream=True,
+                                  timeout=CONFIG["DOWNLOAD_TIMEOUT"]) as res:
+                    if res.status_code in RETRY_STATUSES:
+                        raise requests.exceptions.HTTPError(
+                                    f"Range request for '{location}' failed with status "
+                                    f"{res.status_code}", response=res)
+                    if res.status_code != 206:
+                        raise IOError(f"Range request for '{location}' failed with status "
+                                      f"{res.status_code}; the file may have changed")
+                    etag = res.headers.get("ETag")
+                    if info["etag"] and etag and _opaque_tag(etag) != _opaque_tag(info["etag"]):
+                        raise IOError(f"Range request for '{location}' returned ETag {etag}, "
+                                      f"not {info['etag']}; the file changed")
+                    for chunk in res.iter_content(chunk_size=CONFIG["DOWNLOAD_CHUNK_SIZE"]):
+                        chunk = chunk[:last + 1 - offset]
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                if offset <= last:
+                    raise requests.exceptions.ConnectionError(
+                                "Connection closed before range was complete")
+                break
+            except requests.RequestException as e:
+                if attempt >= CONFIG["DOWNLOAD_RETRIES"]:
+                    raise
+                logger.warning(f"Retrying range {first}-{last} of '{location}' "
+                               f"from byte {offset}: {repr(e)}")
+                time.sleep(2 ** attempt)
+        with lock:
+            progress["done"].append(index)
+            _save_progress(progress_path, progress)
+
+    fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if not done:
+            _preallocate(fd, size)
+        with ThreadPoolExecutor(max_workers=CONFIG["DOWNLOAD_CONNECTIONS"]) as pool:
+            futures = [pool.submit(fetch, index) for index in range(len(ranges))
+                       if index not in done]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                # Stop starting new ranges, the progress file keeps the completed ones
+                failed.set()
+                raise
+    finally:
+        os.close(fd)
+    os.remove(progress_path)
+
+
+def download_stream(location, local_path, filename=None):
+    """Download a file over one connection.
+
+    Arguments:
+        location (str): The URL of the file.
+        local_path (str): The directory to save the file in.
+        filename (str): The filename to save the file as.
+                Default None, to take the filename from the response.
+
+    Returns:
+        str: The path of the saved file.
+    """
+    # Timeout applies to connecting and to each wait for data, not the whole download
+    with requests.get(location, stream=True, timeout=CONFIG["DOWNLOAD_TIMEOUT"]) as res:
+        if res.status_code >= 300:
+            logger.error(f"Error {res.status_code} downloading file '{location}': "
+                         f"{res.content}")
+            raise IOError("File download failed: {}".format(res.content))
+        file_path = os.path.join(local_path, filename or get_http_filename(location, res))
+        with open(file_path, 'wb') as out:
+            for chunk in res.iter_content(chunk_size=CONFIG["DOWNLOAD_CHUNK_SIZE"]):
+                out.write(chunk)
+    return file_path
+
+
+def download_file(location, local_path):
+    """Stream a file from an HTTP(S) location to local storage.
+    The file is written in chunks of DOWNLOAD_CHUNK_SIZE bytes, so memory use
+    does not depend on the file size.
+    If the server supports byte ranges, large files are downloaded over several
+    connections, and a download interrupted by an error resumes when retried.
+
+    Arguments:
+        location (str): The URL of the file.
+        local_path (str): The path to save the file to. If this is a directory
+                (or ends in "/"), the filename is taken from the response.
+
+    Returns:
+        dict: The download details:
+            path (str): The path of the saved file.
+            bytes (int): The number of bytes downloaded.
+            seconds (float): The time taken to download the file.
+            bytes_per_second (int): The average throughput.
+            connections (int): The number of concurrent connections used.
+    """
+    filename = None
+    # If the local_path is a file and not a directory, use the directory
+    if ((os.path.exists(local_path) and not os.path.isdir(local_path))
+            or (not os.path.exists(local_path) and local_path[-1] != "/")):
+        filename = os.path.basename(local_path)
+        local_path = os.path.dirname(local_path) + "/"
+    os.makedirs(local_path, exist_ok=True)
+
+    loc_info = urllib.parse.urlparse(location)
+    if not loc_info.scheme.startswith("http"):
+        raise IOError("Invalid data location: '{}' is not a recognized protocol "
+                      "(from {}).".format(loc_info.scheme, str(location)))
+
+    start = time.monotonic()
+    info = None
+    if CONFIG["DOWNLOAD_CONNECTIONS"] > 1:
+        info = probe(location)
+    # Files of one range are not worth splitting
+    if info is not None and info["ranges"] and info["size"] > CONFIG["DOWNLOAD_RANGE_SIZE"]:
+        file_path = os.path.join(local_path, filename or info["filename"])
+        download_ranges(location, file_path, info)
+        connections = CONFIG["DOWNLOAD_CONNECTIONS"]
+    else:
+        file_path = download_stream(location, local_path, filename)
+        connections = 1
+    size = os.path.getsize(file_path)
+    seconds = time.monotonic() - start
+    rate = int(size / seconds) if seconds > 0 else size
+    logger.debug(f"Downloaded {size} bytes from '{location}' to '{file_path}' "
+                 f"in {seconds:.1f}s ({rate} bytes/s)")
+    return {
+        "path": file_path,
+        "bytes": size,
+        "seconds": seconds,
+        "bytes_per_second": rate,
+        "connections": connections
+    }
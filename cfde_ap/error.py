@@ -38,10 +38,21 @@ class InvalidState(ApiError):
     status = 409
 
 
+class DuplicateRequest(InvalidState):
+    """
+    An action was already created for the request_id,
+    possibly by a concurrent retry of the same request.
+    """
+
+
 class InternalError(ApiError):
     status = 500
 
 
+class ServiceUnavailable(ApiError):
+    status = 503
+
+
 class ServiceError(InternalError):
     """
     Dependent service returned an unexpected error.
@@ -0,0 +1,566 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import csv
+from datetime import date, datetime, timezone
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from deriva.core import urlquote
+import requests
+
+from cfde_ap import CONFIG
+
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses worth retrying a batch after; other errors are problems with the data
+RETRY_STATUSES = {500, 502, 503, 504}
+JSON_HEADERS = {"Content-Type": "application/json"}
+# Rows are inserted with POST; upsert also updates changed rows, and sync also deletes
+# rows which are no longer in the data
+INGEST_MODES = ("insert", "upsert", "sync")
+# Columns managed by the catalog, which are never loaded from data
+SYSTEM_COLUMNS = {"RID", "RCT", "RMT", "RCB", "RMB"}
+# Rows deleted per request, by RID in the URL
+DELETE_BATCH_SIZE = 200
+# Text values of boolean columns
+TRUE_VALUES = {"true", "t", "yes", "y", "1"}
+FALSE_VALUES = {"false", "f", "no", "n", "0"}
+
+
+def _is_transient(error):
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(error, "response", None)
+    return response is not None and response.status_code in RETRY_STATUSES
+
+
+def is_self_referencing(table):
+    """Return True if a table has a foreign key to itself."""
+    return any(fkey.pk_table.name == table.name for fkey in table.foreign_keys)
+
+
+def iter_row_batches(path, row2dict_factory, batch_size):
+    """Read a TSV data file as batches of entities, one batch at a time.
+    Only the batch being built is held, so memory does not grow with the file.
+
+    Arguments:
+        path (str): The path to the TSV file, with a header row.
+        row2dict_factory (function): Called with the header to get the row conversion function.
+        batch_size (int): The maximum number of rows per batch, or None for a single batch.
+
+    Yields:
+        list of dict: The rows of each batch.
+    """
+    with open(path, "r", newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        try:
+            row2dict = row2dict_factory(next(reader))
+        except StopIteration:
+            return
+        batch = []
+        for row in reader:
+            batch.append(row2dict(row))
+            if batch_size is not None and len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def iter_batches(path, row2dict_factory, batch_size):
+    """Read a TSV data file as JSON-encoded batches of entities, one batch at a time.
+
+    Arguments:
+        path (str): The path to the TSV file, with a header row.
+        row2dict_factory (function): Called with the header to get the row conversion function.
+        batch_size (int): The maximum number of rows per batch, or None for a single batch.
+
+    Yields:
+        tuple: The number of rows (int) and the JSON body (bytes) of each batch.
+    """
+    for batch in iter_row_batches(path, row2dict_factory, batch_size):
+        yield len(batch), json.dumps(batch).encode()
+
+
+def read_header(path):
+    """Return the column names in the header row of a TSV data file."""
+    with open(path, "r", newline="") as f:
+        return next(csv.reader(f, delimiter="\t"), [])
+
+
+def _parse_timestamp(value):
+    timestamp = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    # Naive timestamps are compared as given, and differ from the catalog's
+    # timestamptz values; a false difference only causes a redundant update
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc)
+    return timestamp.isoformat()
+
+
+def _parse_boolean(value):
+    if value.lower() in TRUE_VALUES:
+        return True
+    elif value.lower() in FALSE_VALUES:
+        return False
+    raise ValueError(f"'{value}' is not a boolean")
+
+
+# Parsers of TSV text into the values the catalog returns, by column type
+PARSERS = {
+    "int2": int,
+    "int4": int,
+    "int8": int,
+    "serial2": int,
+    "serial4": int,
+    "serial8": int,
+    "float4": float,
+    "float8": float,
+    "numeric": float,
+    "boolean": _parse_boolean,
+    "timestamptz": _parse_timestamp,
+    "timestamp": _parse_timestamp,
+    "date": lambda value: date.fromisoformat(value[:10]).isoformat()
+}
+
+
+def _normalize(value, typename="text"):
+    """Return a value in a canonical form for its column type, so that the typed value
+    read from the catalog and the text read from a TSV data file compare equal.
+    Values of json and array columns are parsed by the row conversion function.
+    Values which cannot be parsed are compared as given; a false difference
+    only causes a redundant update, and invalid values are rejected by the catalog.
+    """
+    if value is None:
+        return None
+    if typename.endswith("[]"):
+        if isinstance(value, list):
+            return [_normalize(item, typename[:-2]) for item in value]
+        return value
+    if typename in ("json", "jsonb"):
+        return json.dumps(value, sort_keys=True)
+    parser = PARSERS.get(typename)
+    if parser is None:
+        return value if isinstance(value, str) else json.dumps(value)
+    # Numbers from the catalog are parsed from their text,
+    # and empty values in other columns are null
+    if not isinstance(value, str):
+        if parser is _parse_boolean or isinstance(value, bool):
+            return value
+        value = str(value)
+    if value == "":
+        return None
+    try:
+        return parser(value)
+    except ValueError:
+        return value
+
+
+def _row_hash(row, columns, types):
+    return hashlib.blake2b(json.dumps([_normalize(row.get(column), typename)
+                                       for column, typename in zip(columns, types)])
+                           .encode(), digest_size=16).digest()
+
+
+def column_types(table, columns):
+    """Return the type names of columns of a table, "text" for columns not in the table."""
+    return [table.columns[column].type.typename if column in table.columns.elements
+            else "text" for column in columns]
+
+
+class PartialLoadError(Exception):
+    """A load which failed after some rows were written to the catalog.
+    Those rows are not removed.
+
+    Arguments:
+        message (str): The error message.
+        catalog_id (str): The ID of the catalog loaded into.
+        rows_written (int): The number of rows inserted, updated, or deleted before the error.
+    """
+
+    def __init__(self, message, catalog_id, rows_written):
+        super().__init__(message)
+        self.catalog_id = catalog_id
+        self.rows_written = rows_written
+
+
+def key_columns(table, columns):
+    """Return the columns of the first key of a table which is not the RID,
+    and which the data file has values for.
+
+    Arguments:
+        table (Table): The catalog model of the table.
+        columns (list of str): The columns of the data file.
+
+    Returns:
+        list of str: The key's columns.
+    """
+    for key in table.keys:
+        names = [column.name for column in key.unique_columns]
+        if names != ["RID"] and set(names) <= set(columns):
+            return names
+    raise ValueError(f"Table '{table.name}' has no key in its data file, "
+                     "which is needed to match rows to update")
+
+
+class EntityLoader(object):
+    """Load TSV data files into catalog tables, sending rows in batches over several
+    connections. Each batch is retried on transient errors; retries of inserts skip rows
+    which already exist, in case an earlier attempt succeeded without a response.
+    ERMrest inserts a batch in one transaction, so a retry must insert either every row
+    or none; a retry which skips only some rows found rows conflicting with the data,
+    and fails.
+
+    Arguments:
+        catalog (ErmrestCatalog): The catalog to load into.
+        batch_size (int): The maximum number of rows per request.
+        workers (int): The maximum number of concurrent requests per table.
+        retries (int): The number of times to retry a batch.
+        mode (str): One of INGEST_MODES. "insert" posts every row. "upsert" compares
+                rows to the rows in the catalog by key, inserts new rows, and updates
+                changed rows. "sync" also finds rows to delete. Default "insert".
+        fetch_page_size (int): The number of rows per request when reading
+                the rows in the catalog, for "upsert" and "sync". Default 10000.
+        progress (function): Called as progress(result) after each table is loaded,
+                with the table's load results. Default None.
+        resume (bool): True to continue an "insert" interrupted after loading some rows.
+                Tables with a key in their data file are loaded as in "upsert", so rows
+                already loaded are not inserted again. Tables without one are inserted
+                if they are still empty, and otherwise fail. Default False.
+    """
+
+    def __init__(self, catalog, batch_size, workers, retries, mode="insert",
+                 fetch_page_size=10000, progress=None, resume=False):
+        if mode not in INGEST_MODES:
+            raise ValueError(f"Ingest mode '{mode}' unknown")
+        self.catalog = catalog
+        self.batch_size = batch_size
+        self.workers = workers
+        self.retries = retries
+        self.mode = mode
+        self.fetch_page_size = fetch_page_size
+        self.progress = progress
+        self.resume = resume
+        # Rows committed by successful requests, which remain if a later request fails
+        self.rows_written = 0
+        # Tables may be loaded concurrently; progress is reported one table at a time
+        self._progress_lock = threading.Lock()
+        self._written_lock = threading.Lock()
+
+    def _send_batch(self, method, path, count, body=None):
+        for attempt in range(self.retries + 1):
+            try:
+                if method == "delete":
+                    self.catalog.delete(path)
+                elif method == "put":
+                    self.catalog.put(path, data=body, headers=JSON_HEADERS)
+                elif attempt == 0:
+                    self.catalog.post(path, data=body, headers=JSON_HEADERS)
+                else:
+                    inserted = len(self.catalog.post(path + "?onconflict=skip", data=body,
+                                                     headers=JSON_HEADERS).json())
+                    if 0 < inserted < count:
+                        raise ValueError(f"{count - inserted} of {count} rows posted to {path} "
+                                         "conflict with rows already in the catalog")
+                with self._written_lock:
+                    self.rows_written += count
+                return method, count
+            except Exception as e:
+                if attempt >= self.retries or not _is_transient(e):
+                    raise
+                logger.warning(f"Retrying {method} of {count} rows for {path}: {repr(e)}")
+                time.sleep(2 ** attempt)
+
+    def _send_all(self, batches, workers):
+        """Send (method, path, count, body) batches, reading the next batch
+        only when a worker is free. Returns the number of rows sent by method.
+        """
+        counts = {"post": 0, "put": 0, "delete": 0}
+        in_flight = set()
+
+        def collect(futures):
+            for future in futures:
+                method, count = future.result()
+                counts[method] += count
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                for batch in batches:
+                    if len(in_flight) >= workers:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    in_flight.add(pool.submit(self._send_batch, *batch))
+                done, in_flight = wait(in_flight)
+                collect(done)
+            except BaseException:
+                for future in in_flight:
+                    future.cancel()
+                raise
+        return counts
+
+    def fetch_row_hashes(self, schema_name, table, keys, columns):
+        """Read the rows of a table, a page at a time, as hashes of their values.
+        Only the hashes are kept, but every row of the table is held in memory until the
+        table is loaded: roughly 300-500 bytes per row with short keys, about 4 GB
+        for 10 million rows. LOAD_TABLE_WORKERS tables may be held at once.
+
+        Arguments:
+            schema_name (str): The name of the table's schema.
+            table (Table): The catalog model of the table.
+            keys (list of str): The columns identifying a row.
+            columns (list of str): The other columns to compare.
+
+        Returns:
+            dict: The (RID, hash) of each row, by the normalized values of its key columns.
+        """
+        projection = ",".join(urlquote(column) for column in ["RID"] + keys + columns)
+        path = "/attribute/{}:{}/{}@sort(RID)".format(urlquote(schema_name),
+                                                      urlquote(table.name), projection)
+        key_types = column_types(table, keys)
+        types = column_types(table, columns)
+        rows = {}
+        after = ""
+        while True:
+            page_path = "{}{}?limit={}".format(path, after, self.fetch_page_size)
+            page = self.catalog.get(page_path).json()
+            for row in page:
+                row_key = tuple(_normalize(row[key], typename)
+                                for key, typename in zip(keys, key_types))
+                rows[row_key] = (row["RID"], _row_hash(row, columns, types))
+            if len(page) < self.fetch_page_size:
+                return rows
+            after = "@after({})".format(urlquote(page[-1]["RID"]))
+
+    def has_rows(self, schema_name, table):
+        """Return True if a table has any rows in the catalog."""
+        path = "/entity/{}:{}?limit=1".format(urlquote(schema_name), urlquote(table.name))
+        return len(self.catalog.get(path).json()) > 0
+
+    def _table_mode(self, schema_name, table, path):
+        """Return the mode to load a table in, which differs from the loader's mode
+        only when resuming an insert.
+        """
+        if not self.resume or self.mode != "insert":
+            return self.mode
+        try:
+            key_columns(table, read_header(path))
+        except ValueError:
+            if self.has_rows(schema_name, table):
+                raise ValueError(f"Unable to resume loading table '{table.name}': it has rows "
+                                 "from before the interruption, and no key in its data file "
+                                 "to match them, so they would be inserted again")
+            return "insert"
+        return "upsert"
+
+    def _diff_batches(self, entity_path, update_path, path, row2dict_factory, existing,
+                      table, keys, columns, batch_size, counts):
+        """Yield the requests to insert new rows and update changed rows, one batch of
+        the data file at a time. Rows found are removed from existing.
+        """
+        key_types = column_types(table, keys)
+        types = column_types(table, columns)
+        for batch in iter_row_batches(path, row2dict_factory, batch_size):
+            inserts = []
+            updates = []
+            for row in batch:
+                row_key = tuple(_normalize(row.get(key), typename)
+                                for key, typename in zip(keys, key_types))
+                current = existing.pop(row_key, None)
+                if current is None:
+                    inserts.append(row)
+                elif current[1] != _row_hash(row, columns, types):
+                    updates.append(row)
+                else:
+                    counts["unchanged"] += 1
+            if inserts:
+                yield "post", entity_path, len(inserts), json.dumps(inserts).encode()
+            if updates:
+                yield "put", update_path, len(updates), json.dumps(updates).encode()
+
+    def load_table(self, schema_name, table, path, row2dict_factory):
+        """Load a TSV data file into a table.
+        Tables with a foreign key to themselves are sent in a single request, so that
+        rows may reference rows anywhere in the file; the whole file is held in memory.
+        In "sync" mode, rows to delete are returned rather than deleted, because
+        rows referencing them in other tables must be deleted first.
+
+        Arguments:
+            schema_name (str): The name of the table's schema.
+            table (Table): The catalog model of the table.
+            path (str): The path to the TSV file.
+            row2dict_factory (function): Called with the header to get the row conversion
+                    function.
+
+        Returns:
+            dict: The load results: table (str), rows (int), inserted (int), updated (int),
+                unchanged (int), seconds (float), rows_per_second (int),
+                and stale_rids (list of str), the RIDs of rows to delete.
+        """
+        start = time.monotonic()
+        entity_path = "/entity/{}:{}".format(urlquote(schema_name), urlquote(table.name))
+        if is_self_referencing(table):
+            batch_size = None
+            workers = 1
+        else:
+            batch_size = self.batch_size
+            workers = self.workers
+        counts = {"unchanged": 0}
+        stale_rids = []
+        mode = self._table_mode(schema_name, table, path)
+        if mode == "insert":
+            sent = self._send_all((("post", entity_path, count, body) for count, body
+                                   in iter_batches(path, row2dict_factory, batch_size)),
+                                  workers)
+        else:
+            header = read_header(path)
+            keys = key_columns(table, header)
+            columns = [column for column in header
+                       if column not in keys and column not in SYSTEM_COLUMNS]
+            existing = self.fetch_row_hashes(schema_name, table, keys, columns)
+            update_path = "/attributegroup/{}:{}/{};{}".format(
+                                urlquote(schema_name), urlquote(table.name),
+                                ",".join(urlquote(key) for key in keys),
+                                ",".join(urlquote(column) for column in columns))
+            sent = self._send_all(self._diff_batches(entity_path, update_path, path,
+                                                     row2dict_factory, existing, table,
+                                                     keys, columns, batch_size, counts),
+                                  workers)
+            if mode == "sync":
+                stale_rids = [rid for rid, row_hash in existing.values()]
+        rows = sent["post"] + sent["put"] + counts["unchanged"]
+        seconds = time.monotonic() - start
+        result = {
+            "table": table.name,
+            "rows": rows,
+            "inserted": sent["post"],
+            "updated": sent["put"],
+            "unchanged": counts["unchanged"],
+            "seconds": seconds,
+            "rows_per_second": int(rows / seconds) if seconds > 0 else rows,
+            "stale_rids": stale_rids
+        }
+        logger.info(f"Loaded {rows} rows into {table.name} in {seconds:.1f}s "
+                    f"({result['rows_per_second']} rows/s): {sent['post']} inserted, "
+                    f"{sent['put']} updated, {counts['unchanged']} unchanged")
+        if self.progress is not None:
+            try:
+                with self._progress_lock:
+                    self.progress(result)
+            except Exception as e:
+                logger.warning(f"Unable to report load progress: {repr(e)}")
+        return result
+
+    def delete_rows(self, schema_name, table, rids):
+        """Delete rows from a table by RID.
+
+        Arguments:
+            schema_name (str): The name of the table's schema.
+            table (Table): The catalog model of the table.
+            rids (list of str): The RIDs of the rows to delete.
+
+        Returns:
+            int: The number of rows deleted.
+        """
+        entity_path = "/entity/{}:{}/".format(urlquote(schema_name), urlquote(table.name))
+        batches = []
+        for i in range(0, len(rids), DELETE_BATCH_SIZE):
+            batch = rids[i:i+DELETE_BATCH_SIZE]
+            rid_filter = ";".join("RID=" + urlquote(rid) for rid in batch)
+            batches.append(("delete", entity_path + rid_filter, len(batch)))
+        deleted = self._send_all(batches, self.workers)["delete"]
+        if deleted:
+            logger.info(f"Deleted {deleted} rows from {table.name}")
+        return deleted
+
+
+def dependency_levels(tables):
+    """Group tables by foreign key depth, so that each table only references
+    tables in earlier levels. Tables in the same level are independent of each other.
+    References to tables outside the group, and to the table itself, are ignored.
+
+    Arguments:
+        tables (list of Table): The tables, in foreign key dependency order.
+
+    Returns:
+        list of list of Table: The levels, in load order.
+    """
+    depths = {}
+    levels = []
+    for table in tables:
+        depth = 1 + max([depths[fkey.pk_table.name] for fkey in table.foreign_keys
+                         if fkey.pk_table.name != table.name
+                         and fkey.pk_table.name in depths], default=-1)
+        depths[table.name] = depth
+        if depth == len(levels):
+            levels.append([])
+        levels[depth].append(table)
+    return levels
+
+
+def load_datapackage(datapack, data_dir, mode="insert", progress=None, resume=False):
+    """Load the data files of a CfdeDataPackage into its catalog, in foreign key
+    dependency order. Replaces CfdeDataPackage.load_data_files(), which posts each
+    table in a single request.
+    Independent tables are loaded concurrently, up to LOAD_TABLE_WORKERS at a time.
+    A level of tables is only started once every table of the previous level is loaded.
+    In "sync" mode, rows no longer in the data are deleted once all tables are loaded,
+    from the most dependent tables to the least.
+    Rows are committed a batch at a time, so a failed load leaves the rows written
+    before the error in the catalog; PartialLoadError is raised if there are any.
+
+    Arguments:
+        datapack (CfdeDataPackage): The data package, set to its catalog.
+        data_dir (str): The directory the data package's resource paths are relative to.
+        mode (str): One of INGEST_MODES. Default "insert".
+        progress (function): Called as progress(result) after each table is loaded.
+                Default None.
+        resume (bool): True to continue an interrupted "insert", see EntityLoader.
+                Default False.
+
+    Returns:
+        list of dict: The load results of each table, with the number of rows deleted.
+    """
+    loader = EntityLoader(datapack.catalog, CONFIG["LOAD_BATCH_SIZE"], CONFIG["LOAD_WORKERS"],
+                          CONFIG["LOAD_RETRIES"], mode=mode,
+                          fetch_page_size=CONFIG["LOAD_FETCH_PAGE_SIZE"], progress=progress,
+                          resume=resume)
+    tables_doc = datapack.model_doc["schemas"]["CFDE"]["tables"]
+    paths = {}
+    tables = []
+    for tname in datapack.data_tnames_topo_sorted():
+        resource = tables_doc[tname]["annotations"].get(datapack.resource_tag, {})
+        if "path" in resource:
+            paths[tname] = os.path.join(data_dir, resource["path"])
+            tables.append(datapack.cat_model_root.table("CFDE", tname))
+
+    def load(table):
+        return loader.load_table("CFDE", table, paths[table.name],
+                                 lambda header: datapack.make_row2dict(table, header))
+
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=CONFIG["LOAD_TABLE_WORKERS"]) as pool:
+            for level, level_tables in enumerate(dependency_levels(tables)):
+                logger.debug(f"Loading level {level}: {[table.name for table in level_tables]}")
+                futures = [pool.submit(load, table) for table in level_tables]
+                try:
+                    results.extend(future.result() for future in futures)
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        tables_by_name = {table.name: table for table in tables}
+        for result in reversed(results):
+            result["deleted"] = loader.delete_rows("CFDE", tables_by_name[result["table"]],
+                                                   result.pop("stale_rids"))
+    except Exception as e:
+        if not loader.rows_written:
+            raise
+        catalog_id = datapack.catalog.catalog_id
+        raise PartialLoadError(f"{str(e)} ({loader.rows_written} rows were written to catalog "
+                               f"{catalog_id} before the error, and remain in it)",
+                               catalog_id, loader.rows_written) from e
+    return results
@@ -0,0 +1,177 @@
+from copy import deepcopy
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from cfde_deriva.datapackage import CfdeDataPackage
+import requests
+
+from cfde_ap import CONFIG
+
+
+logger = logging.getLogger(__name__)
+
+# The metadata of the last known good model, kept in DERIVA_SCHEMA_CACHE_DIR
+META_FILE = "model.meta.json"
+# The parsed canonical model of this process, inherited by forked action processes.
+# Copies are handed out, because provisioning a catalog changes the package.
+LOADED_MODEL = {
+    "location": None,
+    "sha256": None,
+    "datapack": None,
+    "checked": None
+}
+LOADED_MODEL_LOCK = threading.Lock()
+# The process running the background refresher, see start_refresher()
+REFRESHER_PID = None
+
+
+def _reset_lock():
+    # A process forked while a refresh holds the lock must not inherit it held
+    global LOADED_MODEL_LOCK
+    LOADED_MODEL_LOCK = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_lock)
+
+
+def _read_meta():
+    try:
+        with open(os.path.join(CONFIG["DERIVA_SCHEMA_CACHE_DIR"], META_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_atomic(path, content):
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'wb') as out:
+        out.write(content)
+    os.replace(tmp_path, path)
+
+
+def _persist(content, meta):
+    """Save a new model, named by its checksum so that the model file
+    and metadata are always consistent, and remove older models.
+    """
+    cache_dir = CONFIG["DERIVA_SCHEMA_CACHE_DIR"]
+    model_name = "model-{}.json".format(meta["sha256"])
+    _write_atomic(os.path.join(cache_dir, model_name), content)
+    _write_atomic(os.path.join(cache_dir, META_FILE), json.dumps(meta).encode())
+    for name in os.listdir(cache_dir):
+        if name.startswith("model-") and name != model_name:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+
+
+def refresh_model():
+    """Fetch the canonical model from DERIVA_SCHEMA_LOCATION if it changed,
+    using a conditional request, and save it as the last known good model.
+    If the model cannot be fetched, the last known good model is used instead.
+
+    Returns:
+        dict: The metadata of the current model:
+            location (str): The location the model was fetched from.
+            etag (str): The model's ETag, or None.
+            last_modified (str): The model's Last-Modified date, or None.
+            sha256 (str): The model's checksum.
+            path (str): The path to the saved model.
+    """
+    location = CONFIG["DERIVA_SCHEMA_LOCATION"]
+    os.makedirs(CONFIG["DERIVA_SCHEMA_CACHE_DIR"], exist_ok=True)
+    meta = _read_meta()
+    have_copy = meta.get("location") == location and os.path.isfile(meta.get("path", ""))
+    headers = {}
+    if have_copy and meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    elif have_copy and meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        res = requests.get(location, headers=headers, timeout=CONFIG["DOWNLOAD_TIMEOUT"])
+        if res.status_code == 304 and have_copy:
+            logger.debug(f"Canonical model at '{location}' unchanged")
+            return meta
+        res.raise_for_status()
+        # Never replace a good model with an invalid one
+        json.loads(res.content)
+    except (requests.RequestException, ValueError) as e:
+        if not have_copy:
+            raise
+        logger.warning(f"Unable to refresh canonical model from '{location}', "
+                       f"using last known good model: {repr(e)}")
+        return meta
+    sha256 = hashlib.sha256(res.content).hexdigest()
+    meta = {
+        "location": location,
+        "etag": res.headers.get("ETag"),
+        "last_modified": res.headers.get("Last-Modified"),
+        "sha256": sha256,
+        "path": os.path.join(CONFIG["DERIVA_SCHEMA_CACHE_DIR"], f"model-{sha256}.json")
+    }
+    _persist(res.content, meta)
+    logger.info(f"Fetched canonical model from '{location}' ({sha256})")
+    return meta
+
+
+def _check_model(force=False):
+    """Check the canonical model for changes, if due or forced, parsing it again
+    only when it changed. Must hold LOADED_MODEL_LOCK.
+    """
+    if (not force and LOADED_MODEL["location"] == CONFIG["DERIVA_SCHEMA_LOCATION"]
+            and LOADED_MODEL["checked"] is not None
+            and time.monotonic() - LOADED_MODEL["checked"]
+            <= CONFIG["DERIVA_SCHEMA_REFRESH_INTERVAL"]):
+        return
+    meta = refresh_model()
+    if (meta["sha256"] != LOADED_MODEL["sha256"]
+            or meta["location"] != LOADED_MODEL["location"]):
+        LOADED_MODEL["datapack"] = CfdeDataPackage(meta["path"], verbose=False)
+        LOADED_MODEL["sha256"] = meta["sha256"]
+        LOADED_MODEL["location"] = meta["location"]
+    LOADED_MODEL["checked"] = time.monotonic()
+
+
+def get_canonical_datapackage():
+    """Return the canonical model as a CfdeDataPackage, for provisioning a new catalog.
+    The model is checked for changes at most every DERIVA_SCHEMA_REFRESH_INTERVAL
+    seconds, and only parsed again when it changed.
+
+    Returns:
+        CfdeDataPackage: A copy of the canonical model package, not yet set to a catalog.
+    """
+    with LOADED_MODEL_LOCK:
+        _check_model()
+        return deepcopy(LOADED_MODEL["datapack"])
+
+
+def start_refresher(interval):
+    """Check the canonical model for changes in the background, if not already running
+    in this process. Run in the API process, so that forked action processes inherit
+    a recently checked, parsed model and do not fetch or parse it themselves.
+
+    Arguments:
+        interval (int): The number of seconds between checks for model changes.
+            Should be less than DERIVA_SCHEMA_REFRESH_INTERVAL.
+    """
+    global REFRESHER_PID
+    with LOADED_MODEL_LOCK:
+        if REFRESHER_PID == os.getpid():
+            return
+        REFRESHER_PID = os.getpid()
+    threading.Thread(target=_refresh_loop, args=(interval,), name="model-refresher",
+                     daemon=True).start()
+
+
+def _refresh_loop(interval):
+    while True:
+        try:
+            with LOADED_MODEL_LOCK:
+                _check_model(force=True)
+        except Exception as e:
+            logger.error(f"Unable to refresh canonical model: {repr(e)}")
+        time.sleep(interval)
@@ -0,0 +1,380 @@
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sqlite3
+import threading
+
+from . import error as err
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for finished action processes
+POLL_INTERVAL = 1
+
+
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+
+
+def _process_start(pid):
+    """Return an identifier of when a process started, which differs between processes
+    that reuse the same ID: the boot ID and the process start time.
+
+    Returns:
+        str: The start identifier, or None if the process does not exist,
+                or the system does not provide start times.
+    """
+    try:
+        with open(BOOT_ID_PATH) as f:
+            boot_id = f.read().strip()
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name may contain spaces, the start time is field 22
+    return boot_id + ":" + stat.rsplit(")", 1)[1].split()[19]
+
+
+def _pid_alive(pid, start=None):
+    """Return True if the process with the given ID, and start identifier, exists.
+    The ID of this process is never considered alive: an earlier process
+    with the same ID (e.g. before a container restart) has exited.
+
+    Arguments:
+        pid (int): The process ID.
+        start (str): The start identifier recorded with the ID, from _process_start().
+                Default None, to only check that some process has the ID.
+    """
+    if not pid or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    if start is not None:
+        current = _process_start(pid)
+        # The ID was reused by a new process
+        if current is not None and current != start:
+            return False
+    return True
+
+
+class JobLog(object):
+    """Durable record, in a local SQLite database, of the jobs queued and running on a node,
+    and of the last checkpoint each job reached.
+    Shared by the API processes and action processes on the node.
+
+    Arguments:
+        db_path (str): The path to the database file.
+        node_id (str): The name of this node. Only this node's jobs are recovered.
+    """
+
+    def __init__(self, db_path, node_id):
+        self.db_path = db_path
+        self.node_id = node_id
+        self._local = threading.local()
+
+    def _connect(self):
+        """Return a connection for this thread.
+        Connections are not shared between threads or across a fork.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs (action_id TEXT PRIMARY KEY, "
+                         "node_id TEXT, operation TEXT, args TEXT, priority INTEGER, "
+                         "state TEXT, owner_pid INTEGER, worker_pid INTEGER, "
+                         "attempts INTEGER, stage TEXT, checkpoint TEXT, "
+                         "owner_start TEXT, worker_start TEXT)")
+            # Added to job logs created by earlier versions
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            for column in ["owner_start", "worker_start"]:
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def add(self, action_id, operation, args, priority):
+        """Record a newly queued job, owned by this process."""
+        self._connect().execute("INSERT OR REPLACE INTO jobs (action_id, node_id, operation, "
+                                "args, priority, state, owner_pid, owner_start, attempts) "
+                                "VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, 1)",
+                                (action_id, self.node_id, operation, json.dumps(args),
+                                 priority, os.getpid(), _process_start(os.getpid())))
+
+    def start(self, action_id, worker_pid):
+        """Record that a job is running in the given process."""
+        self._connect().execute("UPDATE jobs SET state = 'running', worker_pid = ?, "
+                                "worker_start = ? WHERE action_id = ?",
+                                (worker_pid, _process_start(worker_pid), action_id))
+
+    def finish(self, action_id):
+        """Remove a job that is no longer running."""
+        self._connect().execute("DELETE FROM jobs WHERE action_id = ?", (action_id,))
+
+    def checkpoint(self, action_id, stage, **data):
+        """Record that a job completed a stage, with any data needed to resume after it.
+
+        Arguments:
+            action_id (str): The ID of the action.
+            stage (str): The name of the completed stage.
+            **data: JSON-serializable values needed to resume from this stage.
+        """
+        self._connect().execute("UPDATE jobs SET stage = ?, checkpoint = ? WHERE action_id = ?",
+                                (stage, json.dumps(data), action_id))
+        logger.debug(f"{action_id}: Checkpoint '{stage}' reached")
+
+    def get_checkpoint(self, action_id):
+        """Return the last checkpoint of a job.
+
+        Returns:
+            tuple: The stage name (or None if no checkpoint) and data dict.
+        """
+        row = self._connect().execute("SELECT stage, checkpoint FROM jobs WHERE action_id = ?",
+                                      (action_id,)).fetchone()
+        if row is None or row[0] is None:
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    def action_ids(self):
+        """Return the IDs of all jobs recorded for this node."""
+        rows = self._connect().execute("SELECT action_id FROM jobs WHERE node_id = ?",
+                                       (self.node_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def claim_orphans(self):
+        """Take ownership of this node's jobs whose owning process has exited,
+        and which are not still running in a surviving action process.
+        Processes are identified by their ID and start time, so a new process
+        reusing the ID of an exited one (e.g. after a restart) does not keep its jobs.
+        Each claimed job's attempt count is incremented.
+
+        Returns:
+            list of dict: The claimed jobs.
+        """
+        conn = self._connect()
+        claimed = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute("SELECT action_id, operation, args, priority, owner_pid, "
+                                "owner_start, worker_pid, worker_start, attempts FROM jobs "
+                                "WHERE node_id = ?", (self.node_id,)).fetchall()
+            for (action_id, operation, args, priority, owner_pid, owner_start,
+                 worker_pid, worker_start, attempts) in rows:
+                if _pid_alive(owner_pid, owner_start) or _pid_alive(worker_pid, worker_start):
+                    continue
+                conn.execute("UPDATE jobs SET state = 'queued', owner_pid = ?, owner_start = ?, "
+                             "worker_pid = NULL, worker_start = NULL, attempts = ? "
+                             "WHERE action_id = ?",
+                             (os.getpid(), _process_start(os.getpid()), attempts + 1, action_id))
+                claimed.append({
+                    "action_id": action_id,
+                    "operation": operation,
+                    "args": json.loads(args),
+                    "priority": priority,
+                    "attempts": attempts + 1
+                })
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return claimed
+
+
+def _run_job(job_log, action_id, target, args):
+    """Run an action in its process, removing it from the job log when it returns."""
+    try:
+        target(*args)
+    finally:
+        if job_log is not None:
+            job_log.finish(action_id)
+
+
+class JobScheduler(object):
+    """Run actions in a bounded number of processes, queueing the rest.
+    Queued jobs are started lowest priority value first, then in submission order.
+    Finished processes are joined, so none are left as zombies.
+    With a JobLog, queued and running jobs are recorded durably so that recover()
+    can restart them after this process exits.
+
+    Arguments:
+        targets (dict): The action function to run for each operation name.
+        max_workers (int): The maximum number of action processes running at once.
+        max_queued (int): The maximum number of jobs waiting for a worker.
+                Further submissions are rejected until the queue drains.
+        job_log (JobLog): The durable record of jobs. Default None, to not record jobs.
+        on_start (function): Called as on_start(action_id) before starting each job.
+                Default None.
+        on_error (function): Called as on_error(action_id, exception) if a job's
+                process cannot be started or exits abnormally. Default None.
+    """
+
+    def __init__(self, targets, max_workers, max_queued, job_log=None,
+                 on_start=None, on_error=None):
+        self.targets = targets
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.job_log = job_log
+        self.on_start = on_start
+        self.on_error = on_error
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._running = {}
+        self._cond = threading.Condition()
+        self._dispatcher_pid = None
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.recovered = 0
+
+    def start(self):
+        """Start the dispatcher thread, if not already running in this process."""
+        with self._cond:
+            if self._dispatcher_pid == os.getpid():
+                return
+            self._dispatcher_pid = os.getpid()
+        threading.Thread(target=self._dispatch, name="job-dispatcher", daemon=True).start()
+
+    def recover(self, max_attempts):
+        """Re-queue jobs left behind by exited processes on this node.
+        Jobs which have already been attempted max_attempts times are failed instead.
+
+        Arguments:
+            max_attempts (int): The maximum number of times to start one job.
+        """
+        if self.job_log is None:
+            return
+        for job in self.job_log.claim_orphans():
+            if job["attempts"] > max_attempts or job["operation"] not in self.targets:
+                logger.error(f"{job['action_id']}: Not recovering interrupted action "
+                             f"after {job['attempts'] - 1} attempts")
+                self.job_log.finish(job["action_id"])
+                self._report_error(job["action_id"],
+                                   RuntimeError("Action was interrupted by service restarts"))
+                continue
+            logger.info(f"{job['action_id']}: Recovering interrupted action")
+            with self._cond:
+                self._queue.put((job["priority"], next(self._sequence), job["action_id"],
+                                 job["operation"], tuple(job["args"])))
+                self.recovered += 1
+                self._cond.notify()
+
+    def is_full(self):
+        """Return True if a newly submitted job would be rejected."""
+        with self._cond:
+            return self._waiting() >= self.max_queued
+
+    def _waiting(self):
+        """Return the number of jobs waiting for a worker. Must hold self._cond.
+        Jobs which will start immediately pass through the queue, but are not waiting.
+        """
+        return max(0, self._queue.qsize() + len(self._running) - self.max_workers)
+
+    def submit(self, action_id, operation, args, priority=0):
+        """Queue a job to run an action in a new process.
+
+        Arguments:
+            action_id (str): The ID of the action, also used as the process name.
+            operation (str): The operation, which selects the action function from targets.
+            args (tuple): The JSON-serializable arguments for the action function.
+            priority (int): The queue priority; lower values start first. Default 0.
+
+        Returns:
+            bool: True if the job will start immediately, False if it must wait.
+
+        Raises ServiceUnavailable if the queue is full.
+        """
+        with self._cond:
+            if self._waiting() >= self.max_queued:
+                self.rejected += 1
+                raise err.ServiceUnavailable("Too many actions are queued, please retry later")
+            if self.job_log is not None:
+                self.job_log.add(action_id, operation, args, priority)
+            immediate = self._queue.qsize() + len(self._running) < self.max_workers
+            self._queue.put((priority, next(self._sequence), action_id, operation, args))
+            self.submitted += 1
+            self._cond.notify()
+        return immediate
+
+    def _report_error(self, action_id, error):
+        if self.on_error is not None:
+            try:
+                self.on_error(action_id, error)
+            except Exception as e:
+                logger.error(f"{action_id}: Error reporting action failure: {repr(e)}")
+
+    def _reap(self):
+        """Join finished processes. Must hold self._cond."""
+        for action_id, process in list(self._running.items()):
+            # Process is None while it is being started
+            if process is not None and not process.is_alive():
+                process.join()
+                del self._running[action_id]
+                self.completed += 1
+                logger.debug(f"{action_id}: Process exited with code {process.exitcode}")
+                # Actions report their own failures, unless the process was killed
+                if process.exitcode != 0:
+                    if self.job_log is not None:
+                        self.job_log.finish(action_id)
+                    self._report_error(action_id, RuntimeError(
+                        f"Action process exited with code {process.exitcode}"))
+
+    def _dispatch(self):
+        """Start queued jobs as workers become free."""
+        while True:
+            with self._cond:
+                self._reap()
+                if self._queue.empty() or len(self._running) >= self.max_workers:
+                    self._cond.wait(timeout=POLL_INTERVAL)
+                    continue
+                priority, seq, action_id, operation, args = self._queue.get()
+                self._running[action_id] = None
+            if self.on_start is not None:
+                try:
+                    self.on_start(action_id)
+                except Exception as e:
+                    logger.error(f"{action_id}: Error marking queued action started: {repr(e)}")
+            try:
+                process = multiprocessing.Process(
+                                target=_run_job,
+                                args=(self.job_log, action_id, self.targets[operation], args),
+                                name=action_id)
+                process.start()
+                if self.job_log is not None:
+                    self.job_log.start(action_id, process.pid)
+            except Exception as e:
+                logger.error(f"{action_id}: Unable to start action process: {repr(e)}")
+                with self._cond:
+                    self._running.pop(action_id, None)
+                if self.job_log is not None:
+                    self.job_log.finish(action_id)
+                self._report_error(action_id, e)
+                continue
+            with self._cond:
+                self._running[action_id] = process
+
+    def stats(self):
+        """Return the queue depth and worker utilization.
+
+        Returns:
+            dict: The scheduler statistics.
+        """
+        with self._cond:
+            return {
+                "queue_depth": self._waiting(),
+                "max_queued": self.max_queued,
+                "running": len(self._running),
+                "max_workers": self.max_workers,
+                "utilization": len(self._running) / self.max_workers,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "recovered": self.recovered
+            }
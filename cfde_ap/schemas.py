@@ -48,6 +48,19 @@ INPUT_SCHEMA = {
                             "catalog (e.g. 'prod'). To create a new catalog, do not specify "
                             "this value. If specified, the catalog must exist.")
         },
+        "ingest_mode": {
+            "type": "string",
+            "description": ("How to ingest TableSchema data into an existing catalog. "
+                            "'insert' adds every row, and fails if a row already exists. "
+                            "'upsert' adds new rows and updates changed rows, matching rows "
+                            "by key. 'sync' also deletes rows which are not in the data. "
+                            "'upsert' and 'sync' require a catalog_id. The default is 'insert'."),
+            "enum": [
+                "insert",
+                "upsert",
+                "sync"
+            ]
+        },
         "catalog_acls": {
             "type": "object",
             "description": ("The DERIVA permissions to apply to a new catalog. "
@@ -0,0 +1,172 @@
+import atexit
+from copy import deepcopy
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from cfde_ap import CONFIG
+from .cache import TTLCache
+from .status_store import json_default
+
+
+logger = logging.getLogger(__name__)
+
+# Statuses cached in the API process, keyed by (table_name, action_id), with the time
+# (time.monotonic()) each was last known to be current.
+# Action processes push their status changes to the API process over a Unix
+# datagram socket (see start_listener()), so cached statuses stay current;
+# the TTL bounds staleness if a push is lost.
+STATUS_CACHE = TTLCache(CONFIG["STATUS_CACHE_SIZE"], CONFIG["STATUS_CACHE_TTL"])
+# The time each action's current status was last seen, through a consistent read or a write.
+# Its age is checked against STATUS_MAX_STALENESS; the TTL only bounds how long it is kept.
+SEEN_AT = TTLCache(CONFIG["STATUS_CACHE_SIZE"], CONFIG["STATUS_MAX_STALENESS"])
+# Socket of the API process that owns STATUS_CACHE. Inherited by forked action processes.
+LISTENER_PATH = None
+LISTENER_PID = None
+# Datagrams larger than this are not sent; the receiver invalidates on TTL instead
+MAX_MESSAGE_SIZE = 64 * 1024
+
+
+def start_listener():
+    """Start receiving status pushes for this process's STATUS_CACHE.
+    Must be called in the API process, before any action processes are started.
+    """
+    global LISTENER_PATH, LISTENER_PID
+    if LISTENER_PID == os.getpid():
+        return
+    path = os.path.join(tempfile.gettempdir(), "cfde_ap_status-{}.sock".format(os.getpid()))
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    LISTENER_PATH = path
+    LISTENER_PID = os.getpid()
+    atexit.register(_remove_socket, path, LISTENER_PID)
+    threading.Thread(target=_listen, args=(sock,), name="status-cache-listener",
+                     daemon=True).start()
+    logger.debug("Status cache listening on {}".format(path))
+
+
+def _remove_socket(path, pid):
+    # atexit handlers are inherited by forked processes, only the owner removes the socket
+    if os.getpid() == pid:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _listen(sock):
+    """Apply status pushes received on sock to STATUS_CACHE."""
+    while True:
+        try:
+            message = json.loads(sock.recv(MAX_MESSAGE_SIZE))
+            key = (message["table_name"], message["action_id"])
+            if message["status"] is None:
+                STATUS_CACHE.invalidate(key)
+            else:
+                STATUS_CACHE.put(key, (message["status"], _mark_seen(key)))
+        except Exception as e:
+            logger.error("Invalid status cache message: {}".format(repr(e)))
+
+
+def _mark_seen(key):
+    now = time.monotonic()
+    SEEN_AT.put(key, now)
+    return now
+
+
+def _is_recent(seen_at):
+    return seen_at is not None and time.monotonic() - seen_at <= CONFIG["STATUS_MAX_STALENESS"]
+
+
+def get(table_name, action_id):
+    """Return the cached status for an action, or None if not cached,
+    or if it was last known to be current more than STATUS_MAX_STALENESS seconds ago.
+    """
+    entry = STATUS_CACHE.get((table_name, action_id))
+    if entry is None or not _is_recent(entry[1]):
+        return None
+    return deepcopy(entry[0])
+
+
+def put(table_name, action_id, status, fresh=False):
+    """Cache a status read for an action, in this process only.
+    A status read eventually consistently is only known to be as current as
+    the last status seen, and is cached with that time.
+
+    Arguments:
+        table_name (str): The name of the status table.
+        action_id (str): The ID for the action.
+        status (dict): The action status.
+        fresh (bool): True if the status was read consistently. Default False.
+    """
+    key = (table_name, action_id)
+    if fresh:
+        seen_at = _mark_seen(key)
+    else:
+        seen_at = SEEN_AT.get(key)
+        # Not known how stale the status may be
+        if seen_at is None:
+            return
+    STATUS_CACHE.put(key, (deepcopy(status), seen_at))
+
+
+def mark_fresh(table_name, action_id):
+    """Record that the current status of an action was just seen."""
+    _mark_seen((table_name, action_id))
+
+
+def is_fresh(table_name, action_id):
+    """Return True if the current status of an action was seen
+    within the last STATUS_MAX_STALENESS seconds.
+    """
+    return _is_recent(SEEN_AT.get((table_name, action_id)))
+
+
+def publish(table_name, action_id, status):
+    """Record a new status for an action, in this process and in the API process.
+
+    Arguments:
+        table_name (str): The name of the status table.
+        action_id (str): The ID for the action.
+        status (dict): The new action status, or None if the status was deleted.
+    """
+    key = (table_name, action_id)
+    if status is None:
+        STATUS_CACHE.invalidate(key)
+        SEEN_AT.invalidate(key)
+    else:
+        put(table_name, action_id, status, fresh=True)
+    # Push to the API process if this is an action process
+    if LISTENER_PATH is None or LISTENER_PID == os.getpid():
+        return
+    message = json.dumps({
+        "table_name": table_name,
+        "action_id": action_id,
+        "status": status
+    }, default=json_default).encode()
+    if len(message) > MAX_MESSAGE_SIZE:
+        message = json.dumps({
+            "table_name": table_name,
+            "action_id": action_id,
+            "status": None
+        }).encode()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            # Never block the action on a busy API process
+            sock.setblocking(False)
+            sock.sendto(message, LISTENER_PATH)
+    except OSError as e:
+        logger.debug("{}: Unable to push status to API process: {}".format(action_id, repr(e)))
+
+
+def stats():
+    """Return the hit counts for STATUS_CACHE."""
+    return STATUS_CACHE.stats()
@@ -0,0 +1,1172 @@
+from collections import Counter
+from copy import deepcopy
+from decimal import Decimal
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import boto3
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+import bson  # For IDs
+
+from cfde_ap import CONFIG
+from . import error as err
+
+
+logger = logging.getLogger(__name__)
+
+# Global secondary index used to look up actions by request_id
+DMO_REQUEST_INDEX = {
+    "IndexName": "request_id-index",
+    "KeySchema": [{
+        "AttributeName": "request_id",
+        "KeyType": "HASH"
+    }],
+    # Only a fallback for actions created before request ID markers, which are
+    # read again by action_id, so status writes are not copied into the index
+    "Projection": {
+        "ProjectionType": "KEYS_ONLY"
+    },
+    "ProvisionedThroughput": {
+        "ReadCapacityUnits": 20,
+        "WriteCapacityUnits": 20
+    }
+}
+DMO_INDEX_POLL_INTERVAL = 20  # Seconds
+# Beyond this many principals, authorization is not checked in a ConditionExpression
+# (DynamoDB limits expressions to 300 operators)
+DMO_MAX_CONDITION_PRINCIPALS = 100
+DMO_DESERIALIZER = TypeDeserializer()
+DMO_SERIALIZER = TypeSerializer()
+# Each action's request_id is claimed by a marker item, keyed by this prefix and the
+# request_id, written in the same transaction as the action. Markers are not actions.
+DMO_REQUEST_MARKER_PREFIX = "request_id:"
+# Number of action_id collisions tolerated before giving up on creation
+MAX_ID_ATTEMPTS = 5
+# Action statuses which are complete, and may be released
+TERMINAL_STATUSES = ["SUCCEEDED", "FAILED"]
+DMO_SCHEMA = {
+    "AttributeDefinitions": [{
+        "AttributeName": "action_id",
+        "AttributeType": "S"
+    }, {
+        "AttributeName": "request_id",
+        "AttributeType": "S"
+    }],
+    "KeySchema": [{
+        "AttributeName": "action_id",
+        "KeyType": "HASH"
+    }],
+    "GlobalSecondaryIndexes": [
+        DMO_REQUEST_INDEX
+    ],
+    "ProvisionedThroughput": {
+        "ReadCapacityUnits": 20,
+        "WriteCapacityUnits": 20
+    }
+}
+
+# DynamoDB client, created on first use so other backends do not need AWS credentials
+DMO_CLIENT = None
+# Per-process cache of active Table handles, so that status operations do not
+# each make a DescribeTable call. Cached handles are re-checked periodically
+# by a background thread (see _dmo_health_check()).
+DMO_TABLE_CACHE = {}
+DMO_TABLE_CACHE_LOCK = threading.Lock()
+DMO_HEALTH_CHECK_PID = None
+# Counts of DynamoDB calls made by this process, by operation
+DMO_STATS = Counter()
+
+# The configured StatusStore, created on first use by get_status_store()
+STATUS_STORE = None
+STATUS_STORE_LOCK = threading.Lock()
+
+
+#######################################
+# Store selection
+#######################################
+
+def get_status_store():
+    """Return the StatusStore for the STATUS_BACKEND set in the config.
+
+    Returns:
+        StatusStore: The configured status store.
+    """
+    global STATUS_STORE
+    with STATUS_STORE_LOCK:
+        if STATUS_STORE is None:
+            backend = CONFIG["STATUS_BACKEND"]
+            if backend not in STATUS_BACKENDS:
+                raise ValueError("Unknown STATUS_BACKEND '{}', must be one of {}"
+                                 .format(backend, list(STATUS_BACKENDS.keys())))
+            STATUS_STORE = STATUS_BACKENDS[backend]()
+        return STATUS_STORE
+
+
+def generate_action_id():
+    """Generate a new action_id.
+    Uniqueness is not checked here; StatusStore.create() writes the ID
+    conditionally and retries with a new ID on collision.
+
+    Returns:
+        str: The action_id.
+    """
+    # TODO: Different ID generation logic?
+    return str(bson.ObjectId())
+
+
+def merge_status(status, updates):
+    """Merge updates into an action status, as done by StatusStore.update().
+    Top-level values are replaced, except dicts, whose values are merged
+    into the existing dict (so {"details": {"message": "x"}} changes only
+    details.message). Deeper values are replaced as a whole.
+
+    Arguments:
+        status (dict): The status to update. Modified in place.
+        updates (dict): The updates to apply.
+
+    Returns:
+        dict: The updated status.
+    """
+    for key, value in updates.items():
+        if key == "action_id":
+            continue
+        if isinstance(value, dict) and value and isinstance(status.get(key), dict):
+            status[key].update(deepcopy(value))
+        else:
+            status[key] = deepcopy(value)
+    return status
+
+
+def check_release(action_id, status, principals=None):
+    """Check that an action status may be released, as done by StatusStore.delete().
+
+    Arguments:
+        action_id (str): The ID for the action.
+        status (dict): The current action status.
+        principals (list of str): The principals of the requester.
+                Default None, to skip the authorization check.
+
+    Raises exception if the action cannot be released.
+    """
+    if principals is not None and not set(principals).intersection(status.get("manage_by", [])):
+        raise err.NotAuthorized("You cannot release action {}".format(action_id))
+    if status.get("status") not in TERMINAL_STATUSES:
+        raise err.InvalidState("Action {} not completed and cannot be released"
+                               .format(action_id))
+
+
+class StatusStore(object):
+    """Persistence for action statuses.
+    Every method takes the name of the table (or equivalent) to use,
+    and raises an ApiError on any failure.
+    """
+
+    def create(self, table_name, action_status):
+        """Create action entry in status database.
+        Only one action may be created for each request_id.
+
+        Arguments:
+            table_name (str): The name of the table.
+            action_status (dict): The initial status for the action.
+
+        Returns:
+            dict: The action status created (including action_id).
+
+        Raises DuplicateRequest if an action exists with the same request_id.
+        """
+        raise NotImplementedError
+
+    def read(self, table_name, action_id, consistent=True):
+        """Fetch an action entry from status database.
+
+        Arguments:
+            table_name (str): The name of the table to read from.
+            action_id (str): The ID for the action.
+            consistent (bool): When False, the store may return a slightly stale status
+                    in exchange for a cheaper read. Default True.
+
+        Returns:
+            dict: The requested action status.
+        """
+        raise NotImplementedError
+
+    def read_by_request(self, table_name, request_id, consistent=True):
+        """Fetch an action entry given its request_id instead of action_id.
+
+        Arguments:
+            table_name (str): The name of the table to read from.
+            request_id (str): The requested request_id.
+            consistent (bool): When False, the store may return a slightly stale status
+                    in exchange for a cheaper read. Default True.
+
+        Returns:
+            dict: The requested action status.
+        """
+        raise NotImplementedError
+
+    def update(self, table_name, action_id, updates, overwrite=False):
+        """Update action entry in status database.
+
+        Arguments:
+            table_name (str): The name of the table to update.
+            action_id (str): The ID for the action.
+            updates (dict): The updates to apply to the action status.
+            overwrite (bool): When False, will merge the updates into the existing status
+                    (see merge_status()). When True, will replace the existing status
+                    entirely with the updates. Default False.
+
+        Returns:
+            dict: The updated action status.
+        """
+        raise NotImplementedError
+
+    def delete(self, table_name, action_id, principals=None):
+        """Release a completed action entry from the database.
+
+        Arguments:
+            table_name (str): The name of the table to delete from.
+            action_id (str): The ID for the action.
+            principals (list of str): The principals of the requester, at least one of which
+                    must be in the action's manage_by list.
+                    Default None, to skip the authorization check.
+
+        Returns:
+            dict: The deleted action status.
+        """
+        raise NotImplementedError
+
+    def list(self, table_name, status=None):
+        """List action entries in the database.
+
+        Arguments:
+            table_name (str): The name of the table to read from.
+            status (str): If set, only list actions currently in this status.
+                    Default None, to list all actions.
+
+        Returns:
+            list of dict: The action statuses.
+        """
+        raise NotImplementedError
+
+
+#######################################
+# DynamoDB
+#######################################
+
+def get_dmo_client():
+    """Return the DynamoDB client, creating it if necessary.
+
+    Returns:
+        dynamodb.ServiceResource: An authenticated client for DynamoDB.
+    """
+    global DMO_CLIENT
+    if DMO_CLIENT is None:
+        DMO_CLIENT = boto3.resource('dynamodb',
+                                    aws_access_key_id=CONFIG["AWS_KEY"],
+                                    aws_secret_access_key=CONFIG["AWS_SECRET"],
+                                    region_name="us-east-1")
+    return DMO_CLIENT
+
+
+def initialize_dmo_table(table_name, schema=DMO_SCHEMA, client=None):
+    """Init a table in DynamoDB, by default the DMO_TABLE with DMO_SCHEMA.
+    Currently not intended to be called in a script;
+    table creation is only necessary once per table.
+
+    Arguments:
+        table_name (str): The name for the DynamoDB table.
+        schema (dict): The schema for the DynamoDB table.
+                Default DMO_SCHEMA.
+        client (dynamodb.ServiceResource): An authenticated client for DynamoDB.
+                Default None, to use get_dmo_client().
+
+    Returns:
+        dynamodb.Table: The created DynamoDB table.
+
+    Raises exception on any failure.
+    """
+    client = client or get_dmo_client()
+    # Table should not be active already
+    try:
+        get_dmo_table(table_name, client)
+    except err.NotFound:
+        pass
+    else:
+        raise err.InvalidState("Table already created")
+
+    schema = deepcopy(schema)
+    schema["TableName"] = table_name
+
+    try:
+        count_dmo_call("create_table")
+        new_table = client.create_table(**schema)
+        new_table.wait_until_exists()
+    except client.meta.client.exceptions.ResourceInUseException:
+        raise err.InvalidState("Table concurrently created")
+    except Exception as e:
+        raise err.ServiceError(str(e))
+
+    # Check that table now exists
+    try:
+        table2 = get_dmo_table(table_name, client)
+    except err.NotFound:
+        raise err.InternalError("Unable to create table")
+
+    return table2
+
+
+def get_dmo_table(table_name, client=None):
+    """Return a DynamoDB table, by default the DMO_TABLE.
+    Active tables are cached per process, so only the first call for a table
+    checks the table status with DynamoDB.
+
+    Arguments:
+        table_name (str): The name of the DynamoDB table.
+        client (dynamodb.ServiceResource): An authenticated client for DynamoDB.
+                Default None, to use get_dmo_client().
+
+    Returns:
+        dynamodb.Table: The requested DynamoDB table.
+
+    Raises exception on any failure.
+    """
+    client = client or get_dmo_client()
+    cache_key = (table_name, id(client))
+    table = DMO_TABLE_CACHE.get(cache_key)
+    if table is not None:
+        count_dmo_call("table_cache_hit")
+        return table
+
+    try:
+        table = client.Table(table_name)
+        count_dmo_call("describe_table")
+        dmo_status = table.table_status
+        if dmo_status != "ACTIVE":
+            raise ValueError("Table not active")
+    except (ValueError, client.meta.client.exceptions.ResourceNotFoundException):
+        raise err.NotFound("Table does not exist or is not active")
+    except Exception as e:
+        raise err.ServiceError(str(e))
+
+    with DMO_TABLE_CACHE_LOCK:
+        DMO_TABLE_CACHE[cache_key] = table
+    _start_dmo_health_check()
+    return table
+
+
+def count_dmo_call(operation):
+    """Record a DynamoDB call in DMO_STATS.
+
+    Arguments:
+        operation (str): The name of the operation performed.
+    """
+    with DMO_TABLE_CACHE_LOCK:
+        DMO_STATS[operation] += 1
+
+
+def get_dmo_stats():
+    """Return the counts of DynamoDB calls made by this process.
+
+    Returns:
+        dict: The number of calls made, by operation.
+    """
+    with DMO_TABLE_CACHE_LOCK:
+        return dict(DMO_STATS)
+
+
+def _start_dmo_health_check():
+    """Start the table health check thread, if not already running in this process.
+    Threads do not survive a fork, so the check is keyed to the process ID.
+    """
+    global DMO_HEALTH_CHECK_PID
+    with DMO_TABLE_CACHE_LOCK:
+        if DMO_HEALTH_CHECK_PID == os.getpid():
+            return
+        DMO_HEALTH_CHECK_PID = os.getpid()
+    threading.Thread(target=_dmo_health_check, name="dmo-health-check", daemon=True).start()
+
+
+def _dmo_health_check():
+    """Periodically check that cached tables are still active,
+    evicting any that are not so that the next get_dmo_table() call re-checks them.
+    """
+    while True:
+        time.sleep(CONFIG["DYNAMO_HEALTH_CHECK_INTERVAL"])
+        with DMO_TABLE_CACHE_LOCK:
+            cached = list(DMO_TABLE_CACHE.items())
+        for cache_key, table in cached:
+            count_dmo_call("describe_table")
+            try:
+                table.reload()
+                healthy = table.table_status == "ACTIVE"
+            except Exception as e:
+                logger.error("Health check failed for table '{}': {}".format(cache_key[0], str(e)))
+                healthy = False
+            if not healthy:
+                count_dmo_call("health_check_eviction")
+                with DMO_TABLE_CACHE_LOCK:
+                    DMO_TABLE_CACHE.pop(cache_key, None)
+
+
+def add_request_index(table_name, client=None):
+    """Add the request_id global secondary index (DMO_REQUEST_INDEX) to an existing table.
+    DynamoDB backfills the index from the existing entries; this waits until
+    the backfill is complete and the index is usable.
+    Like initialize_dmo_table(), only necessary once per table.
+
+    Arguments:
+        table_name (str): The name of the DynamoDB table.
+        client (dynamodb.ServiceResource): An authenticated client for DynamoDB.
+                Default None, to use get_dmo_client().
+
+    Returns:
+        dynamodb.Table: The updated DynamoDB table.
+
+    Raises exception on any failure.
+    """
+    table = get_dmo_table(table_name, client)
+    index_name = DMO_REQUEST_INDEX["IndexName"]
+
+    existing = [index["IndexName"] for index in (table.global_secondary_indexes or [])]
+    if index_name not in existing:
+        count_dmo_call("update_table")
+        try:
+            table.update(
+                AttributeDefinitions=[{
+                    "AttributeName": "request_id",
+                    "AttributeType": "S"
+                }],
+                GlobalSecondaryIndexUpdates=[{
+                    "Create": deepcopy(DMO_REQUEST_INDEX)
+                }]
+            )
+        except Exception as e:
+            raise err.ServiceError(str(e))
+        logger.info("{}: Creating index '{}'".format(table_name, index_name))
+
+    # Wait for the index to finish backfilling
+    while True:
+        count_dmo_call("describe_table")
+        table.reload()
+        index_status = [index for index in (table.global_secondary_indexes or [])
+                        if index["IndexName"] == index_name]
+        if not index_status:
+            raise err.InternalError("Unable to create index '{}'".format(index_name))
+        elif (index_status[0]["IndexStatus"] == "ACTIVE"
+              and not index_status[0].get("Backfilling", False)):
+            break
+        time.sleep(DMO_INDEX_POLL_INTERVAL)
+
+    logger.info("{}: Index '{}' active".format(table_name, index_name))
+    return table
+
+
+def make_update_expression(updates):
+    """Translate a dict of updates into DynamoDB UpdateItem arguments,
+    with the same semantics as merge_status().
+    Nested dicts are SET inside the existing map, which must already exist
+    (see make_create_maps_expression()).
+
+    Arguments:
+        updates (dict): The updates to apply.
+
+    Returns:
+        dict: The UpdateExpression, ExpressionAttributeNames,
+                and ExpressionAttributeValues arguments,
+                or None if there is nothing to update (e.g. only the action_id).
+    """
+    # Placeholders are prefixed "u" to avoid collisions with the "#n"/":v"
+    # placeholders boto3 generates for a ConditionExpression
+    names = {}
+    values = {}
+    set_clauses = []
+
+    def add_clause(path, value):
+        path_names = []
+        for key in path:
+            name = "#u{}".format(len(names))
+            names[name] = key
+            path_names.append(name)
+        value_name = ":u{}".format(len(values))
+        values[value_name] = value
+        set_clauses.append("{} = {}".format(".".join(path_names), value_name))
+
+    for key, value in updates.items():
+        if key == "action_id":
+            continue
+        if isinstance(value, dict) and value:
+            for sub_key, sub_value in value.items():
+                add_clause((key, sub_key), sub_value)
+        else:
+            add_clause((key,), value)
+
+    if not set_clauses:
+        return None
+    return {
+        "UpdateExpression": "SET " + ", ".join(set_clauses),
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": values
+    }
+
+
+def make_create_maps_expression(updates):
+    """Translate a dict of updates into DynamoDB UpdateItem arguments creating
+    the empty maps that the nested updates of make_update_expression() SET into,
+    where they do not exist yet.
+
+    Arguments:
+        updates (dict): The updates to apply.
+
+    Returns:
+        dict: The UpdateExpression, ExpressionAttributeNames,
+                and ExpressionAttributeValues arguments,
+                or None if there are no nested updates.
+    """
+    names = {}
+    set_clauses = []
+    for key, value in updates.items():
+        if key != "action_id" and isinstance(value, dict) and value:
+            name = "#u{}".format(len(names))
+            names[name] = key
+            set_clauses.append("{0} = if_not_exists({0}, :u0)".format(name))
+    if not set_clauses:
+        return None
+    return {
+        "UpdateExpression": "SET " + ", ".join(set_clauses),
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": {":u0": {}}
+    }
+
+
+class DynamoStatusStore(StatusStore):
+    """Action statuses stored in DynamoDB, one item per action."""
+
+    def create(self, table_name, action_status):
+        table = get_dmo_table(table_name)
+
+        # TODO: Add default status information
+        if not action_status.get("details"):
+            action_status["details"] = {
+                "message": "Action started"
+            }
+
+        # TODO: Validate entry
+        status_errors = []
+        if status_errors:
+            raise err.InvalidRequest(*status_errors)
+
+        # Push to Dynamo table, with a new action_id if the ID is already taken
+        for attempt in range(MAX_ID_ATTEMPTS):
+            action_id = generate_action_id()
+            action_status["action_id"] = action_id
+            try:
+                if action_status.get("request_id") is None:
+                    count_dmo_call("put_item")
+                    table.put_item(Item=action_status,
+                                   ConditionExpression=Attr("action_id").not_exists())
+                elif not self._create_with_request(table, table_name, action_status):
+                    logger.warning("Action ID collision on '{}', retrying".format(action_id))
+                    continue
+            except table.meta.client.exceptions.ConditionalCheckFailedException:
+                logger.warning("Action ID collision on '{}', retrying".format(action_id))
+                continue
+            except err.ApiError:
+                raise
+            except Exception as e:
+                logger.error("Error creating status for '{}': {}".format(action_id, str(e)))
+                raise err.ServiceError(str(e))
+            else:
+                break
+        else:
+            raise err.InternalError("Unable to generate a unique action ID")
+
+        logger.info("{}: Action status created".format(action_id))
+        return action_status
+
+    def _create_with_request(self, table, table_name, action_status):
+        """Write an action and the marker claiming its request_id in one transaction,
+        each conditional on its key not existing. A marker left by a released action
+        is removed, and the transaction retried.
+
+        Returns:
+            bool: True if created, False if the action_id is already taken.
+
+        Raises DuplicateRequest if an action exists with the same request_id.
+        """
+        client = table.meta.client
+        marker_id = DMO_REQUEST_MARKER_PREFIX + action_status["request_id"]
+        marker = {
+            "action_id": marker_id,
+            "request_action_id": action_status["action_id"]
+        }
+        items = [{
+            "Put": {
+                "TableName": table_name,
+                "Item": {key: DMO_SERIALIZER.serialize(value)
+                         for key, value in item.items()},
+                "ConditionExpression": "attribute_not_exists(action_id)",
+                "ReturnValuesOnConditionCheckFailure": "ALL_OLD"
+            }
+        } for item in (action_status, marker)]
+        while True:
+            count_dmo_call("transact_write_items")
+            try:
+                client.transact_write_items(TransactItems=items)
+                return True
+            except client.exceptions.TransactionCanceledException as e:
+                reasons = e.response.get("CancellationReasons", [])
+                codes = [reason.get("Code") for reason in reasons]
+                if codes[1:] != ["ConditionalCheckFailed"]:
+                    if codes[:1] == ["ConditionalCheckFailed"]:
+                        return False
+                    raise
+                existing_id = DMO_DESERIALIZER.deserialize(reasons[1]["Item"]["request_action_id"])
+            try:
+                self.read(table_name, existing_id)
+            except err.NotFound:
+                pass
+            else:
+                raise err.DuplicateRequest("An action already exists for request ID '{}'"
+                                           .format(action_status["request_id"]))
+            self._delete_request_marker(table, marker_id, existing_id)
+
+    def _delete_request_marker(self, table, marker_id, action_id):
+        """Remove the marker of a released action, if it still claims the request_id."""
+        count_dmo_call("delete_item")
+        try:
+            table.delete_item(Key={"action_id": marker_id},
+                              ConditionExpression=Attr("request_action_id").eq(action_id))
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    def read(self, table_name, action_id, consistent=True):
+        table = get_dmo_table(table_name)
+
+        # If not found, Dynamo will return empty, only raising error on service issue
+        count_dmo_call("get_item")
+        try:
+            entry = table.get_item(Key={"action_id": action_id},
+                                   ConsistentRead=consistent).get("Item")
+        except Exception as e:
+            logger.error("Error reading status for '{}': {}".format(action_id, str(e)))
+            raise err.ServiceError(str(e))
+
+        if not entry or "request_action_id" in entry:
+            raise err.NotFound("Action ID {} not found in status database".format(action_id))
+        return entry
+
+    def read_by_request(self, table_name, request_id, consistent=True):
+        """Fetch an action entry given its request_id instead of action_id.
+        The action is found by the marker item written with it, a read of the table
+        by key, which is strongly consistent when consistent.
+        Actions created before markers were written are found by querying the request_id
+        global secondary index (DMO_REQUEST_INDEX), which is only eventually consistent:
+        an action created moments ago may not be found. The index holds only keys,
+        so the action found is then read by action_id.
+        """
+        table = get_dmo_table(table_name)
+
+        count_dmo_call("get_item")
+        try:
+            marker = table.get_item(Key={"action_id": DMO_REQUEST_MARKER_PREFIX + request_id},
+                                    ConsistentRead=consistent).get("Item")
+        except Exception as e:
+            logger.error("Error reading request ID '{}': {}".format(request_id, str(e)))
+            raise err.ServiceError(str(e))
+        if marker:
+            try:
+                return self.read(table_name, marker["request_action_id"], consistent=consistent)
+            # Left by a released action
+            except err.NotFound:
+                raise err.NotFound("Request ID '{}' not found in status database"
+                                   .format(request_id))
+
+        query_args = {
+            "IndexName": DMO_REQUEST_INDEX["IndexName"],
+            "KeyConditionExpression": Key("request_id").eq(request_id)
+        }
+        # Make query call, paging through if the result set is too large
+        result_entries = []
+        while True:
+            count_dmo_call("query")
+            try:
+                query_res = table.query(**query_args)
+            except Exception as e:
+                logger.error("Error querying request ID '{}': {}".format(request_id, str(e)))
+                raise err.ServiceError(str(e))
+            # Add results to list
+            result_entries.extend(query_res["Items"])
+            # Check for completeness
+            # If LastEvaluatedKey exists, need to page through more results
+            if query_res.get("LastEvaluatedKey", None) is not None:
+                query_args["ExclusiveStartKey"] = query_res["LastEvaluatedKey"]
+            # Otherwise, all results retrieved
+            else:
+                break
+
+        # Should be exactly 0 or 1 result, 2+ should never happen
+        if len(result_entries) <= 0:
+            raise err.NotFound("Request ID '{}' not found in status database".format(request_id))
+        elif len(result_entries) == 1:
+            try:
+                return self.read(table_name, result_entries[0]["action_id"],
+                                 consistent=consistent)
+            # Released since the index was updated
+            except err.NotFound:
+                raise err.NotFound("Request ID '{}' not found in status database"
+                                   .format(request_id))
+        else:
+            logger.error("Multiple entries found for request ID '{}'!".format(request_id))
+            raise err.InternalError("Multiple entries found for request ID '{}'. "
+                                    "Please report this error.".format(request_id))
+
+    def update(self, table_name, action_id, updates, overwrite=False):
+        """Update action entry in status database.
+        Merging updates are made atomically with one UpdateItem call
+        (see make_update_expression()). If a map with nested updates does not exist,
+        it is first created empty, with a second call.
+        """
+        # TODO: Validate updates
+        update_errors = []
+        if update_errors:
+            raise err.InvalidRequest(*update_errors)
+
+        update_args = None if overwrite else make_update_expression(updates)
+        # Nothing to write
+        if update_args is None and not overwrite:
+            return self.read(table_name, action_id)
+
+        table = get_dmo_table(table_name)
+        # Entry must already exist, otherwise DynamoDB would create it
+        condition = Attr("action_id").exists()
+
+        # Replace entire entry (.put_item() overwrites)
+        if overwrite:
+            full_updates = dict(updates, action_id=action_id)
+            count_dmo_call("put_item")
+            try:
+                table.put_item(Item=full_updates, ConditionExpression=condition)
+            except table.meta.client.exceptions.ConditionalCheckFailedException:
+                raise err.NotFound("Action ID {} not found in status database".format(action_id))
+            except Exception as e:
+                logger.error("Error updating status for '{}': {}".format(action_id, str(e)))
+                raise err.ServiceError(str(e))
+        # Merge updates into existing entry in one atomic write
+        else:
+            create_maps_args = make_create_maps_expression(updates)
+            count_dmo_call("update_item")
+            try:
+                try:
+                    full_updates = table.update_item(Key={"action_id": action_id},
+                                                     ConditionExpression=condition,
+                                                     ReturnValues="ALL_NEW",
+                                                     **update_args)["Attributes"]
+                # A map with nested updates is missing, as merge_status() would create it
+                except table.meta.client.exceptions.ClientError as e:
+                    if (create_maps_args is None
+                            or e.response["Error"]["Code"] != "ValidationException"):
+                        raise
+                    count_dmo_call("update_item")
+                    table.update_item(Key={"action_id": action_id},
+                                      ConditionExpression=condition, **create_maps_args)
+                    count_dmo_call("update_item")
+                    full_updates = table.update_item(Key={"action_id": action_id},
+                                                     ConditionExpression=condition,
+                                                     ReturnValues="ALL_NEW",
+                                                     **update_args)["Attributes"]
+            except table.meta.client.exceptions.ConditionalCheckFailedException:
+                raise err.NotFound("Action ID {} not found in status database".format(action_id))
+            except Exception as e:
+                logger.error("Error updating status for '{}': {}".format(action_id, str(e)))
+                raise err.ServiceError(str(e))
+
+        logger.debug("{}: Action status updated: {}".format(action_id, updates))
+        return full_updates
+
+    def delete(self, table_name, action_id, principals=None):
+        """Release a completed action entry from the database.
+        The existence, state, and authorization checks are made atomically by DynamoDB
+        as part of a single conditional delete.
+        """
+        if principals is not None:
+            principals = list(principals)
+            if not principals:
+                raise err.NotAuthorized("You cannot release action {}".format(action_id))
+            # Too many principals for one expression, check authorization against a read
+            if len(principals) > DMO_MAX_CONDITION_PRINCIPALS:
+                status = self.read(table_name, action_id)
+                if not set(principals).intersection(status.get("manage_by", [])):
+                    raise err.NotAuthorized("You cannot release action {}".format(action_id))
+                principals = None
+
+        condition = Attr("action_id").exists() & Attr("status").is_in(TERMINAL_STATUSES)
+        if principals is not None:
+            auth_condition = Attr("manage_by").contains(principals[0])
+            for principal in principals[1:]:
+                auth_condition = auth_condition | Attr("manage_by").contains(principal)
+            condition = condition & auth_condition
+
+        table = get_dmo_table(table_name)
+
+        # Delete entry
+        count_dmo_call("delete_item")
+        try:
+            old_status = table.delete_item(
+                                Key={"action_id": action_id},
+                                ConditionExpression=condition,
+                                ReturnValues="ALL_OLD",
+                                ReturnValuesOnConditionCheckFailure="ALL_OLD")["Attributes"]
+        # Determine which condition failed from the entry returned with the error
+        except table.meta.client.exceptions.ConditionalCheckFailedException as e:
+            item = e.response.get("Item")
+            # Request ID markers share the table, but are not actions
+            if not item or "request_action_id" in item or "status" not in item:
+                raise err.NotFound("Action ID {} not found in status database".format(action_id))
+            status = {key: DMO_DESERIALIZER.deserialize(value)
+                      for key, value in e.response["Item"].items()}
+            check_release(action_id, status, principals)
+            # Condition failed but all checks pass, so the entry changed concurrently
+            raise err.InvalidState("Action {} changed during release".format(action_id))
+        except Exception as e:
+            logger.error("Error deleting status for '{}': {}".format(action_id, str(e)))
+            raise err.ServiceError(str(e))
+        # A marker left by a failure here is removed when its request_id is reused
+        if old_status.get("request_id") is not None:
+            try:
+                self._delete_request_marker(table,
+                                            DMO_REQUEST_MARKER_PREFIX + old_status["request_id"],
+                                            action_id)
+            except Exception as e:
+                logger.warning("Unable to delete request ID marker for '{}': {}"
+                               .format(action_id, str(e)))
+
+        logger.info("{}: Action status deleted".format(action_id))
+        return old_status
+
+    def list(self, table_name, status=None):
+        """List action entries in the database.
+        This requires scanning the DynamoDB table, and is not intended for request paths.
+        """
+        table = get_dmo_table(table_name)
+
+        # Request ID markers are not actions
+        scan_args = {
+            "ConsistentRead": True,
+            "FilterExpression": Attr("request_action_id").not_exists()
+        }
+        if status is not None:
+            scan_args["FilterExpression"] = (scan_args["FilterExpression"]
+                                             & Attr("status").eq(status))
+        # Make scan call, paging through if too many entries are scanned
+        result_entries = []
+        while True:
+            count_dmo_call("scan")
+            try:
+                scan_res = table.scan(**scan_args)
+            except Exception as e:
+                logger.error("Error scanning table '{}': {}".format(table_name, str(e)))
+                raise err.ServiceError(str(e))
+            result_entries.extend(scan_res["Items"])
+            if scan_res.get("LastEvaluatedKey", None) is not None:
+                scan_args["ExclusiveStartKey"] = scan_res["LastEvaluatedKey"]
+            else:
+                break
+        return result_entries
+
+
+#######################################
+# SQLite
+#######################################
+
+def json_default(value):
+    # Statuses read from DynamoDB may contain Decimals
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+class SQLiteStatusStore(StatusStore):
+    """Action statuses stored in a local SQLite database (STATUS_DB_PATH) in WAL mode,
+    shared by every process on this node. Each table_name is a table in the database.
+    """
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path or CONFIG["STATUS_DB_PATH"]
+        self._local = threading.local()
+        self._tables = set()
+        self._tables_lock = threading.Lock()
+
+    def _connect(self):
+        """Return a connection for this thread.
+        Connections are not shared between threads or across a fork.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _table(self, conn, table_name):
+        """Return the quoted SQL table name, creating the table if necessary."""
+        sql_name = '"{}"'.format(table_name.replace('"', '""'))
+        if table_name not in self._tables:
+            conn.execute("CREATE TABLE IF NOT EXISTS {} (action_id TEXT PRIMARY KEY, "
+                         "request_id TEXT, status TEXT, entry TEXT NOT NULL)".format(sql_name))
+            conn.execute('CREATE INDEX IF NOT EXISTS "{}" ON {} (request_id)'
+                         .format((table_name + "_request_id").replace('"', '""'), sql_name))
+            with self._tables_lock:
+                self._tables.add(table_name)
+        return sql_name
+
+    def _read_entry(self, conn, sql_name, action_id):
+        row = conn.execute("SELECT entry FROM {} WHERE action_id = ?".format(sql_name),
+                           (action_id,)).fetchone()
+        if row is None:
+            raise err.NotFound("Action ID {} not found in status database".format(action_id))
+        return json.loads(row[0])
+
+    def _write_entry(self, conn, sql_name, entry):
+        conn.execute("REPLACE INTO {} (action_id, request_id, status, entry) "
+                     "VALUES (?, ?, ?, ?)".format(sql_name),
+                     (entry["action_id"], entry.get("request_id"), entry.get("status"),
+                      json.dumps(entry, default=json_default)))
+
+    def _check_request(self, conn, sql_name, request_id):
+        if request_id is None:
+            return
+        row = conn.execute("SELECT action_id FROM {} WHERE request_id = ?".format(sql_name),
+                           (request_id,)).fetchone()
+        if row is not None:
+            raise err.DuplicateRequest("An action already exists for request ID '{}'"
+                                       .format(request_id))
+
+    def create(self, table_name, action_status):
+        if not action_status.get("details"):
+            action_status["details"] = {
+                "message": "Action started"
+            }
+        try:
+            conn = self._connect()
+            sql_name = self._table(conn, table_name)
+            # Write lock held from the request_id check through the insert
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._check_request(conn, sql_name, action_status.get("request_id"))
+                for attempt in range(MAX_ID_ATTEMPTS):
+                    action_status["action_id"] = generate_action_id()
+                    try:
+                        conn.execute("INSERT INTO {} (action_id, request_id, status, entry) "
+                                     "VALUES (?, ?, ?, ?)".format(sql_name),
+                                     (action_status["action_id"], action_status.get("request_id"),
+                                      action_status.get("status"),
+                                      json.dumps(action_status, default=json_default)))
+                    except sqlite3.IntegrityError:
+                        logger.warning("Action ID collision on '{}', retrying"
+                                       .format(action_status["action_id"]))
+                        continue
+                    else:
+                        break
+                else:
+                    raise err.InternalError("Unable to generate a unique action ID")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error("Error creating status: {}".format(str(e)))
+            raise err.ServiceError(str(e))
+
+        logger.info("{}: Action status created".format(action_status["action_id"]))
+        return action_status
+
+    def read(self, table_name, action_id, consistent=True):
+        # SQLite reads are always consistent
+        try:
+            conn = self._connect()
+            return self._read_entry(conn, self._table(conn, table_name), action_id)
+        except sqlite3.Error as e:
+            logger.error("Error reading status for '{}': {}".format(action_id, str(e)))
+            raise err.ServiceError(str(e))
+
+    def read_by_request(self, table_name, request_id, consistent=True):
+        try:
+            conn = self._connect()
+            sql_name = self._table(conn, table_name)
+            rows = conn.execute("SELECT entry FROM {} WHERE request_id = ?".format(sql_name),
+                                (request_id,)).fetchall()
+        except sqlite3.Error as e:
+            logger.error("Error querying request ID '{}': {}".format(request_id, str(e)))
+            raise err.ServiceError(str(e))
+
+        if len(rows) <= 0:
+            raise err.NotFound("Request ID '{}' not found in status database".format(request_id))
+        elif len(rows) == 1:
+            return json.loads(rows[0][0])
+        else:
+            logger.error("Multiple entries found for request ID '{}'!".format(request_id))
+            raise err.InternalError("Multiple entries found for request ID '{}'. "
+                                    "Please report this error.".format(request_id))
+
+    def update(self, table_name, action_id, updates, overwrite=False):
+        try:
+            conn = self._connect()
+            sql_name = self._table(conn, table_name)
+            # Write lock held from the read through the write
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                entry = self._read_entry(conn, sql_name, action_id)
+                if overwrite:
+                    entry = dict(deepcopy(updates), action_id=action_id)
+                else:
+                    entry = merge_status(entry, updates)
+                self._write_entry(conn, sql_name, entry)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error("Error updating status for '{}': {}".format(action_id, str(e)))
+            raise err.ServiceError(str(e))
+
+        logger.debug("{}: Action status updated: {}".format(action_id, updates))
+        return entry
+
+    def delete(self, table_name, action_id, principals=None):
+        try:
+            conn = self._connect()
+            sql_name = self._table(conn, table_name)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                entry = self._read_entry(conn, sql_name, action_id)
+                check_release(action_id, entry, principals)
+                conn.execute("DELETE FROM {} WHERE action_id = ?".format(sql_name), (action_id,))
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error("Error deleting status for '{}': {}".format(action_id, str(e)))
+            raise err.ServiceError(str(e))
+
+        logger.info("{}: Action status deleted".format(action_id))
+        return entry
+
+    def list(self, table_name, status=None):
+        try:
+            conn = self._connect()
+            sql_name = self._table(conn, table_name)
+            if status is None:
+                rows = conn.execute("SELECT entry FROM {}".format(sql_name)).fetchall()
+            else:
+                rows = conn.execute("SELECT entry FROM {} WHERE status = ?".format(sql_name),
+                                    (status,)).fetchall()
+        except sqlite3.Error as e:
+            logger.error("Error listing table '{}': {}".format(table_name, str(e)))
+            raise err.ServiceError(str(e))
+        return [json.loads(row[0]) for row in rows]
+
+
+#######################################
+# In-memory
+#######################################
+
+class MemoryStatusStore(StatusStore):
+    """Action statuses stored in a dict in this process.
+    Statuses are not shared with other processes (including forked action processes)
+    and are lost on exit, so this is only suitable for testing and benchmarking.
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _read_entry(self, table_name, action_id):
+        try:
+            return self._tables.setdefault(table_name, {})[action_id]
+        except KeyError:
+            raise err.NotFound("Action ID {} not found in status database".format(action_id))
+
+    def create(self, table_name, action_status):
+        if not action_status.get("details"):
+            action_status["details"] = {
+                "message": "Action started"
+            }
+        with self._lock:
+            table = self._tables.setdefault(table_name, {})
+            request_id = action_status.get("request_id")
+            if request_id is not None and any(entry.get("request_id") == request_id
+                                              for entry in table.values()):
+                raise err.DuplicateRequest("An action already exists for request ID '{}'"
+                                           .format(request_id))
+            for attempt in range(MAX_ID_ATTEMPTS):
+                action_id = generate_action_id()
+                if action_id not in table:
+                    break
+            else:
+                raise err.InternalError("Unable to generate a unique action ID")
+            action_status["action_id"] = action_id
+            table[action_id] = deepcopy(action_status)
+
+        logger.info("{}: Action status created".format(action_id))
+        return action_status
+
+    def read(self, table_name, action_id, consistent=True):
+        with self._lock:
+            return deepcopy(self._read_entry(table_name, action_id))
+
+    def read_by_request(self, table_name, request_id, consistent=True):
+        with self._lock:
+            entries = [entry for entry in self._tables.get(table_name, {}).values()
+                       if entry.get("request_id") == request_id]
+            entries = deepcopy(entries)
+
+        if len(entries) <= 0:
+            raise err.NotFound("Request ID '{}' not found in status database".format(request_id))
+        elif len(entries) == 1:
+            return entries[0]
+        else:
+            logger.error("Multiple entries found for request ID '{}'!".format(request_id))
+            raise err.InternalError("Multiple entries found for request ID '{}'. "
+                                    "Please report this error.".format(request_id))
+
+    def update(self, table_name, action_id, updates, overwrite=False):
+        with self._lock:
+            entry = self._read_entry(table_name, action_id)
+            if overwrite:
+                entry = dict(deepcopy(updates), action_id=action_id)
+                self._tables[table_name][action_id] = entry
+            else:
+                merge_status(entry, updates)
+            entry = deepcopy(entry)
+
+        logger.debug("{}: Action status updated: {}".format(action_id, updates))
+        return entry
+
+    def delete(self, table_name, action_id, principals=None):
+        with self._lock:
+            entry = self._read_entry(table_name, action_id)
+            check_release(action_id, entry, principals)
+            del self._tables[table_name][action_id]
+
+        logger.info("{}: Action status deleted".format(action_id))
+        return entry
+
+    def list(self, table_name, status=None):
+        with self._lock:
+            return [deepcopy(entry) for entry in self._tables.get(table_name, {}).values()
+                    if status is None or entry.get("status") == status]
+
+
+STATUS_BACKENDS = {
+    "dynamodb": DynamoStatusStore,
+    "sqlite": SQLiteStatusStore,
+    "memory": MemoryStatusStore
+}
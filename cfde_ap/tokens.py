@@ -0,0 +1,132 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+import globus_sdk
+
+from cfde_ap import CONFIG
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenManager(object):
+    """Access tokens obtained with a refresh token, cached until shortly before they expire.
+    The current token is kept in a file readable only by this user, so that
+    all processes on the node share one token instead of each refreshing it.
+    A background thread refreshes the token well before it expires,
+    so callers of get_token() only wait on Globus Auth if that thread fails.
+
+    Arguments:
+        refresh_token (str): The Globus refresh token.
+        client_id (str): The ID of the native app the refresh token was issued to.
+        token_path (str): The path to the shared token file.
+        min_lifetime (int): The number of seconds a token must have left to be used.
+        refresh_ahead (int): The number of seconds before expiry that the background
+                thread refreshes the token.
+    """
+
+    def __init__(self, refresh_token, client_id, token_path, min_lifetime, refresh_ahead):
+        self.refresh_token = refresh_token
+        self.client_id = client_id
+        self.token_path = token_path
+        self.lock_path = token_path + ".lock"
+        self.min_lifetime = min_lifetime
+        self.refresh_ahead = refresh_ahead
+        # The token and its expiry time, replaced together so readers need no lock
+        self._current = (None, 0)
+        self._lock = threading.Lock()
+        self._refresher_pid = None
+        self.refreshes = 0
+
+    def _remaining(self):
+        return self._current[1] - time.time()
+
+    def _read_file(self):
+        """Load the shared token into this process, if the file holds one."""
+        try:
+            with open(self.token_path) as f:
+                data = json.load(f)
+            self._current = (data["access_token"], data["expires_at"])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _write_file(self):
+        tmp_path = self.token_path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as out:
+            json.dump({
+                "access_token": self._current[0],
+                "expires_at": self._current[1]
+            }, out)
+        os.replace(tmp_path, self.token_path)
+
+    def _refresh(self, min_remaining):
+        """Make sure the token has more than min_remaining seconds left, refreshing it
+        unless another process or thread did so first.
+        """
+        if self._remaining() > min_remaining:
+            return
+        self._read_file()
+        if self._remaining() > min_remaining:
+            return
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Record locks are not inherited by action processes forked during a refresh
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            # The token may have been refreshed while waiting for the lock
+            self._read_file()
+            if self._remaining() > min_remaining:
+                return
+            auth_client = globus_sdk.NativeAppAuthClient(self.client_id)
+            res = auth_client.oauth2_refresh_token(self.refresh_token)
+            self._current = (res["access_token"], time.time() + res["expires_in"])
+            self._write_file()
+            self.refreshes += 1
+            logger.debug("Refreshed DERIVA access token, valid for "
+                         f"{int(res['expires_in'])} seconds")
+        finally:
+            os.close(fd)
+
+    def get_token(self):
+        """Return a current access token.
+
+        Returns:
+            str: An access token valid for more than min_lifetime seconds.
+        """
+        token, expires_at = self._current
+        if expires_at - time.time() > self.min_lifetime:
+            return token
+        with self._lock:
+            self._refresh(self.min_lifetime)
+            return self._current[0]
+
+    def start_refresher(self, interval):
+        """Start refreshing the token in the background, if not already running in this process.
+
+        Arguments:
+            interval (int): The number of seconds between checks of the token's expiry.
+        """
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+        threading.Thread(target=self._refresh_loop, args=(interval,), name="token-refresher",
+                         daemon=True).start()
+
+    def _refresh_loop(self, interval):
+        while True:
+            try:
+                with self._lock:
+                    self._refresh(self.refresh_ahead)
+            except Exception as e:
+                logger.error(f"Unable to refresh DERIVA access token: {repr(e)}")
+            time.sleep(interval)
+
+
+DERIVA_TOKENS = TokenManager(CONFIG["TEMP_REFRESH_TOKEN"], CONFIG["GLOBUS_NATIVE_APP"],
+                             CONFIG["DERIVA_TOKEN_PATH"], CONFIG["DERIVA_TOKEN_MIN_LIFETIME"],
+                             CONFIG["DERIVA_TOKEN_REFRESH_AHEAD"])
@@ -1,50 +1,28 @@
-from copy import deepcopy
 import logging
 import os
 import shutil
-import urllib
 
-from bdbag import bdbag_api
-import boto3
-from boto3.dynamodb.conditions import Attr
-import bson  # For IDs
 import globus_sdk
-import mdf_toolbox
-import requests
 
 from cfde_ap import CONFIG
-from . import error as err
+from . import bag_cache, bags, downloads, status_cache, tokens
+from .status_store import get_status_store, TERMINAL_STATUSES  # noqa: F401
 
 
 logger = logging.getLogger(__name__)
 
-DMO_CLIENT = boto3.resource('dynamodb',
-                            aws_access_key_id=CONFIG["AWS_KEY"],
-                            aws_secret_access_key=CONFIG["AWS_SECRET"],
-                            region_name="us-east-1")
-DMO_SCHEMA = {
-    "AttributeDefinitions": [{
-        "AttributeName": "action_id",
-        "AttributeType": "S"
-    }],
-    "KeySchema": [{
-        "AttributeName": "action_id",
-        "KeyType": "HASH"
-    }],
-    "ProvisionedThroughput": {
-        "ReadCapacityUnits": 20,
-        "WriteCapacityUnits": 20
-    }
-}
-
-
-def clean_environment():
-    # Delete data dir and remake
-    try:
-        shutil.rmtree(CONFIG["DATA_DIR"])
-    except FileNotFoundError:
-        pass
-    os.makedirs(CONFIG["DATA_DIR"])
+
+def clean_environment(keep=()):
+    # Delete data dir contents, except the data of actions in keep, and remake
+    os.makedirs(CONFIG["DATA_DIR"], exist_ok=True)
+    for entry in os.listdir(CONFIG["DATA_DIR"]):
+        if entry in keep:
+            continue
+        path = os.path.join(CONFIG["DATA_DIR"], entry)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
     # Clear old exceptional error log
     try:
         os.remove("ERROR.log")
@@ -52,290 +30,72 @@ def clean_environment():
         pass
 
 
-def initialize_dmo_table(table_name, schema=DMO_SCHEMA, client=DMO_CLIENT):
-    """Init a table in DynamoDB, by default the DMO_TABLE with DMO_SCHEMA.
-    Currently not intended to be called in a script;
-    table creation is only necessary once per table.
-
-    Arguments:
-        table_name (str): The name for the DynamoDB table.
-        schema (dict): The schema for the DynamoDB table.
-                Default DMO_SCHEMA.
-        client (dynamodb.ServiceResource): An authenticated client for DynamoDB.
-                Default DMO_CLIENT.
-
-    Returns:
-        dynamodb.Table: The created DynamoDB table.
-
-    Raises exception on any failure.
-    """
-    # Table should not be active already
-    try:
-        get_dmo_table(table_name, client)
-    except err.NotFound:
-        pass
-    else:
-        raise err.InvalidState("Table already created")
-
-    schema = deepcopy(DMO_SCHEMA)
-    schema["TableName"] = table_name
-
-    try:
-        new_table = client.create_table(**schema)
-        new_table.wait_until_exists()
-    except client.meta.client.exceptions.ResourceInUseException:
-        raise err.InvalidState("Table concurrently created")
-    except Exception as e:
-        raise err.ServiceError(str(e))
-
-    # Check that table now exists
-    try:
-        table2 = get_dmo_table(table_name, client)
-    except err.NotFound:
-        raise err.InternalError("Unable to create table")
-
-    return table2
-
-
-def get_dmo_table(table_name, client=DMO_CLIENT):
-    """Return a DynamoDB table, by default the DMO_TABLE.
-
-    Arguments:
-        table_name (str): The name of the DynamoDB table.
-        client (dynamodb.ServiceResource): An authenticated client for DynamoDB.
-                Default DMO_CLIENT.
-
-    Returns:
-        dynamodb.Table: The requested DynamoDB table.
-
-    Raises exception on any failure.
-    """
-    try:
-        table = client.Table(table_name)
-        dmo_status = table.table_status
-        if dmo_status != "ACTIVE":
-            raise ValueError("Table not active")
-    except (ValueError, client.meta.client.exceptions.ResourceNotFoundException):
-        raise err.NotFound("Table does not exist or is not active")
-    except Exception as e:
-        raise err.ServiceError(str(e))
-    else:
-        return table
-
-
-def generate_action_id(table_name):
-    """Generate a valid action_id, unique to the given table.
-
-    Arguments:
-        table_name (str): The name of the table to check uniqueness against.
-
-    Returns:
-        str: The action_id.
-    """
-    # TODO: Different ID generation logic?
-    action_id = str(bson.ObjectId())
-    while True:
-        try:
-            read_action_status(table_name, action_id)
-        except err.NotFound:
-            break
-        else:
-            action_id = str(bson.ObjectId())
-    return action_id
-
-
 def create_action_status(table_name, action_status):
-    """Create action entry in status database (DynamoDB).
-
-    Arguments:
-        table_name (str): The name of the DynamoDB table.
-        action_status (dict): The initial status for the action.
-
-    Returns:
-        dict: The action status created (including action_id).
-
-    Raises exception on any failure.
+    """Create action entry in status database.
+    See StatusStore.create().
     """
-    table = get_dmo_table(table_name)
-
-    # TODO: Add default status information
-    action_id = generate_action_id(table_name)
-    action_status["action_id"] = action_id
-    if not action_status.get("details"):
-        action_status["details"] = {
-            "message": "Action started"
-        }
-
-    # TODO: Validate entry
-    status_errors = []
-    if status_errors:
-        raise err.InvalidRequest(*status_errors)
-
-    # Push to Dynamo table
-    try:
-        table.put_item(Item=action_status, ConditionExpression=Attr("action_id").not_exists())
-    except Exception as e:
-        logger.error("Error creating status for '{}': {}".format(action_id, str(e)))
-        raise err.ServiceError(str(e))
-
-    logger.info("{}: Action status created".format(action_id))
-    return action_status
+    status = get_status_store().create(table_name, action_status)
+    status_cache.publish(table_name, status["action_id"], status)
+    return status
 
 
-def read_action_status(table_name, action_id):
+def read_action_status(table_name, action_id, cached=False, consistent=True):
     """Fetch an action entry from status database.
+    See StatusStore.read().
 
     Arguments:
-        table_name (str): The name of the table to read from.
-        action_id (dict): The ID for the action.
-
-    Returns:
-        dict: The requested action status.
-
-    Raises exception on any failure.
+        cached (bool): When True, return the status from the status cache if present,
+                and last known to be current within STATUS_MAX_STALENESS seconds.
+                Cached statuses are kept current by update_action_status(),
+                in any process. Default False.
+        consistent (bool): When False, use an eventually consistent read if the
+                action's status was seen within the last STATUS_MAX_STALENESS seconds,
+                bounding how stale the result can be. Default True.
     """
-    table = get_dmo_table(table_name)
-
-    # If not found, Dynamo will return empty, only raising error on service issue
-    try:
-        entry = table.get_item(Key={"action_id": action_id}, ConsistentRead=True).get("Item")
-    except Exception as e:
-        logger.error("Error reading status for '{}': {}".format(action_id, str(e)))
-        raise err.ServiceError(str(e))
-
-    if not entry:
-        raise err.NotFound("Action ID {} not found in status database".format(action_id))
-    return entry
-
-
-def read_action_by_request(table_name, request_id):
+    if cached:
+        status = status_cache.get(table_name, action_id)
+        if status is not None:
+            return status
+    if not consistent and not status_cache.is_fresh(table_name, action_id):
+        consistent = True
+    status = get_status_store().read(table_name, action_id, consistent=consistent)
+    if cached:
+        status_cache.put(table_name, action_id, status, fresh=consistent)
+    elif consistent:
+        status_cache.mark_fresh(table_name, action_id)
+    return status
+
+
+def read_action_by_request(table_name, request_id, consistent=True):
     """Fetch an action entry given its request_id instead of action_id.
-    This requires scanning the DynamoDB table.
-
-    Arguments:
-        table_name (str): The name of the table to read from.
-        request_id (str): The requested request_id.
-
-    Returns:
-        dict: The requested action status.
-
-    Raises exception on any failure.
+    See StatusStore.read_by_request().
     """
-    table = get_dmo_table(table_name)
-
-    scan_args = {
-        "ConsistentRead": True,
-        "FilterExpression": Attr("request_id").eq(request_id)
-    }
-    # Make scan call, paging through if too many entries are scanned
-    result_entries = []
-    while True:
-        scan_res = table.scan(**scan_args)
-        # Check for success
-        if scan_res["ResponseMetadata"]["HTTPStatusCode"] >= 300:
-            logger.error("Scan error: {}: {}"
-                         .format(scan_res["ResponseMetadata"]["HTTPStatusCode"],
-                                 scan_res["ResponseMetadata"]))
-            raise err.ServiceError(scan_res["ResponseMetadata"])
-        # Add results to list
-        result_entries.extend(scan_res["Items"])
-        # Check for completeness
-        # If LastEvaluatedKey exists, need to page through more results
-        if scan_res.get("LastEvaluatedKey", None) is not None:
-            scan_args["ExclusiveStartKey"] = scan_res["LastEvaluatedKey"]
-        # Otherwise, all results retrieved
-        else:
-            break
-
-    # Should be exactly 0 or 1 result, 2+ should never happen
-    if len(result_entries) <= 0:
-        raise err.NotFound("Request ID '{}' not found in status database".format(request_id))
-    elif len(result_entries) == 1:
-        return result_entries[0]
-    else:
-        logger.error("Multiple entries found for request ID '{}'!".format(request_id))
-        raise err.InternalError("Multiple entries found for request ID '{}'. "
-                                "Please report this error.".format(request_id))
+    return get_status_store().read_by_request(table_name, request_id, consistent=consistent)
 
 
 def update_action_status(table_name, action_id, updates, overwrite=False):
     """Update action entry in status database.
-
-    Arguments:
-        table_name (str): The name of the table to update.
-        action_id (dict): The ID for the action.
-        updates (dict): The updates to apply to the action status.
-        overwrite (bool): When False, will merge the updates into the existing status,
-                overwriting only existing values.
-                When True, will delete the existing status entirely and replace it
-                with the updates.
-                Default False.
-
-    Returns:
-        dict: The updated action status.
-
-    Raises exception on any failure.
+    See StatusStore.update().
     """
-    # Verify old status exists and save it
-    old_status = read_action_status(table_name, action_id)
-
-    # Merge updates into old_status if not overwriting
-    if not overwrite:
-        # dict_merge(base, addition) returns base keys unchanged, addition keys added
-        full_updates = mdf_toolbox.dict_merge(updates, old_status)
-    else:
-        full_updates = updates
-
-    # TODO: Validate updates
-    update_errors = []
-    if update_errors:
-        raise err.InvalidRequest(*update_errors)
-
-    # Update in DB (.put_item() overwrites)
-    table = get_dmo_table(table_name)
-    try:
-        table.put_item(Item=full_updates)
-    except Exception as e:
-        logger.error("Error updating status for '{}': {}".format(action_id, str(e)))
-        raise err.ServiceError(str(e))
-
-    logger.debug("{}: Action status updated: {}".format(action_id, updates))
-    return full_updates
-
-
-def delete_action_status(table_name, action_id):
-    """Release an action entry from the database.
+    status = get_status_store().update(table_name, action_id, updates, overwrite=overwrite)
+    status_cache.publish(table_name, action_id, status)
+    return status
 
-    Arguments:
-        table_name (str): The name of the table to delete from.
-        action_id (dict): The ID for the action.
 
-    Raises exception on any failure.
+def delete_action_status(table_name, action_id, principals=None):
+    """Release a completed action entry from the database.
+    See StatusStore.delete().
     """
-    # Check that entry exists currently
-    # Throws exceptions if it doesn't exist
-    read_action_status(table_name, action_id)
-
-    table = get_dmo_table(table_name)
+    status = get_status_store().delete(table_name, action_id, principals=principals)
+    status_cache.publish(table_name, action_id, None)
+    return status
 
-    # Delete entry
-    try:
-        table.delete_item(Key={"action_id": action_id})
-    except Exception as e:
-        logger.error("Error deleting status for '{}': {}".format(action_id, str(e)))
-        err.ServiceError(str(e))
-
-    # Verify deletion
-    try:
-        read_action_status(table_name, action_id)
-    except err.NotFound:
-        pass
-    else:
-        logger.error("{} error: Action status in database after deletion".format(action_id))
-        raise err.InternalError("Action status was not deleted.")
 
-    logger.info("{}: Action status deleted".format(action_id))
-    return
+def list_action_statuses(table_name, status=None):
+    """List action entries in the database.
+    See StatusStore.list().
+    """
+    return get_status_store().list(table_name, status=status)
 
 
 def translate_status(raw_status):
@@ -360,10 +120,8 @@ def get_deriva_token():
     #       Refresh token will expire in six months(?)
     #       Date last generated: 9-26-2019
 
-    return globus_sdk.RefreshTokenAuthorizer(
-                        refresh_token=CONFIG["TEMP_REFRESH_TOKEN"],
-                        auth_client=globus_sdk.NativeAppAuthClient(CONFIG["GLOBUS_NATIVE_APP"])
-           ).access_token
+    # Cached and refreshed by the token manager, shared by all processes on the node
+    return tokens.DERIVA_TOKENS.get_token()
 
 
 def _generate_new_deriva_token():
@@ -381,66 +139,36 @@ def _generate_new_deriva_token():
 def download_data(location, local_path):
     """Download data from a remote host to the configured machine.
     (Many sources to one destination)
+    Bags fetched before are served from the local bag cache.
 
     Arguments:
         location (str): The location of the data.
         local_path (str): The path to the local storage location.
 
     Returns:
-        dict: success (bool): True on success, False on failure.
+        str: The path to the extracted bag.
     """
-    filename = None
-    # If the local_path is a file and not a directory, use the directory
-    if ((os.path.exists(local_path) and not os.path.isdir(local_path))
-            or (not os.path.exists(local_path) and local_path[-1] != "/")):
-        # Save the filename for later
-        filename = os.path.basename(local_path)
+    if local_path[-1] != "/" and not os.path.isdir(local_path):
         local_path = os.path.dirname(local_path) + "/"
+    return bag_cache.get_bag(location, local_path, fetch_bag)
+
+
+def fetch_bag(location, local_path):
+    """Download, extract, and verify a BDBag, without using the bag cache.
+
+    Arguments:
+        location (str): The location of the data.
+        local_path (str): The path to the local storage location.
 
-    os.makedirs(local_path, exist_ok=True)
-
-    loc_info = urllib.parse.urlparse(location)
-    # HTTP(S)
-    if loc_info.scheme.startswith("http"):
-        # Get default filename and extension
-        http_filename = os.path.basename(loc_info.path)
-        if not http_filename:
-            http_filename = "archive"
-        ext = os.path.splitext(http_filename)[1]
-        if not ext:
-            ext = ".archive"
-
-        # Fetch file
-        with requests.get(location, stream=True) as res:
-            if res.status_code >= 300:
-                logger.error(f"Error {res.status_code} downloading file '{location}': "
-                             f"{res.content}")
-                raise IOError("File download failed: {}".format(res.content))
-            else:
-                logger.debug(f"Downloaded file {location} with status code {res.status_code}")
-            # Get filename from header if present
-            con_disp = res.headers.get("Content-Disposition", "")
-            filename_start = con_disp.find("filename=")
-            if filename_start >= 0:
-                filename_end = con_disp.find(";", filename_start)
-                if filename_end < 0:
-                    filename_end = None
-                http_filename = con_disp[filename_start+len("filename="):filename_end]
-                http_filename = http_filename.strip("\"'; ")
-
-            # Create path for file
-            archive_path = os.path.join(local_path, filename or http_filename)
-            # Download and save file
-            with open(archive_path, 'wb') as out:
-                shutil.copyfileobj(res.raw, out)
-            logger.debug("Saved HTTP file: {}".format(archive_path))
-
-        # Assume data is BDBag, extract
-        bag_path = bdbag_api.extract_bag(archive_path, local_path)
-    # Not supported
-    else:
-        # Nothing to do
-        raise IOError("Invalid data location: '{}' is not a recognized protocol "
-                      "(from {}).".format(loc_info.scheme, str(location)))
+    Returns:
+        str: The path to the extracted bag.
+    """
+    download = downloads.download_file(location, local_path)
+    archive_path = download["path"]
+    logger.debug("Saved HTTP file: {}".format(archive_path))
+    # Assume data is BDBag, extract and verify
+    prepared = bags.prepare_bag(archive_path, os.path.dirname(archive_path))
+    logger.info(f"Bag stages for '{location}': download {download['seconds']:.2f}s, "
+                f"prepare {prepared['seconds']:.2f}s")
     # Return path to bag
-    return bag_path
+    return prepared["bag_path"]
@@ -0,0 +1,54 @@
+import logging
+
+import jsonschema
+
+from . import error as err
+
+# fastjsonschema (in requirements.txt) generates Python code for a schema,
+# which validates several times faster than jsonschema.
+# If it is not installed, validation falls back to jsonschema.
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def compile_validator(schema, fast=True):
+    """Check a JSON Schema once, and return a function to validate documents against it.
+    Formats are not checked, as with jsonschema.validate().
+
+    Arguments:
+        schema (dict): The JSON Schema.
+        fast (bool): If True, use fastjsonschema, or jsonschema if fastjsonschema
+                is not installed. Default True.
+
+    Returns:
+        function: Called as validate(document); raises InvalidRequest with the first error.
+    """
+    if fast and fastjsonschema is not None:
+        fast_validate = fastjsonschema.compile(schema, use_formats=False)
+
+        def validate(document):
+            try:
+                fast_validate(document)
+            except fastjsonschema.JsonSchemaException as e:
+                raise err.InvalidRequest(e.message)
+        logger.debug("Compiled schema '{}' with fastjsonschema".format(schema.get("title")))
+        return validate
+
+    if fast:
+        logger.warning("fastjsonschema is not installed, validating with jsonschema")
+    validator_class = jsonschema.validators.validator_for(schema)
+    validator_class.check_schema(schema)
+    validator = validator_class(schema)
+
+    def validate(document):
+        error = jsonschema.exceptions.best_match(validator.iter_errors(document))
+        if error is not None:
+            # Raise just the first line of the exception text, which contains the error
+            # The entire body and schema are in the exception, which are too verbose
+            raise err.InvalidRequest(str(error).split("\n")[0])
+    return validate
@@ -0,0 +1,23 @@
+import os
+import tempfile
+
+from cfde_ap import CONFIG
+
+
+def pytest_configure(config):
+    # Keep state written by the service (and by tests) out of the home directory,
+    # and off remote services, before any module reads the config
+    test_dir = tempfile.mkdtemp(prefix="cfde_ap_test-")
+    CONFIG.update({
+        "API_LOG_FILE": os.path.join(test_dir, "api.log"),
+        "DATA_DIR": os.path.join(test_dir, "data"),
+        "STATUS_BACKEND": "memory",
+        "STATUS_DB_PATH": os.path.join(test_dir, "status.db"),
+        "JOB_DB_PATH": os.path.join(test_dir, "jobs.db"),
+        "BAG_CACHE_DIR": os.path.join(test_dir, "bag_cache"),
+        "DERIVA_TOKEN_PATH": os.path.join(test_dir, "deriva_token.json"),
+        "DERIVA_TOKEN_CHECK_INTERVAL": 24 * 60 * 60,
+        "DERIVA_SCHEMA_CACHE_DIR": os.path.join(test_dir, "model_cache"),
+        "DERIVA_SCHEMA_LOCATION": "file:///nonexistent/model.json",
+        "RESPONSE_VALIDATION": "off"
+    })
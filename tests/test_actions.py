@@ -0,0 +1,89 @@
+import logging
+
+import pytest
+
+from cfde_ap import actions
+
+
+class FakeRestore(object):
+    """Logs table and catalog results like DerivaRestore, through the root logger."""
+    results = []
+
+    def __init__(self, server_args, input_path, oauth2_token):
+        self.catalog_id = server_args["catalog_id"] or "7"
+
+    def restore(self):
+        success = True
+        for table_name, result, rows in self.results:
+            if result == "successful":
+                logging.info(f"Restoration of table data [{table_name}] successful. "
+                             f"{rows} rows restored.")
+            else:
+                # A failed table does not stop the restore
+                success = False
+                logging.warning(f"Restoration of table data [{table_name}] failed. "
+                                f"{rows} rows restored.")
+        logging.info("Restore of catalog https://example.org/ermrest/catalog/{} {}. "
+                     .format(self.catalog_id, "completed successfully" if success else "failed"))
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def restore(monkeypatch):
+    monkeypatch.setattr(actions, "DerivaRestore", FakeRestore)
+    monkeypatch.setattr(actions, "get_deriva_token", lambda: "token")
+    root_logger = logging.getLogger()
+    root_level = root_logger.level
+    root_logger.setLevel(logging.WARNING)
+    yield FakeRestore
+    root_logger.setLevel(root_level)
+
+
+def test_restore_progress_by_table(restore, monkeypatch):
+    monkeypatch.setattr(restore, "results", [("demo:Samples", "successful", 10),
+                                             ("demo:Files", "successful", 5)])
+    progress = []
+    result = actions.deriva_restore("example.org", "/data/bag", progress=progress.append)
+    assert (result["tables_restored"], result["rows_restored"]) == (2, 15)
+    assert [update.get("last_table", update.get("phase")) for update in progress] == [
+        "restoring", "demo:Samples", "demo:Files", "restored"]
+
+
+def test_restore_failed_table(restore, monkeypatch):
+    monkeypatch.setattr(restore, "results", [("demo:Samples", "successful", 10),
+                                             ("demo:Files", "failed", 3)])
+    with pytest.raises(actions.DerivaRestoreError, match="demo:Files"):
+        actions.deriva_restore("example.org", "/data/bag")
+
+
+def test_restore_failed_catalog(restore, monkeypatch):
+    monkeypatch.setattr(restore, "results", [])
+    monkeypatch.setattr(restore, "restore", lambda self: logging.info(
+        "Restore of catalog https://example.org/ermrest/catalog/7 failed. "))
+    with pytest.raises(actions.DerivaRestoreError, match="catalog"):
+        actions.deriva_restore("example.org", "/data/bag")
+
+
+def test_root_logging_unchanged(restore, monkeypatch):
+    monkeypatch.setattr(restore, "results", [("demo:Samples", "successful", 10),
+                                             ("demo:Files", "failed", 3)])
+    root_logger = logging.getLogger()
+    handler = RecordingHandler()
+    root_logger.addHandler(handler)
+    try:
+        with pytest.raises(actions.DerivaRestoreError):
+            actions.deriva_restore("example.org", "/data/bag")
+    finally:
+        root_logger.removeHandler(handler)
+    # Only the records at the configured level reached the configured handler
+    assert [record.levelno for record in handler.records] == [logging.WARNING]
+    assert root_logger.level == logging.WARNING
+    assert handler.filters == []
@@ -0,0 +1,112 @@
+import time
+from unittest import mock
+
+import pytest
+
+
+IDENTITY = "urn:globus:auth:identity:5a2b3b7e-0a7b-4b5e-9c59-3e0d8e9f0a11"
+
+
+class FakeAuthState(object):
+    def __init__(self, token):
+        self.token = token
+        self.identities = [IDENTITY] if token == "valid" else []
+        self.principals = self.identities
+        self.effective_identity = IDENTITY
+        self.errors = [] if self.identities else ["Token is not active"]
+
+    def introspect_token(self):
+        if not self.identities:
+            return None
+        return {"exp": time.time() + 3600}
+
+    def check_authorization(self, allowed_principals, allow_all_authenticated_users=False):
+        return bool(self.identities)
+
+
+class FakeTokenChecker(object):
+    def __init__(self, *args, **kwargs):
+        self.checked = []
+
+    def check_token(self, token):
+        self.checked.append(token)
+        return FakeAuthState(token)
+
+
+@pytest.fixture(scope="module")
+def api():
+    # The real TokenChecker contacts Globus Auth when created
+    with mock.patch("globus_action_provider_tools.authentication.TokenChecker",
+                    FakeTokenChecker):
+        from cfde_ap import api
+    return api
+
+
+@pytest.fixture
+def client(api):
+    api.AUTH_CACHE.clear()
+    api.TOKEN_CHECKER.checked.clear()
+    return api.app.test_client()
+
+
+def test_token_introspected_once(api, client):
+    for i in range(2):
+        res = client.get("/", headers={"Authorization": "Bearer valid"})
+        assert res.status_code == 200
+    assert api.TOKEN_CHECKER.checked == ["valid"]
+
+
+def test_invalid_token_rejected(api, client):
+    for i in range(2):
+        res = client.get("/", headers={"Authorization": "Bearer invalid"})
+        assert res.status_code == 401
+    assert api.TOKEN_CHECKER.checked == ["invalid"]
+
+
+def test_stats_require_authentication(client):
+    assert client.get("/stats").status_code == 401
+    res = client.get("/stats", headers={"Authorization": "Bearer valid"})
+    assert res.status_code == 200
+    assert "scheduler" in res.get_json()
+
+
+@pytest.mark.parametrize("immediate,status", [(True, "ACTIVE"), (False, "INACTIVE")])
+def test_run_status_from_scheduler(api, client, monkeypatch, immediate, status):
+    monkeypatch.setattr(api.SCHEDULER, "submit", mock.Mock(return_value=immediate))
+    res = client.post("/run", headers={"Authorization": "Bearer valid"}, json={
+        "request_id": f"request-{status}",
+        "body": {
+            "operation": "ingest",
+            "data_url": "https://example.org/bag.zip"
+        }
+    })
+    assert res.status_code == 202
+    assert res.get_json()["status"] == status
+    assert api.SCHEDULER.submit.call_count == 1
+
+
+def test_run_rejected_when_queue_full(api, client, monkeypatch):
+    monkeypatch.setattr(api.SCHEDULER, "submit", mock.Mock(
+        side_effect=api.err.ServiceUnavailable("Too many actions are queued")))
+    res = client.post("/run", headers={"Authorization": "Bearer valid"}, json={
+        "request_id": "request-full",
+        "body": {
+            "operation": "ingest",
+            "data_url": "https://example.org/bag.zip"
+        }
+    })
+    assert res.status_code == 503
+    # The rejected action is released, so a retry of the request is run
+    with pytest.raises(api.err.NotFound):
+        api.utils.read_action_by_request(api.TBL, "request-full")
+    api.SCHEDULER.submit.side_effect = None
+    api.SCHEDULER.submit.return_value = True
+    res = client.post("/run", headers={"Authorization": "Bearer valid"}, json={
+        "request_id": "request-full",
+        "body": {
+            "operation": "ingest",
+            "data_url": "https://example.org/bag.zip"
+        }
+    })
+    assert res.status_code == 202
+    assert res.json["status"] == "ACTIVE"
@@ -0,0 +1,98 @@
+import os
+import threading
+
+import pytest
+
+from cfde_ap import bag_cache, CONFIG
+
+
+LOCATION = "https://example.org/bag.zip"
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(CONFIG, "BAG_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setitem(CONFIG, "BAG_CACHE_MAX_SIZE", 1024 ** 3)
+    monkeypatch.setattr(bag_cache.downloads, "probe",
+                        lambda location: {"etag": '"v1"', "last_modified": None})
+    return tmp_path / "cache"
+
+
+class FakeFetch(object):
+    """Writes a partial archive, then fails until told to succeed."""
+    def __init__(self, fail=0):
+        self.fail = fail
+        self.calls = []
+
+    def __call__(self, location, directory):
+        archive = os.path.join(directory, "bag.zip")
+        self.calls.append((directory, os.path.exists(archive)))
+        with open(archive, "a") as out:
+            out.write("data")
+        bag_path = os.path.join(directory, "bag")
+        os.makedirs(bag_path)
+        if self.fail:
+            self.fail -= 1
+            raise OSError("Connection reset")
+        with open(os.path.join(bag_path, "file.txt"), "w") as out:
+            out.write("content")
+        return bag_path
+
+
+def test_hit_does_not_fetch(tmp_path):
+    fetch = FakeFetch()
+    for action in ["a", "b"]:
+        bag_path = bag_cache.get_bag(LOCATION, str(tmp_path / action) + "/", fetch)
+        with open(os.path.join(bag_path, "file.txt")) as f:
+            assert f.read() == "content"
+    assert len(fetch.calls) == 1
+    assert bag_cache.stats()["hits"] == 1
+
+
+def test_failed_fetch_is_resumed(tmp_path, cache_dir):
+    fetch = FakeFetch(fail=1)
+    with pytest.raises(OSError):
+        bag_cache.get_bag(LOCATION, str(tmp_path / "a") + "/", fetch)
+    staging_dir = fetch.calls[0][0]
+    # The partial download survives, the partial extraction does not block the retry
+    assert os.path.exists(os.path.join(staging_dir, "bag.zip"))
+
+    bag_path = bag_cache.get_bag(LOCATION, str(tmp_path / "b") + "/", fetch)
+    assert fetch.calls[1] == (staging_dir, True)
+    assert os.path.exists(os.path.join(bag_path, "file.txt"))
+    assert not os.path.exists(staging_dir)
+
+
+def test_fetch_does_not_block_other_bags(tmp_path, monkeypatch):
+    monkeypatch.setattr(bag_cache.downloads, "probe",
+                        lambda location: {"etag": location, "last_modified": None})
+    fetching = threading.Event()
+    release = threading.Event()
+
+    def slow_fetch(location, directory):
+        fetching.set()
+        assert release.wait(10)
+        return FakeFetch()(location, directory)
+
+    slow = threading.Thread(target=bag_cache.get_bag,
+                            args=("https://example.org/slow.zip", str(tmp_path / "a") + "/",
+                                  slow_fetch))
+    slow.start()
+    try:
+        assert fetching.wait(10)
+        bag_path = bag_cache.get_bag(LOCATION, str(tmp_path / "b") + "/", FakeFetch())
+        assert os.path.exists(os.path.join(bag_path, "file.txt"))
+    finally:
+        release.set()
+        slow.join()
+
+
+def test_evict_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(bag_cache.downloads, "probe",
+                        lambda location: {"etag": location, "last_modified": None})
+    monkeypatch.setitem(CONFIG, "BAG_CACHE_MAX_SIZE", 1)
+    bag_cache.get_bag("https://example.org/1.zip", str(tmp_path / "a") + "/", FakeFetch())
+    bag_cache.get_bag("https://example.org/2.zip", str(tmp_path / "b") + "/", FakeFetch())
+    assert bag_cache.stats()["evictions"] == 1
+    # The evicted bag is still available to its action
+    assert os.path.exists(tmp_path / "a" / "bag" / "file.txt")
@@ -0,0 +1,136 @@
+import json
+
+import pytest
+import requests
+
+from cfde_ap import CONFIG, downloads
+
+
+DATA = bytes(range(256)) * 4
+INFO = {"size": len(DATA), "ranges": True, "etag": '"v1"', "last_modified": None,
+        "filename": "bag.zip"}
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content, cut=None, etag=None):
+        self.status_code = status_code
+        self.content = content
+        self.cut = cut
+        self.headers = {"ETag": etag} if etag else {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def iter_content(self, chunk_size):
+        # Deliver cut bytes, then drop the connection
+        content = self.content if self.cut is None else self.content[:self.cut]
+        for start in range(0, len(content), 64):
+            yield content[start:start + 64]
+
+
+class FakeServer(object):
+    """Serves DATA as byte ranges, failing the requests for the given first bytes,
+    or answering them with the given statuses.
+    """
+    def __init__(self, fail=(), cut=(), statuses=(), etag='"v1"'):
+        self.fail = set(fail)
+        self.cut = dict(cut)
+        self.statuses = dict(statuses)
+        self.etag = etag
+        self.ranges = []
+
+    def get(self, location, headers=None, stream=False, timeout=None):
+        first, last = (int(byte) for byte in headers["Range"][len("bytes="):].split("-"))
+        self.ranges.append(first)
+        # Servers answer If-Range with a weak ETag with the whole file
+        if "If-Range" in headers and (headers["If-Range"] != self.etag
+                                      or headers["If-Range"].startswith("W/")):
+            return FakeResponse(200, DATA, etag=self.etag)
+        if first in self.fail:
+            raise requests.exceptions.ConnectionError("Connection reset")
+        if first in self.statuses:
+            return FakeResponse(self.statuses.pop(first), b"")
+        return FakeResponse(206, DATA[first:last + 1], self.cut.pop(first, None), self.etag)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setitem(CONFIG, "DOWNLOAD_RANGE_SIZE", 256)
+    monkeypatch.setitem(CONFIG, "DOWNLOAD_CONNECTIONS", 1)
+    monkeypatch.setitem(CONFIG, "DOWNLOAD_RETRIES", 0)
+    monkeypatch.setattr(downloads.time, "sleep", lambda seconds: None)
+
+    def serve(**kwargs):
+        fake = FakeServer(**kwargs)
+        monkeypatch.setattr(downloads.requests, "get", fake.get)
+        return fake
+    return serve
+
+
+def test_failed_download_resumed(server, tmp_path):
+    file_path = str(tmp_path / "bag.zip")
+    server(fail=[768])
+    with pytest.raises(requests.exceptions.ConnectionError):
+        downloads.download_ranges("https://example.org/bag.zip", file_path, INFO)
+    with open(file_path + ".progress") as f:
+        assert json.load(f)["done"] == [0, 1, 2]
+
+    resumed = server()
+    downloads.download_ranges("https://example.org/bag.zip", file_path, INFO)
+    assert resumed.ranges == [768]
+    with open(file_path, "rb") as f:
+        assert f.read() == DATA
+    assert not (tmp_path / "bag.zip.progress").exists()
+
+
+def test_changed_file_not_resumed(server, tmp_path):
+    file_path = str(tmp_path / "bag.zip")
+    server(fail=[768])
+    with pytest.raises(requests.exceptions.ConnectionError):
+        downloads.download_ranges("https://example.org/bag.zip", file_path, INFO)
+    restarted = server(etag='"v2"')
+    downloads.download_ranges("https://example.org/bag.zip", file_path, dict(INFO, etag='"v2"'))
+    assert restarted.ranges == [0, 256, 512, 768]
+
+
+def test_file_changed_during_download(server, tmp_path):
+    server(etag='"v2"')
+    with pytest.raises(IOError, match="the file may have changed"):
+        downloads.download_ranges("https://example.org/bag.zip", str(tmp_path / "bag.zip"), INFO)
+
+
+def test_range_continues_from_last_byte(server, monkeypatch, tmp_path):
+    monkeypatch.setitem(CONFIG, "DOWNLOAD_RETRIES", 1)
+    file_path = str(tmp_path / "bag.zip")
+    fake = server(cut={256: 100})
+    downloads.download_ranges("https://example.org/bag.zip", file_path, INFO)
+    assert fake.ranges == [0, 256, 356, 512, 768]
+    with open(file_path, "rb") as f:
+        assert f.read() == DATA
+
+
+def test_transient_status_retried(server, monkeypatch, tmp_path):
+    monkeypatch.setitem(CONFIG, "DOWNLOAD_RETRIES", 1)
+    file_path = str(tmp_path / "bag.zip")
+    fake = server(statuses={256: 503})
+    downloads.download_ranges("https://example.org/bag.zip", file_path, INFO)
+    assert fake.ranges == [0, 256, 256, 512, 768]
+
+
+def test_weak_etag_not_sent_in_if_range(server, tmp_path):
+    file_path = str(tmp_path / "bag.zip")
+    server(etag='W/"v1"')
+    downloads.download_ranges("https://example.org/bag.zip", file_path,
+                              dict(INFO, etag='W/"v1"'))
+    with open(file_path, "rb") as f:
+        assert f.read() == DATA
+
+
+def test_weak_etag_changed_during_download(server, tmp_path):
+    server(etag='W/"v2"')
+    with pytest.raises(IOError, match="the file changed"):
+        downloads.download_ranges("https://example.org/bag.zip", str(tmp_path / "bag.zip"),
+                                  dict(INFO, etag='W/"v1"'))
@@ -0,0 +1,297 @@
+import json
+
+import pytest
+import requests
+
+from cfde_ap import loader
+
+
+class FakeType(object):
+    def __init__(self, typename):
+        self.typename = typename
+
+
+class FakeColumn(object):
+    def __init__(self, name, typename):
+        self.name = name
+        self.type = FakeType(typename)
+
+
+class FakeColumns(list):
+    def __init__(self, columns):
+        super().__init__(columns)
+        self.elements = {column.name: column for column in columns}
+
+    def __getitem__(self, name):
+        if isinstance(name, str):
+            return self.elements[name]
+        return super().__getitem__(name)
+
+
+class FakeKey(object):
+    def __init__(self, columns):
+        self.unique_columns = columns
+
+
+class FakeTable(object):
+    def __init__(self, name, columns, key, foreign_keys=()):
+        self.name = name
+        self.columns = FakeColumns([FakeColumn(*column) for column in columns])
+        self.keys = [FakeKey([self.columns["RID"]]),
+                     FakeKey([self.columns[name] for name in key])]
+        self.foreign_keys = list(foreign_keys)
+
+
+class FakeResponse(object):
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeCatalog(object):
+    """Returns the given rows for attribute reads, and records changes."""
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.requests = []
+
+    def get(self, path):
+        return FakeResponse(self.rows)
+
+    def post(self, path, data=None, headers=None):
+        self.requests.append(("post", path, json.loads(data)))
+
+    def put(self, path, data=None, headers=None):
+        self.requests.append(("put", path, json.loads(data)))
+
+    def delete(self, path):
+        self.requests.append(("delete", path, None))
+
+
+TABLE = FakeTable("sample", [("RID", "ermrest_rid"), ("local_id", "text"),
+                             ("weight", "float8"), ("count", "int8"),
+                             ("created", "timestamptz"), ("verified", "boolean"),
+                             ("info", "jsonb")], key=["local_id"])
+HEADER = ["local_id", "weight", "count", "created", "verified", "info"]
+
+
+def row2dict_factory(header):
+    # Like CfdeDataPackage.make_row2dict(), json values are parsed and missing values are null
+    def row2dict(row):
+        return {name: (None if value == "" else json.loads(value) if name == "info" else value)
+                for name, value in zip(header, row)}
+    return row2dict
+
+
+def write_tsv(path, rows):
+    with open(path, "w") as out:
+        for row in [HEADER] + rows:
+            out.write("\t".join(row) + "\n")
+    return str(path)
+
+
+@pytest.mark.parametrize("typename,catalog_value,text", [
+    ("float8", 1.0, "1"),
+    ("float8", 0.5, "0.50"),
+    ("int8", 12, "12"),
+    ("timestamptz", "2020-05-01T12:00:00+00:00", "2020-05-01T12:00:00Z"),
+    ("timestamptz", "2020-05-01T12:00:00+00:00", "2020-05-01 14:00:00+02:00"),
+    ("date", "2020-05-01", "2020-05-01"),
+    ("boolean", True, "true"),
+    ("boolean", False, "F"),
+    ("int8", None, None),
+    ("boolean", None, None),
+    ("text", None, None)
+])
+def test_normalize_typed_values(typename, catalog_value, text):
+    assert loader._normalize(catalog_value, typename) == loader._normalize(text, typename)
+
+
+@pytest.mark.parametrize("typename,catalog_value,text", [
+    ("float8", 1.5, "1.25"),
+    ("timestamptz", "2020-05-01T12:00:00+00:00", "2020-05-01T12:00:01Z"),
+    ("boolean", True, "false"),
+    ("int8", 0, None),
+    ("text", "", None)
+])
+def test_normalize_changed_values(typename, catalog_value, text):
+    assert loader._normalize(catalog_value, typename) != loader._normalize(text, typename)
+
+
+def test_upsert_skips_unchanged_typed_rows(tmp_path):
+    catalog = FakeCatalog([
+        {"RID": "1-A", "local_id": "a", "weight": 2.0, "count": 3,
+         "created": "2020-05-01T12:00:00+00:00", "verified": True, "info": {"x": 1, "y": [2]}},
+        {"RID": "1-B", "local_id": "b", "weight": None, "count": None,
+         "created": None, "verified": False, "info": None},
+        {"RID": "1-C", "local_id": "c", "weight": 1.0, "count": 1,
+         "created": None, "verified": None, "info": None}
+    ])
+    path = write_tsv(tmp_path / "sample.tsv", [
+        ["a", "2", "3", "2020-05-01T12:00:00Z", "true", '{"y": [2], "x": 1}'],
+        ["b", "", "", "", "false", ""],
+        ["c", "1.5", "1", "", "", ""],
+        ["d", "", "", "", "", ""]
+    ])
+    entities = loader.EntityLoader(catalog, batch_size=10, workers=1, retries=0, mode="sync")
+    result = entities.load_table("CFDE", TABLE, path, row2dict_factory)
+    assert (result["inserted"], result["updated"], result["unchanged"]) == (1, 1, 2)
+    assert result["stale_rids"] == []
+    assert [(method, [row["local_id"] for row in rows])
+            for method, path, rows in catalog.requests] == [("post", ["d"]), ("put", ["c"])]
+
+
+class FakeForeignKey(object):
+    def __init__(self, pk_table_name):
+        self.pk_table = FakeTable(pk_table_name, [("RID", "ermrest_rid"), ("id", "text")],
+                                  key=["id"])
+
+
+class FailingCatalog(FakeCatalog):
+    """Fails every request after the first posts."""
+    def __init__(self, posts):
+        super().__init__()
+        self.posts = posts
+        self.catalog_id = "12"
+
+    def post(self, path, data=None, headers=None):
+        if self.posts == 0:
+            raise ValueError("409 Conflict")
+        self.posts -= 1
+        super().post(path, data, headers)
+
+
+class FakeDataPackage(object):
+    resource_tag = "resource"
+
+    def __init__(self, catalog, tables):
+        self.catalog = catalog
+        self.tables = {table.name: table for table in tables}
+        self.model_doc = {"schemas": {"CFDE": {"tables": {
+            table.name: {"annotations": {"resource": {"path": table.name + ".tsv"}}}
+            for table in tables
+        }}}}
+        self.cat_model_root = self
+
+    def data_tnames_topo_sorted(self):
+        return list(self.tables)
+
+    def table(self, schema_name, table_name):
+        return self.tables[table_name]
+
+    def make_row2dict(self, table, header):
+        return row2dict_factory(header)
+
+
+def test_self_referencing_table_in_one_request(tmp_path):
+    table = FakeTable("taxonomy", [("RID", "ermrest_rid"), ("id", "text"), ("parent", "text")],
+                      key=["id"], foreign_keys=[FakeForeignKey("taxonomy")])
+    path = tmp_path / "taxonomy.tsv"
+    # Rows reference rows later in the file
+    path.write_text("id\tparent\n" + "".join(f"{i}\t{i + 1}\n" for i in range(25)))
+    catalog = FakeCatalog()
+    entities = loader.EntityLoader(catalog, batch_size=10, workers=4, retries=0)
+    result = entities.load_table("CFDE", table, str(path), row2dict_factory)
+    assert result["inserted"] == 25
+    assert [(method, len(rows)) for method, path, rows in catalog.requests] == [("post", 25)]
+
+
+def test_batches_of_other_tables(tmp_path):
+    path = write_tsv(tmp_path / "sample.tsv", [[str(i), "", "", "", "", ""] for i in range(25)])
+    catalog = FakeCatalog()
+    entities = loader.EntityLoader(catalog, batch_size=10, workers=1, retries=0)
+    entities.load_table("CFDE", TABLE, path, row2dict_factory)
+    assert [len(rows) for method, path, rows in catalog.requests] == [10, 10, 5]
+
+
+def test_partial_load_reported(tmp_path, monkeypatch):
+    monkeypatch.setitem(loader.CONFIG, "LOAD_BATCH_SIZE", 10)
+    monkeypatch.setitem(loader.CONFIG, "LOAD_WORKERS", 1)
+    write_tsv(tmp_path / "sample.tsv", [[str(i), "", "", "", "", ""] for i in range(25)])
+    datapack = FakeDataPackage(FailingCatalog(posts=2), [TABLE])
+    with pytest.raises(loader.PartialLoadError) as error:
+        loader.load_datapackage(datapack, str(tmp_path))
+    assert error.value.rows_written == 20
+    assert error.value.catalog_id == "12"
+    assert "20 rows were written to catalog 12" in str(error.value)
+
+
+def test_failed_load_without_writes(tmp_path):
+    write_tsv(tmp_path / "sample.tsv", [["a", "", "", "", "", ""]])
+    datapack = FakeDataPackage(FailingCatalog(posts=0), [TABLE])
+    with pytest.raises(ValueError):
+        loader.load_datapackage(datapack, str(tmp_path))
+
+
+def keyless_table():
+    table = FakeTable("note", [("RID", "ermrest_rid"), ("text", "text")], key=["text"])
+    table.keys = table.keys[:1]
+    return table
+
+
+def test_resumed_insert_skips_loaded_rows(tmp_path):
+    path = write_tsv(tmp_path / "sample.tsv", [["a", "", "", "", "", ""],
+                                               ["b", "", "", "", "", ""]])
+    catalog = FakeCatalog([{"RID": "1-A", "local_id": "a", "weight": None, "count": None,
+                            "created": None, "verified": None, "info": None}])
+    entities = loader.EntityLoader(catalog, batch_size=10, workers=1, retries=0, resume=True)
+    entities.load_table("CFDE", TABLE, path, row2dict_factory)
+    assert [(method, [row["local_id"] for row in rows])
+            for method, path, rows in catalog.requests] == [("post", ["b"])]
+
+
+def test_resumed_insert_of_empty_keyless_table(tmp_path):
+    path = tmp_path / "note.tsv"
+    path.write_text("text\nfirst\nsecond\n")
+    catalog = FakeCatalog()
+    entities = loader.EntityLoader(catalog, batch_size=10, workers=1, retries=0, resume=True)
+    assert entities.load_table("CFDE", keyless_table(), str(path), row2dict_factory)[
+        "inserted"] == 2
+
+
+def test_resumed_insert_of_loaded_keyless_table(tmp_path):
+    path = tmp_path / "note.tsv"
+    path.write_text("text\nfirst\nsecond\n")
+    catalog = FakeCatalog([{"RID": "1-A", "text": "first"}])
+    entities = loader.EntityLoader(catalog, batch_size=10, workers=1, retries=0, resume=True)
+    with pytest.raises(ValueError, match="Unable to resume loading table 'note'"):
+        entities.load_table("CFDE", keyless_table(), str(path), row2dict_factory)
+    assert catalog.requests == []
+
+
+class FlakyCatalog(FakeCatalog):
+    """Loses the response to the first post. Retries skip the first committed rows,
+    as if they were already in the catalog, and insert the rest.
+    """
+    def __init__(self, committed):
+        super().__init__()
+        self.committed = committed
+
+    def post(self, path, data=None, headers=None):
+        super().post(path, data, headers)
+        rows = json.loads(data)
+        if len(self.requests) == 1:
+            raise requests.ConnectionError("Connection reset")
+        return FakeResponse(rows[self.committed:])
+
+
+@pytest.mark.parametrize("committed", [0, 3])
+def test_retried_insert_after_lost_response(tmp_path, monkeypatch, committed):
+    monkeypatch.setattr(loader.time, "sleep", lambda seconds: None)
+    path = write_tsv(tmp_path / "sample.tsv", [[str(i), "", "", "", "", ""] for i in range(3)])
+    catalog = FlakyCatalog(committed)
+    entities = loader.EntityLoader(catalog, batch_size=10, workers=1, retries=1)
+    assert entities.load_table("CFDE", TABLE, path, row2dict_factory)["inserted"] == 3
+    assert [path for method, path, rows in catalog.requests] == [
+        "/entity/CFDE:sample", "/entity/CFDE:sample?onconflict=skip"]
+
+
+def test_retried_insert_with_conflicting_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(loader.time, "sleep", lambda seconds: None)
+    path = write_tsv(tmp_path / "sample.tsv", [[str(i), "", "", "", "", ""] for i in range(3)])
+    # Only some rows skipped: they were in the catalog before, not inserted by the lost post
+    catalog = FlakyCatalog(1)
+    entities = loader.EntityLoader(catalog, batch_size=10, workers=1, retries=1)
+    with pytest.raises(ValueError, match="1 of 3 rows"):
+        entities.load_table("CFDE", TABLE, path, row2dict_factory)
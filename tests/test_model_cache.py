@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from cfde_ap import CONFIG, model_cache
+
+
+@pytest.fixture
+def models(monkeypatch):
+    metas = []
+    monkeypatch.setattr(model_cache, "refresh_model", lambda: metas[-1])
+    monkeypatch.setattr(model_cache, "CfdeDataPackage", lambda path, verbose: {"path": path})
+    monkeypatch.setitem(CONFIG, "DERIVA_SCHEMA_LOCATION", "https://example.org/model.json")
+    monkeypatch.setattr(model_cache, "LOADED_MODEL", dict.fromkeys(model_cache.LOADED_MODEL))
+    return metas
+
+
+def add_model(models, sha256):
+    models.append({"location": CONFIG["DERIVA_SCHEMA_LOCATION"], "sha256": sha256,
+                   "path": f"/cache/model-{sha256}.json"})
+
+
+def test_forced_check_parses_changed_model(models):
+    add_model(models, "a")
+    assert model_cache.get_canonical_datapackage() == {"path": "/cache/model-a.json"}
+    add_model(models, "b")
+    # Checked recently, so action processes use the inherited model
+    assert model_cache.get_canonical_datapackage() == {"path": "/cache/model-a.json"}
+    with model_cache.LOADED_MODEL_LOCK:
+        model_cache._check_model(force=True)
+    assert model_cache.get_canonical_datapackage() == {"path": "/cache/model-b.json"}
+
+
+def test_fork_during_refresh_gets_free_lock():
+    with model_cache.LOADED_MODEL_LOCK:
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if model_cache.LOADED_MODEL_LOCK.acquire(timeout=5) else 1)
+    assert os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) == 0
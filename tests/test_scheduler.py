@@ -0,0 +1,132 @@
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from cfde_ap import error as err, scheduler
+
+
+def wait_job(path):
+    # Run until the test creates path
+    while not os.path.exists(path):
+        time.sleep(0.01)
+
+
+def crash_job():
+    os._exit(3)
+
+
+@pytest.fixture
+def job_log(tmp_path):
+    return scheduler.JobLog(str(tmp_path / "jobs.db"), "node-1")
+
+
+def set_owner(job_log, action_id, pid, start):
+    job_log._connect().execute("UPDATE jobs SET owner_pid = ?, owner_start = ? "
+                               "WHERE action_id = ?", (pid, start, action_id))
+
+
+def claimed_ids(job_log):
+    return [job["action_id"] for job in job_log.claim_orphans()]
+
+
+def test_claim_job_of_exited_process(job_log):
+    job_log.add("act-1", "ingest", ["act-1", "https://example.org/bag.zip"], 0)
+    # Jobs recorded by this process ID were recorded by an earlier process
+    jobs = job_log.claim_orphans()
+    assert [job["action_id"] for job in jobs] == ["act-1"]
+    assert jobs[0]["attempts"] == 2
+    assert jobs[0]["args"] == ["act-1", "https://example.org/bag.zip"]
+
+
+def test_live_owner_keeps_job(job_log):
+    job_log.add("act-1", "ingest", [], 0)
+    parent = os.getppid()
+    set_owner(job_log, "act-1", parent, scheduler._process_start(parent))
+    assert claimed_ids(job_log) == []
+
+
+def test_reused_pid_does_not_keep_job(job_log):
+    job_log.add("act-1", "ingest", [], 0)
+    if scheduler._process_start(os.getppid()) is None:
+        pytest.skip("Process start times are not available")
+    set_owner(job_log, "act-1", os.getppid(), "other-boot:1")
+    assert claimed_ids(job_log) == ["act-1"]
+
+
+def test_live_worker_keeps_job(job_log):
+    job_log.add("act-1", "ingest", [], 0)
+    set_owner(job_log, "act-1", None, None)
+    job_log.start("act-1", os.getppid())
+    assert claimed_ids(job_log) == []
+
+
+def test_checkpoint_survives_claim(job_log):
+    job_log.add("act-1", "ingest", [], 0)
+    job_log.checkpoint("act-1", "catalog_created", bag_path="/data/bag", catalog_id="12")
+    assert claimed_ids(job_log) == ["act-1"]
+    assert job_log.get_checkpoint("act-1") == ("catalog_created",
+                                               {"bag_path": "/data/bag", "catalog_id": "12"})
+
+
+def test_upgrade_old_job_log(tmp_path):
+    db_path = str(tmp_path / "jobs.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE jobs (action_id TEXT PRIMARY KEY, "
+                 "node_id TEXT, operation TEXT, args TEXT, priority INTEGER, "
+                 "state TEXT, owner_pid INTEGER, worker_pid INTEGER, "
+                 "attempts INTEGER, stage TEXT, checkpoint TEXT)")
+    conn.execute("INSERT INTO jobs VALUES ('act-1', 'node-1', 'ingest', '[]', 0, 'running', "
+                 "?, NULL, 1, NULL, NULL)", (os.getpid(),))
+    conn.commit()
+    conn.close()
+    assert claimed_ids(scheduler.JobLog(db_path, "node-1")) == ["act-1"]
+
+
+def test_submit_reports_whether_job_waits(tmp_path):
+    jobs = scheduler.JobScheduler({"wait": wait_job}, max_workers=1, max_queued=1)
+    release = str(tmp_path / "release")
+    assert jobs.submit("act-1", "wait", (release,)) is True
+    assert jobs.submit("act-2", "wait", (release,)) is False
+    with pytest.raises(err.ServiceUnavailable):
+        jobs.submit("act-3", "wait", (release,))
+    assert jobs.stats()["rejected"] == 1
+
+
+def test_every_job_marked_started(tmp_path, job_log):
+    started = []
+    done = threading.Event()
+    release = str(tmp_path / "release")
+
+    def on_start(action_id):
+        started.append(action_id)
+        if len(started) == 2:
+            done.set()
+
+    jobs = scheduler.JobScheduler({"wait": wait_job}, max_workers=1, max_queued=1,
+                                  job_log=job_log, on_start=on_start)
+    jobs.submit("act-1", "wait", (release,))
+    jobs.submit("act-2", "wait", (release,))
+    jobs.start()
+    open(release, "w").close()
+    assert done.wait(10)
+    assert started == ["act-1", "act-2"]
+
+
+def test_crashed_job_reported(job_log):
+    errors = []
+    reported = threading.Event()
+
+    def on_error(action_id, error):
+        errors.append((action_id, str(error)))
+        reported.set()
+
+    jobs = scheduler.JobScheduler({"crash": crash_job}, max_workers=1, max_queued=1,
+                                  job_log=job_log, on_error=on_error)
+    jobs.submit("act-1", "crash", ())
+    jobs.start()
+    assert reported.wait(10)
+    assert errors == [("act-1", "Action process exited with code 3")]
+    assert job_log.action_ids() == []
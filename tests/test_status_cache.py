@@ -0,0 +1,47 @@
+import time
+
+import pytest
+
+from cfde_ap import CONFIG, status_cache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    monkeypatch.setitem(CONFIG, "STATUS_MAX_STALENESS", 60)
+    status_cache.STATUS_CACHE.clear()
+    status_cache.SEEN_AT.clear()
+    return now
+
+
+def test_consistent_read_is_fresh(clock):
+    status_cache.put("actions", "act-1", {"status": "ACTIVE"}, fresh=True)
+    clock[0] += 20
+    assert status_cache.is_fresh("actions", "act-1")
+    assert status_cache.get("actions", "act-1") == {"status": "ACTIVE"}
+    clock[0] += 41
+    assert not status_cache.is_fresh("actions", "act-1")
+
+
+def test_eventual_read_keeps_age_of_last_consistent_read(clock):
+    status_cache.put("actions", "act-1", {"status": "ACTIVE"}, fresh=True)
+    clock[0] += 55
+    # Within the cache TTL, but last known current more than STATUS_MAX_STALENESS ago
+    status_cache.put("actions", "act-1", {"status": "ACTIVE"}, fresh=False)
+    clock[0] += 10
+    assert status_cache.get("actions", "act-1") is None
+    assert not status_cache.is_fresh("actions", "act-1")
+
+
+def test_eventual_read_of_unseen_action_not_cached(clock):
+    status_cache.put("actions", "act-1", {"status": "ACTIVE"}, fresh=False)
+    assert status_cache.get("actions", "act-1") is None
+
+
+def test_published_status_is_fresh(clock):
+    status_cache.publish("actions", "act-1", {"status": "SUCCEEDED"})
+    assert status_cache.is_fresh("actions", "act-1")
+    status_cache.publish("actions", "act-1", None)
+    assert status_cache.get("actions", "act-1") is None
+    assert not status_cache.is_fresh("actions", "act-1")
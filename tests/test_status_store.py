@@ -0,0 +1,163 @@
+import boto3
+from botocore.stub import ANY, Stubber
+import pytest
+
+from cfde_ap import error as err, status_store
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return status_store.SQLiteStatusStore(str(tmp_path / "status.db"))
+    return status_store.MemoryStatusStore()
+
+
+def test_one_action_per_request(store):
+    status = store.create("actions", {"status": "INACTIVE", "request_id": "req-1"})
+    with pytest.raises(err.DuplicateRequest):
+        store.create("actions", {"status": "INACTIVE", "request_id": "req-1"})
+    assert store.read_by_request("actions", "req-1")["action_id"] == status["action_id"]
+    assert len(store.list("actions")) == 1
+
+
+def test_released_request_reused(store):
+    status = store.create("actions", {"status": "SUCCEEDED", "request_id": "req-1"})
+    store.delete("actions", status["action_id"])
+    with pytest.raises(err.NotFound):
+        store.read_by_request("actions", "req-1")
+    store.create("actions", {"status": "INACTIVE", "request_id": "req-1"})
+
+
+@pytest.fixture
+def dmo_table(monkeypatch):
+    resource = boto3.resource("dynamodb", region_name="us-east-1",
+                              aws_access_key_id="test", aws_secret_access_key="test")
+    table = resource.Table("actions")
+    monkeypatch.setattr(status_store, "get_dmo_table", lambda table_name, client=None: table)
+    with Stubber(table.meta.client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+def marker_conflict(action_id):
+    return {
+        "CancellationReasons": [{
+            "Code": "None"
+        }, {
+            "Code": "ConditionalCheckFailed",
+            "Item": {
+                "action_id": {"S": "request_id:req-1"},
+                "request_action_id": {"S": action_id}
+            }
+        }]
+    }
+
+
+def test_dynamo_create_claims_request(dmo_table):
+    dmo_table.add_response("transact_write_items", {})
+    status = status_store.DynamoStatusStore().create(
+                "actions", {"status": "INACTIVE", "request_id": "req-1"})
+    assert status["request_id"] == "req-1"
+
+
+def test_dynamo_duplicate_request(dmo_table):
+    dmo_table.add_client_error("transact_write_items", "TransactionCanceledException",
+                               modeled_fields=marker_conflict("act-1"))
+    dmo_table.add_response("get_item", {"Item": {"action_id": {"S": "act-1"},
+                                                 "request_id": {"S": "req-1"}}},
+                           {"TableName": "actions", "Key": {"action_id": "act-1"},
+                            "ConsistentRead": True})
+    with pytest.raises(err.DuplicateRequest):
+        status_store.DynamoStatusStore().create(
+                "actions", {"status": "INACTIVE", "request_id": "req-1"})
+
+
+def test_dynamo_stale_marker_replaced(dmo_table):
+    dmo_table.add_client_error("transact_write_items", "TransactionCanceledException",
+                               modeled_fields=marker_conflict("act-old"))
+    # The action was released, but its marker was left behind
+    dmo_table.add_response("get_item", {})
+    dmo_table.add_response("delete_item", {})
+    dmo_table.add_response("transact_write_items", {})
+    status_store.DynamoStatusStore().create(
+                "actions", {"status": "INACTIVE", "request_id": "req-1"})
+
+
+def test_dynamo_read_by_request_consistent(dmo_table):
+    dmo_table.add_response("get_item", {"Item": {"action_id": {"S": "request_id:req-1"},
+                                                 "request_action_id": {"S": "act-1"}}},
+                           {"TableName": "actions", "Key": {"action_id": "request_id:req-1"},
+                            "ConsistentRead": True})
+    dmo_table.add_response("get_item", {"Item": {"action_id": {"S": "act-1"},
+                                                 "status": {"S": "ACTIVE"}}},
+                           {"TableName": "actions", "Key": {"action_id": "act-1"},
+                            "ConsistentRead": True})
+    status = status_store.DynamoStatusStore().read_by_request("actions", "req-1")
+    assert status["action_id"] == "act-1"
+
+
+@pytest.mark.parametrize("updates", [{}, {"action_id": "act-1"}])
+def test_update_expression_empty(updates):
+    assert status_store.make_update_expression(updates) is None
+
+
+def test_update_expression_merges_dicts():
+    args = status_store.make_update_expression({"action_id": "act-1", "status": "ACTIVE",
+                                                "details": {"message": "Loading"}})
+    assert args["UpdateExpression"] == "SET #u0 = :u0, #u1.#u2 = :u1"
+    assert args["ExpressionAttributeNames"] == {"#u0": "status", "#u1": "details",
+                                                "#u2": "message"}
+    assert args["ExpressionAttributeValues"] == {":u0": "ACTIVE", ":u1": "Loading"}
+
+
+def test_dynamo_empty_update_skips_write(dmo_table):
+    # Only the current status is read, no UpdateItem is made
+    dmo_table.add_response("get_item", {"Item": {"action_id": {"S": "act-1"},
+                                                 "status": {"S": "ACTIVE"}}})
+    status = status_store.DynamoStatusStore().update("actions", "act-1", {"action_id": "act-1"})
+    assert status["status"] == "ACTIVE"
+
+
+def test_dynamo_release_request_marker_not_found(dmo_table):
+    dmo_table.add_client_error("delete_item", "ConditionalCheckFailedException",
+                               modeled_fields={"Item": {
+                                   "action_id": {"S": "request_id:req-1"},
+                                   "request_action_id": {"S": "act-1"}
+                               }})
+    with pytest.raises(err.NotFound):
+        status_store.DynamoStatusStore().delete("actions", "request_id:req-1", ["user-1"])
+
+
+def test_dynamo_read_by_request_index_fallback(dmo_table):
+    # Actions created before markers are found by the keys-only index, then read by key
+    dmo_table.add_response("get_item", {})
+    dmo_table.add_response("query", {"Items": [{"action_id": {"S": "act-1"},
+                                                "request_id": {"S": "req-1"}}]})
+    dmo_table.add_response("get_item", {"Item": {"action_id": {"S": "act-1"},
+                                                 "request_id": {"S": "req-1"},
+                                                 "status": {"S": "SUCCEEDED"}}},
+                           {"TableName": "actions", "Key": {"action_id": "act-1"},
+                            "ConsistentRead": True})
+    status = status_store.DynamoStatusStore().read_by_request("actions", "req-1")
+    assert status["status"] == "SUCCEEDED"
+
+
+def test_dynamo_update_creates_missing_map(dmo_table):
+    dmo_table.add_client_error("update_item", "ValidationException",
+                               "The document path provided in the update expression "
+                               "is invalid for update")
+    dmo_table.add_response("update_item", {}, {
+        "TableName": "actions",
+        "Key": {"action_id": "act-1"},
+        "ConditionExpression": ANY,
+        "UpdateExpression": "SET #u0 = if_not_exists(#u0, :u0)",
+        "ExpressionAttributeNames": {"#u0": "details"},
+        "ExpressionAttributeValues": {":u0": {}}
+    })
+    dmo_table.add_response("update_item", {"Attributes": {
+        "action_id": {"S": "act-1"},
+        "details": {"M": {"message": {"S": "Loading"}}}
+    }})
+    status = status_store.DynamoStatusStore().update(
+                "actions", "act-1", {"details": {"message": "Loading"}})
+    assert status["details"] == {"message": "Loading"}